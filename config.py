@@ -18,26 +18,44 @@ TASKS_PER_MACHINE = 1
 MACHINE_TYPE = ['t2.micro']
 MACHINE_PRICE = 0.10
 EBS_VOL_SIZE = 22                       # In GB.  Minimum allowed is 22.
+SCALE_MIN_MACHINES = 1                  # The monitor resizes the fleet to the queue, between these bounds
+SCALE_MAX_MACHINES = CLUSTER_MACHINES
+SCALE_DEADLINE_HOURS = 0                # Finish the queue this long after startCluster with as few machines as will do (0 = as fast as SCALE_MAX_MACHINES allows)
 
 # DOCKER INSTANCE RUNNING ENVIRONMENT:
 DOCKER_CORES = 1                        # Number of software processes to run inside a docker container
 CPU_SHARES = DOCKER_CORES * 1024        # ECS computing units assigned to each docker container (1024 units = 1 core)
 MEMORY = 800                            # Memory assigned to the docker container in MB
-SECONDS_TO_START = 3*60                 # Wait before the next process is initiated to avoid memory collisions
+TASK_MEMORY_MB = max(MEMORY - 256, MEMORY // 2) // DOCKER_CORES  # Estimated peak memory of one copy of your software; a new copy starts only when this much is free
+                                        # (the default keeps ~256 MB for the supervisor, instance monitor and s3fs, which share the container)
+TASK_DISK_MB = 1024                     # Estimated local disk one copy of your software needs while running
+DOWNLOAD_FILES = 'False'                # True or False - copy each job's input_files to local disk, through a cache shared by the copies in a container
+INPUT_CACHE_MB = 0                      # Local disk the input cache may fill (0 = a quarter of the container's volume)
+SAVE_OUTPUT_BOOL = 'False'              # True or False - save each job's full console output, gzipped, with its results
+WORKER_IDLE_SECONDS = 10*60             # How long a worker keeps polling an empty queue before it exits (0 = exit at once)
+PIPELINE_BOOL = 'False'                 # True or False - fetch the next job's inputs and upload the last job's outputs while a job runs
 
 # SQS QUEUE INFORMATION:
 SQS_QUEUE_NAME = APP_NAME + 'Queue'
 SQS_MESSAGE_VISIBILITY = 1*60           # Timeout (secs) for messages in flight (average time to be processed)
+SQS_HEARTBEAT_BOOL = 'True'             # True or False - workers keep extending a short visibility while a job runs
 SQS_DEAD_LETTER_QUEUE = 'user_DeadMessages'
+SQS_PREFETCH_MESSAGES = 10              # Messages a worker may receive at once and buffer (1-10)
+SQS_GROUPS_PER_MESSAGE = 1              # Groups packed into each message (1 = no packing, 0 = as many as fit)
+SQS_MESSAGE_CODEC = 'json'              # 'json', 'zlib' (compressed JSON) or 'msgpack' (needs the msgpack package)
+TEMPLATE_IN_S3_BOOL = 'False'           # True or False - store the shared job keys once in AWS_BUCKET instead of in every message
 
 # LOG GROUP INFORMATION:
 LOG_GROUP_NAME = APP_NAME
+INSTANCE_METRICS_SECONDS = 30   # How often each container logs its memory, CPU and disk readings to the _perInstance logs
+METRICS_FILE = ''            # Optional path (inside the container) to also append each job's timing record to, as JSON lines
 
 # REDUNDANCY CHECKS
 CHECK_IF_DONE_BOOL = 'False' # True or False - should it check if there are a certain number of non-empty files and delete the job if yes?
 EXPECTED_NUMBER_FILES = 7    # What is the number of files that trigger skipping a job?
 MIN_FILE_SIZE_BYTES = 1      # What is the minimal number of bytes an object should be to "count"?
 NECESSARY_STRING = ''        # Is there any string that should be in the file name to "count"?
+OUTPUT_PREFIX_TEMPLATE = ''  # Where your worker puts each group's outputs, e.g. 'output/{plate}/{well}' (needed by submitJob --skip-done)
 
 # PUT ANYTHING SPECIFIC TO YOUR PROGRAM DOWN HERE
 MY_NAME = 'FirstName LastName'
\ No newline at end of file
@@ -1,19 +1,73 @@
 import os, sys
+import asyncio
 import boto3
+import concurrent.futures
 import configparser
+import copy
+import csv
 import datetime
+import hashlib
 import json
+import math
+import random
+import re
+import threading
 import time
-from base64 import b64encode
+import zlib
+from base64 import b64encode, b64decode
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 from config import *
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 WAIT_TIME = 60
-MONITOR_TIME = 60
+MONITOR_TIME = 60               # How often the monitor samples the queue
+FLEET_CHECK_SECONDS = 5*60      # How often it checks the spot fleet's capacity,
+SCALE_SECONDS = 5*60            # resizes the fleet to the queue,
+ALARM_SWEEP_SECONDS = 60*60     # and deletes the alarms of terminated instances
+CHEAPEST_SECONDS = 15*60        # In cheapest mode, the fleet is cut to one machine this long after the monitor starts
+MONITOR_JITTER = 0.1            # Each monitor task's interval varies randomly by up to this fraction
+MONITOR_TIMEOUT = 0.5           # A monitor task running longer than this fraction of its interval...
+MONITOR_MIN_TIMEOUT = 30        # ...or than this many seconds, whichever is longer, is reported as timed out
+SCALE_UP_COOLDOWN = 10*60       # Least time from one fleet resize to growing it again...
+SCALE_DOWN_COOLDOWN = 15*60     # ...or to shrinking it
+SCALE_HYSTERESIS = 0.2          # Resizes by less than this fraction of the fleet are not worth making
+SCALE_RATE_SMOOTHING = 0.3      # Weight of the newest sample in the smoothed jobs-per-machine rate
+SUBMIT_START_CONCURRENCY = 8    # Concurrent SendMessageBatch calls when a submission starts...
+SUBMIT_MAX_CONCURRENCY = 64     # ...and the most the adaptive window may grow to
+SUBMIT_RETRIES = 5              # Attempts for entries that fail inside a batch (throttling doesn't count)
+SUBMIT_BACKOFF_MAX = 20         # Longest random wait before a failed or throttled call is retried
+SUBMIT_LATENCY_SAMPLES = 10000  # Call latencies kept for the percentile report
+SUBMIT_PROGRESS_EVERY = 10000   # Print a progress line every this many messages
+THROTTLING_ERRORS = ['Throttling', 'ThrottlingException', 'RequestThrottled', 'AWS.SimpleQueueService.RequestThrottled', 'RequestLimitExceeded']
+SQS_BATCH_ENTRIES = 10          # SendMessageBatch accepts at most 10 entries...
+SQS_BATCH_BYTES = 262144        # ...and at most 256 KiB of payload per call
+SQS_MAX_MESSAGE_BYTES = 262144  # MaximumMessageSize of the queue
+HEARTBEAT_VISIBILITY = 2*60     # Longest visibility timeout used when workers send heartbeats
+COMPLETION_MANIFEST = '_DS_COMPLETE.json'   # Written by the worker under each finished task's output prefix
+INDEX_THREADS = 16              # Concurrent S3 listings when indexing finished outputs
+MESSAGE_CODEC_VERSION = 'DS1'   # Prefix marking an encoded (non plain JSON) message body
+TEMPLATE_PREFIX = 'jobtemplates/'   # Where shared job templates are stored in AWS_BUCKET
+TEMPLATE_KEY = '_template'          # Message key holding the template reference
+DRAINED_TAG = 'ds:drained'      # Queue tag the monitor sets once the job is done; idle workers then exit at once
+JOB_READ_BYTES = 1024*1024      # Chunk size used when streaming a job file
+JOURNAL_HASH_PREFIX = '#sha256\t' # First line of a submission journal, followed by the hash of the job's files
+DLQ_RECEIVERS = 16              # Parallel receivers draining the dead letter queue
+DLQ_WAIT_SECONDS = 1            # Long-poll wait of each receive...
+DLQ_EMPTY_RECEIVES = 3          # ...and how many empty receives in a row end a receiver
+DLQ_HOLD_SECONDS = 15*60        # Dead letters read but not redriven reappear in the queue after this long at most
+DLQ_TOP_VALUES = 10             # Values listed per group key in the dead letter summary
+RESULTS_PREFIX = 'results/'     # Workers write a result record per task under results/<APP_NAME>/<2 hex digits>/
+COLLECT_THREADS = 64            # Parallel S3 requests when collecting result records
 
 
 #################################
@@ -54,7 +108,7 @@ TASK_DEFINITION = {
 #################################
 
 def generate_task_definition(AWS_PROFILE):
-    task_definition = TASK_DEFINITION.copy()
+    task_definition = copy.deepcopy(TASK_DEFINITION)
 
     config = configparser.ConfigParser()
     config.read(f"{os.environ['HOME']}/.aws/config")
@@ -133,8 +187,40 @@ def generate_task_definition(AWS_PROFILE):
             "value": ECS_CLUSTER
         },
         {
-            "name": "SECONDS_TO_START",
-            "value": str(SECONDS_TO_START)
+            "name": "TASK_MEMORY_MB",
+            "value": str(TASK_MEMORY_MB)
+        },
+        {
+            "name": "TASK_DISK_MB",
+            "value": str(TASK_DISK_MB)
+        },
+        {
+            "name": "DOWNLOAD_FILES",
+            "value": DOWNLOAD_FILES
+        },
+        {
+            "name": "INPUT_CACHE_MB",
+            "value": str(INPUT_CACHE_MB)
+        },
+        {
+            "name": "SAVE_OUTPUT",
+            "value": SAVE_OUTPUT_BOOL
+        },
+        {
+            "name": "IDLE_SECONDS",
+            "value": str(WORKER_IDLE_SECONDS)
+        },
+        {
+            "name": "INSTANCE_METRICS_SECONDS",
+            "value": str(INSTANCE_METRICS_SECONDS)
+        },
+        {
+            "name": "METRICS_FILE",
+            "value": METRICS_FILE
+        },
+        {
+            "name": "PIPELINE",
+            "value": PIPELINE_BOOL
         },
         {
             "name": "MIN_FILE_SIZE_BYTES",
@@ -144,6 +230,18 @@ def generate_task_definition(AWS_PROFILE):
             "name": "NECESSARY_STRING",
             "value": NECESSARY_STRING
         },
+        {
+            "name": "SQS_MESSAGE_VISIBILITY",
+            "value": str(queue_visibility())
+        },
+        {
+            "name": "SQS_HEARTBEAT",
+            "value": SQS_HEARTBEAT_BOOL
+        },
+        {
+            "name": "SQS_PREFETCH_MESSAGES",
+            "value": str(SQS_PREFETCH_MESSAGES)
+        },
         {
             "name": "MY_NAME",
             "value": MY_NAME
@@ -194,6 +292,12 @@ def get_queue_url(sqs, queue_name):
                 queue_url = u
     return queue_url
 
+def queue_visibility():
+    # With heartbeats the visibility timeout only needs to cover a few missed heartbeats, not a whole job
+    if SQS_HEARTBEAT_BOOL.upper() == 'TRUE':
+        return min(SQS_MESSAGE_VISIBILITY, HEARTBEAT_VISIBILITY)
+    return SQS_MESSAGE_VISIBILITY
+
 def get_or_create_queue(sqs):
     queue_url = get_queue_url(sqs, SQS_QUEUE_NAME)
     dead_url = get_queue_url(sqs, SQS_DEAD_LETTER_QUEUE)
@@ -211,13 +315,13 @@ def get_or_create_queue(sqs):
         
         SQS_DEFINITION = {
             "DelaySeconds": "0",
-            "MaximumMessageSize": "262144",
+            "MaximumMessageSize": str(SQS_MAX_MESSAGE_BYTES),
             "MessageRetentionPeriod": "1209600",
             "ReceiveMessageWaitTimeSeconds": "0",
             "RedrivePolicy": '{"deadLetterTargetArn":"'
             + dead_arn
             + '","maxReceiveCount":"10"}',
-            "VisibilityTimeout": str(SQS_MESSAGE_VISIBILITY),
+            "VisibilityTimeout": str(queue_visibility()),
         }
 
         sqs.create_queue(QueueName=SQS_QUEUE_NAME, Attributes=SQS_DEFINITION)
@@ -231,6 +335,271 @@ def loadConfig(configFile):
         data = json.load(conf)
     return data
 
+class JSONStream():
+    # Minimal incremental reader for one JSON document, so a job file never has to be held in memory at once
+
+    whitespace = re.compile(r'\s*')
+    decoder = json.JSONDecoder()
+
+    def __init__(self, fileobj):
+        self.file = fileobj
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        chunk = self.file.read(JOB_READ_BYTES)
+        if chunk == '':
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos+1]
+            self.fill()
+
+    def expect(self, chars):
+        char = self.peek()
+        if char == '' or char not in chars:
+            raise ValueError('Malformed job file: expected one of '+repr(chars)+', found '+repr(char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value that touches the end of the buffer (e.g. a number) may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+def iterJobItems(jobFile):
+    # Yield (key, value) pairs of the top-level job object; each entry of an inline "groups" array
+    # is yielded separately as (None, value) so groups are never accumulated
+    with open(jobFile, 'r') as conf:
+        stream = JSONStream(conf)
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if key == 'groups' and stream.peek() == '[':
+                stream.expect('[')
+                if stream.peek() == ']':
+                    stream.expect(']')
+                else:
+                    while True:
+                        yield None, stream.value()
+                        if stream.expect(',]') == ']':
+                            break
+            else:
+                yield key, stream.value()
+            if stream.expect(',}') == '}':
+                return
+
+def streamGroupFile(groupFile):
+    # Groups kept outside the job file, one per NDJSON line or CSV row (the header names the keys)
+    if groupFile.lower().endswith('.csv'):
+        with open(groupFile, 'r', newline='') as groups:
+            for row in csv.DictReader(groups):
+                yield row
+    else:
+        with open(groupFile, 'r') as groups:
+            for line in groups:
+                if line.strip() != '':
+                    yield json.loads(line)
+
+def loadJobStream(jobFile, sources=None):
+    # Returns the message template and a generator over the groups of a job.
+    # jobFile may be a job JSON (groups inline, or "groups" naming an .ndjson/.jsonl/.csv file
+    # relative to it), or an .ndjson/.jsonl/.csv file of groups with no shared keys.
+    # If sources is a list, the paths of the files the job is read from are added to it.
+    if sources is not None:
+        sources.append(jobFile)
+    if not jobFile.lower().endswith('.json'):
+        return {}, streamGroupFile(jobFile)
+
+    templateMessage = {}
+    groupFile = None
+    for key, value in iterJobItems(jobFile):
+        if key == 'groups':
+            groupFile = os.path.join(os.path.dirname(jobFile), value)
+        elif key is not None and '_comment' not in key:
+            templateMessage[key] = value
+
+    if groupFile is not None:
+        if sources is not None:
+            sources.append(groupFile)
+        return templateMessage, streamGroupFile(groupFile)
+    return templateMessage, (value for key, value in iterJobItems(jobFile) if key is None)
+
+def filesHash(paths):
+    # Hex SHA256 over the contents of the given files, in order
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(JOB_READ_BYTES), b''):
+                digest.update(chunk)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def encodeMessage(data, codec=None):
+    # Encode a message body with SQS_MESSAGE_CODEC. Encoded bodies look like 'DS1:<codec>:<base64>';
+    # plain JSON is kept whenever encoding would not make the body smaller, so sizes computed on the
+    # JSON form are always an upper bound. Workers read both forms.
+    if codec is None:
+        codec = SQS_MESSAGE_CODEC
+    body = json.dumps(data)
+    if codec == 'json':
+        return body
+    elif codec == 'zlib':
+        payload = zlib.compress(body.encode('utf-8'))
+    elif codec == 'msgpack':
+        if msgpack is None:
+            raise ImportError("SQS_MESSAGE_CODEC 'msgpack' requires the msgpack package (pip install msgpack)")
+        payload = msgpack.packb(data, use_bin_type=True)
+    else:
+        raise ValueError('Unknown SQS_MESSAGE_CODEC '+str(codec))
+    encoded = MESSAGE_CODEC_VERSION+':'+codec+':'+b64encode(payload).decode('ascii')
+    if len(encoded) < len(body.encode('utf-8')):
+        return encoded
+    return body
+
+def uploadTemplate(templateMessage, s3client):
+    # Store the shared part of a job once, named by its content hash, and return its key.
+    # Identical templates (e.g. resubmissions) reuse the existing object.
+    body = json.dumps(templateMessage, sort_keys=True).encode('utf-8')
+    digest = hashlib.sha256(body).hexdigest()
+    key = TEMPLATE_PREFIX + digest + '.json'
+    try:
+        s3client.head_object(Bucket=AWS_BUCKET, Key=key)
+        print('Job template already stored at s3://'+AWS_BUCKET+'/'+key)
+    except ClientError as e:
+        # Anything but "not found" (e.g. no permission) is not a reason to upload, so it is raised
+        if e.response['Error']['Code'] not in ['404', 'NoSuchKey', 'NotFound']:
+            raise
+        s3client.put_object(Bucket=AWS_BUCKET, Key=key, Body=body, ContentType='application/json', Metadata={'sha256': digest})
+        print('Job template uploaded to s3://'+AWS_BUCKET+'/'+key)
+    return key
+
+def packMessages(templateMessage, groups, groupsPerMessage=1):
+    # Build the messages for a job from (index, group) pairs, yielding (group indexes, message).
+    # With groupsPerMessage > 1 (or 0 for no count limit) consecutive groups share one message
+    # under a "groups" list, up to the queue's maximum message size.
+    if groupsPerMessage == 1:
+        for index, group in groups:
+            yield [index], dict(templateMessage, group=group)
+        return
+
+    baseBytes = len(json.dumps(dict(templateMessage, groups=[])).encode('utf-8'))
+    indexes = []
+    pack = []
+    packBytes = baseBytes
+    for index, group in groups:
+        size = len(json.dumps(group).encode('utf-8')) + 2 # plus the ", " separator
+        if pack and (len(pack) == groupsPerMessage or packBytes + size > SQS_MAX_MESSAGE_BYTES):
+            yield indexes, dict(templateMessage, groups=pack)
+            indexes = []
+            pack = []
+            packBytes = baseBytes
+        indexes.append(index)
+        pack.append(group)
+        packBytes += size
+    if pack:
+        yield indexes, dict(templateMessage, groups=pack)
+
+def groupOutputPrefix(group):
+    # The output prefix a worker writes a group's results to, from OUTPUT_PREFIX_TEMPLATE.
+    # Keep that in step with how worker/generic-worker.py builds remoteOut.
+    return OUTPUT_PREFIX_TEMPLATE.format(**group).strip('/')
+
+def indexPartition(s3client, prefix, depth):
+    # Count qualifying objects under each output prefix (the folder depth folders down) of a partition,
+    # using the worker's done rules. Each object counts once, toward the prefix it is under.
+    counts = {}
+    manifests = set()
+    paginator = s3client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=AWS_BUCKET, Prefix=prefix):
+        for eachobject in page.get('Contents', []):
+            parts = eachobject['Key'].split('/')
+            if len(parts) <= depth:
+                continue
+            folder = '/'.join(parts[:depth])
+            name = '/'.join(parts[depth:])
+            if name == COMPLETION_MANIFEST:
+                manifests.add(folder)
+                continue
+            if eachobject['Size'] < MIN_FILE_SIZE_BYTES:
+                continue
+            if NECESSARY_STRING and NECESSARY_STRING not in name:
+                continue
+            counts[folder] = counts.get(folder, 0) + 1
+    return counts, manifests
+
+def buildCompletedIndex(s3client):
+    # Set of output prefixes in AWS_BUCKET that hold a completion manifest or at least
+    # EXPECTED_NUMBER_FILES qualifying files. Only the template's literal root (the text before its
+    # first field) is listed, one listing per folder of the first templated level, in parallel.
+    template = OUTPUT_PREFIX_TEMPLATE.strip('/')
+    depth = len(template.split('/'))
+    root = template.split('{')[0]
+    partitions = []
+    paginator = s3client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=AWS_BUCKET, Prefix=root, Delimiter='/'):
+        partitions += [p['Prefix'] for p in page.get('CommonPrefixes', [])]
+
+    completed = set()
+    counts = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=INDEX_THREADS) as executor:
+        for partitionCounts, manifests in executor.map(lambda prefix: indexPartition(s3client, prefix, depth), partitions):
+            completed |= manifests
+            counts.update(partitionCounts) # partitions never share a folder
+    completed |= {folder for folder in counts.keys() if counts[folder] >= int(EXPECTED_NUMBER_FILES)}
+    return completed
+
+def skipCompleted(groups, completed, missing):
+    # Pass on only (index, group) pairs whose outputs are not complete, recording them in missing
+    for index, group in groups:
+        try:
+            done = groupOutputPrefix(group) in completed
+        except (KeyError, IndexError):
+            done = False    # a group without the keys the template names is never skipped
+        if done:
+            missing.skipped += 1
+            continue
+        missing.write(group)
+        yield index, group
+
+def batchEntries(messages):
+    # Group (tag, message) pairs into SendMessageBatch entry lists, respecting the per-call entry
+    # and size limits. Yields (entries, tags) where tags maps each entry Id back to its tag.
+    batch = []
+    tags = {}
+    batchBytes = 0
+    for sequence, (tag, message) in enumerate(messages):
+        body = encodeMessage(message)
+        size = len(body.encode('utf-8'))
+        if batch and (len(batch) == SQS_BATCH_ENTRIES or batchBytes + size > SQS_BATCH_BYTES):
+            yield batch, tags
+            batch = []
+            tags = {}
+            batchBytes = 0
+        batch.append({'Id': str(sequence), 'MessageBody': body})
+        tags[str(sequence)] = tag
+        batchBytes += size
+    if batch:
+        yield batch, tags
+
 def killdeadAlarms(fleetId,monitorapp,ec2,cloud):
     todel=[]
     changes = ec2.describe_spot_fleet_request_history(SpotFleetRequestId=fleetId,StartTime=(datetime.datetime.now()-datetime.timedelta(hours=2)).replace(microsecond=0))
@@ -334,6 +703,493 @@ def export_logs(logs, loggroupId, starttime, bucketId):
                 break
         time.sleep(30)
 
+def decodeMessage(body):
+    # Inverse of encodeMessage; the worker has the same function
+    if not body.startswith(MESSAGE_CODEC_VERSION+':'):
+        return json.loads(body)
+    _, codec, payload = body.split(':', 2)
+    payload = b64decode(payload)
+    if codec == 'zlib':
+        return json.loads(zlib.decompress(payload).decode('utf-8'))
+    elif codec == 'msgpack':
+        if msgpack is None:
+            raise ImportError('Message was encoded with msgpack, which needs the msgpack package (pip install msgpack)')
+        return msgpack.unpackb(payload, raw=False)
+    else:
+        raise ValueError('Unknown message codec '+codec)
+
+def messageGroups(data):
+    # The groups a message carries, whether packed or not
+    if 'groups' in data:
+        return data['groups']
+    return [data['group']]
+
+def groupMatches(group, filters):
+    return all([str(group.get(eachkey)) == value for eachkey, value in filters])
+
+def drainDeadLetters(sqs, queueUrl):
+    # Receive everything in the dead letter queue with DLQ_RECEIVERS parallel batched receives. The
+    # messages stay hidden for DLQ_HOLD_SECONDS, so each one is only received once.
+    def receive():
+        received = []
+        empty = 0
+        while empty < DLQ_EMPTY_RECEIVES:
+            response = sqs.receive_message(QueueUrl=queueUrl, MaxNumberOfMessages=10, WaitTimeSeconds=DLQ_WAIT_SECONDS,
+                                           VisibilityTimeout=DLQ_HOLD_SECONDS, AttributeNames=['ApproximateReceiveCount'])
+            if len(response.get('Messages', [])) == 0:
+                empty += 1
+            else:
+                empty = 0
+                received += response['Messages']
+        return received
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DLQ_RECEIVERS) as executor:
+        futures = [executor.submit(receive) for _ in range(DLQ_RECEIVERS)]
+        return [eachmessage for future in futures for eachmessage in future.result()]
+
+def settleDeadLetters(sqs, queueUrl, handles, delete):
+    # Delete received dead letters, or (delete=False) make them visible again, 10 per call in parallel
+    def settle(chunk):
+        if delete:
+            entries = [{'Id': str(index), 'ReceiptHandle': handle} for index, handle in enumerate(chunk)]
+            response = sqs.delete_message_batch(QueueUrl=queueUrl, Entries=entries)
+        else:
+            entries = [{'Id': str(index), 'ReceiptHandle': handle, 'VisibilityTimeout': 0} for index, handle in enumerate(chunk)]
+            response = sqs.change_message_visibility_batch(QueueUrl=queueUrl, Entries=entries)
+        return len(response.get('Failed', []))
+    chunks = [handles[start:start+SQS_BATCH_ENTRIES] for start in range(0, len(handles), SQS_BATCH_ENTRIES)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DLQ_RECEIVERS) as executor:
+        failed = sum(executor.map(settle, chunks))
+    if failed > 0:
+        print(failed, 'dead letters could not be', 'deleted' if delete else 'released')
+
+def repackGroups(data, groups):
+    # data with its groups replaced by the given ones
+    shared = {eachkey:value for eachkey, value in data.items() if eachkey not in ['group', 'groups']}
+    if len(groups) == 1:
+        return dict(shared, group=groups[0])
+    return dict(shared, groups=groups)
+
+def redriveDeadLetters(selected, filters):
+    # Send the selected (dead letter, decoded message) pairs back to the main queue. Of a packed letter
+    # only the matching groups are sent; the others go back to the dead letter queue as a new letter.
+    # Returns the receipt handles of the letters that were fully taken care of, to be deleted.
+    queue = JobQueue()
+    try:
+        queue.clearDrained()
+    except (BotoCoreError, ClientError) as e:
+        print('Warning: could not clear the drained mark, so idle workers may exit before this work is done:', e)
+    redrive = []
+    remainders = []
+    for eachmessage, data in selected:
+        groups = messageGroups(data)
+        matching = [group for group in groups if groupMatches(group, filters)]
+        redrive.append((eachmessage['ReceiptHandle'], repackGroups(data, matching)))
+        if len(matching) < len(groups):
+            remainders.append((eachmessage['ReceiptHandle'], repackGroups(data, [group for group in groups if not groupMatches(group, filters)])))
+    journal = RedriveJournal()
+    queue.scheduleBatches(iter(redrive), journal)
+    kept = RedriveJournal()
+    if len(remainders) > 0:
+        JobQueue(name=SQS_DEAD_LETTER_QUEUE).scheduleBatches(iter(remainders), kept)
+    split = {handle for handle, message in remainders}
+    kept = set(kept.handles)
+    return [handle for handle in journal.handles if handle not in split or handle in kept]
+
+def exportDeadLetters(selected, filters, jobFile):
+    # Write the matching groups of the selected (dead letter, decoded message) pairs to job files, one
+    # per distinct template: the first to jobFile, the others to jobFile_2.json, jobFile_3.json and so on
+    s3client = boto3.client('s3')
+    stored = {}     # template key in S3 -> template
+    writers = {}    # template as sorted JSON -> JobFileWriter
+    base, extension = os.path.splitext(jobFile)
+    for eachmessage, data in selected:
+        templateMessage = {eachkey:value for eachkey, value in data.items() if eachkey not in ['group', 'groups']}
+        if TEMPLATE_KEY in templateMessage:
+            key = templateMessage.pop(TEMPLATE_KEY)
+            if key not in stored:
+                stored[key] = json.loads(s3client.get_object(Bucket=AWS_BUCKET, Key=key)['Body'].read().decode('utf-8'))
+            templateMessage = dict(stored[key], **templateMessage)
+        template = json.dumps(templateMessage, sort_keys=True)
+        if template not in writers:
+            path = jobFile if len(writers) == 0 else base+'_'+str(len(writers)+1)+extension
+            writers[template] = JobFileWriter(path, templateMessage)
+        for group in messageGroups(data):
+            if groupMatches(group, filters):
+                writers[template].write(group)
+    if len(writers) == 0:
+        writers[''] = JobFileWriter(jobFile, {})
+    for writer in writers.values():
+        writer.close()
+        print(writer.written, 'dead groups written to', writer.path)
+
+def summarizeDeadLetters(deadMessages):
+    # Count the dead groups by the value of each group key, most common first
+    groups = [group for data in deadMessages for group in messageGroups(data)]
+    print(len(deadMessages), 'dead letters holding', len(groups), 'groups')
+    counts = {}
+    for group in groups:
+        for eachkey in group.keys():
+            value = str(group[eachkey])
+            counts.setdefault(eachkey, {})
+            counts[eachkey][value] = counts[eachkey].get(value, 0) + 1
+    for eachkey in sorted(counts.keys()):
+        values = sorted(counts[eachkey].items(), key=lambda item: -item[1])
+        print('By '+eachkey+' ('+str(len(values))+' values):')
+        for value, count in values[:DLQ_TOP_VALUES]:
+            print('%8d  %s' % (count, value))
+        if len(values) > DLQ_TOP_VALUES:
+            print('          ... and', len(values) - DLQ_TOP_VALUES, 'more')
+
+def readResultRecords(s3client):
+    # List the 256 partitions of this app's result records in parallel, then fetch the records in parallel
+    prefix = RESULTS_PREFIX + APP_NAME + '/'
+
+    def listPartition(partition):
+        keys = []
+        paginator = s3client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=AWS_BUCKET, Prefix=prefix + partition + '/'):
+            keys += [eachobject['Key'] for eachobject in page.get('Contents', [])]
+        return keys
+
+    def fetch(key):
+        return json.loads(s3client.get_object(Bucket=AWS_BUCKET, Key=key)['Body'].read().decode('utf-8'))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=COLLECT_THREADS) as executor:
+        partitions = ['%02x' % partition for partition in range(256)]
+        keys = [key for partitionKeys in executor.map(listPartition, partitions) for key in partitionKeys]
+        print('Reading', len(keys), 'result records')
+        return list(executor.map(fetch, keys))
+
+def resultsTable(records):
+    # One row per task. Group values and phase durations each get a column of their own
+    # (group_<key>, <Phase>Seconds); the output files are a list of (key, size) per row.
+    import pyarrow
+    groupKeys = sorted({eachkey for record in records for eachkey in record['group'].keys()})
+    phases = sorted({phase for record in records for phase in record.get('durations', {}).keys()})
+    columns = {
+        'task': pyarrow.array([record['task'] for record in records], pyarrow.string()),
+        'outputPrefix': pyarrow.array([record['outputPrefix'] for record in records], pyarrow.string()),
+        'result': pyarrow.array([record['result'] for record in records], pyarrow.string()),
+        'exitCode': pyarrow.array([record.get('exitCode') for record in records], pyarrow.int64()),
+        'completed': pyarrow.array([record['completed'] for record in records], pyarrow.string()),
+        'outputBytes': pyarrow.array([record.get('outputBytes', 0) for record in records], pyarrow.int64()),
+        'fileCount': pyarrow.array([len(record.get('files', [])) for record in records], pyarrow.int64()),
+    }
+    for eachkey in groupKeys:
+        values = [record['group'].get(eachkey) for record in records]
+        columns['group_'+eachkey] = pyarrow.array([None if value is None else str(value) for value in values], pyarrow.string())
+    for phase in phases:
+        columns[phase+'Seconds'] = pyarrow.array([record.get('durations', {}).get(phase) for record in records], pyarrow.float64())
+    fileType = pyarrow.list_(pyarrow.struct([('key', pyarrow.string()), ('size', pyarrow.int64())]))
+    columns['files'] = pyarrow.array([record.get('files', []) for record in records], fileType)
+    return pyarrow.table(columns)
+
+#################################
+# CLASS TO ADAPT SUBMISSION CONCURRENCY
+#################################
+
+class AdaptiveWindow():
+    # Additive-increase/multiplicative-decrease concurrency limit: grows by about one call per window
+    # of successful calls and halves on throttling or errors, at most once per call latency
+
+    def __init__(self, start, minimum, maximum):
+        self.size = float(start)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.lastDecrease = 0
+
+    @property
+    def limit(self):
+        return int(self.size)
+
+    def increase(self):
+        self.size = min(self.maximum, self.size + 1.0 / self.size)
+
+    def decrease(self, latency):
+        now = time.monotonic()
+        if now - self.lastDecrease >= latency:
+            self.size = max(self.minimum, self.size / 2)
+            self.lastDecrease = now
+
+#################################
+# CLASS TO TRACK SUBMITTED GROUPS
+#################################
+
+class SubmissionJournal():
+    # Append-only record of which groups of a job file have been accepted by SQS,
+    # one "group index<TAB>message ID" line per group. Sent indexes are kept as a bitmap.
+    # Given jobHash (see filesHash), the journal starts with it, and resuming a journal
+    # written for different job files raises ValueError, as its indexes would name other groups.
+
+    def __init__(self, path, resume=False, jobHash=None):
+        self.path = path
+        self.sent = bytearray()
+        self.count = 0
+        if resume and os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'r') as journal:
+                header = journal.readline().rstrip('\n')
+                if jobHash is not None and header != JOURNAL_HASH_PREFIX + jobHash:
+                    raise ValueError(path+' was not written for this version of the job, so it can\'t be resumed; submit it again without --resume')
+                journal.seek(0)
+                for line in journal:
+                    fields = line.rstrip('\n').split('\t')
+                    # a line cut short by a crash has no message ID and is ignored
+                    if len(fields) == 2 and fields[0].isdigit() and fields[1] != '':
+                        self.mark(int(fields[0]))
+            with open(path, 'rb+') as journal:
+                journal.seek(0, os.SEEK_END)
+                if journal.tell() > 0:
+                    journal.seek(-1, os.SEEK_END)
+                    if journal.read(1) != b'\n':
+                        journal.write(b'\n')
+            self.file = open(path, 'a')
+        else:
+            self.file = open(path, 'w')
+            if jobHash is not None:
+                self.file.write(JOURNAL_HASH_PREFIX + jobHash + '\n')
+        self.lastSync = time.time()
+
+    def mark(self, index):
+        byte, bit = divmod(index, 8)
+        if byte >= len(self.sent):
+            self.sent.extend(bytes(byte + 1 - len(self.sent)))
+        if not self.sent[byte] & (1 << bit):
+            self.sent[byte] |= 1 << bit
+            self.count += 1
+
+    def wasSent(self, index):
+        byte, bit = divmod(index, 8)
+        return byte < len(self.sent) and bool(self.sent[byte] & (1 << bit))
+
+    def record(self, indexes, messageId):
+        self.file.write(''.join(str(index)+'\t'+messageId+'\n' for index in indexes))
+        self.file.flush()
+        for index in indexes:
+            self.mark(index)
+        if time.time() - self.lastSync > 1:
+            os.fsync(self.file.fileno())
+            self.lastSync = time.time()
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+#################################
+# CLASS TO WRITE A JOB FILE INCREMENTALLY
+#################################
+
+class JobFileWriter():
+    # Writes a job file group by group, so the groups never have to be held in memory
+
+    def __init__(self, path, templateMessage):
+        self.path = path
+        self.file = open(path, 'w')
+        self.file.write('{\n')
+        for eachkey in templateMessage.keys():
+            self.file.write('  '+json.dumps(eachkey)+': '+json.dumps(templateMessage[eachkey])+',\n')
+        self.file.write('  "groups": [')
+        self.written = 0
+        self.skipped = 0
+
+    def write(self, group):
+        self.file.write((',' if self.written > 0 else '')+'\n    '+json.dumps(group))
+        self.written += 1
+
+    def close(self):
+        self.file.write('\n  ]\n}\n')
+        self.file.close()
+
+#################################
+# CLASS TO TRACK REDRIVEN DEAD LETTERS
+#################################
+
+class RedriveJournal():
+    # Takes the place of a SubmissionJournal when redriving: collects the receipt handles of the
+    # dead letters the main queue has accepted, so only those are deleted from the dead letter queue
+
+    def __init__(self):
+        self.handles = []
+
+    def record(self, handle, messageId):
+        self.handles.append(handle)
+
+#################################
+# CLASS TO RUN THE MONITOR'S PERIODIC TASKS
+#################################
+
+class MonitorScheduler():
+    # Runs each of the monitor's tasks on its own interval, in a thread of its own, so a slow call
+    # (e.g. an alarm sweep) never delays another task. A task never overlaps itself: one still running
+    # when its time limit is up is reported as timed out, and its next runs are skipped (and reported)
+    # until that run returns. Tasks share boto3 clients, which are thread safe; a shared JobQueue
+    # serializes its own reads of the queue.
+
+    def __init__(self):
+        self.tasks = []
+        self.stopping = None
+
+    def add(self, name, function, interval, first=0, timeout=None):
+        # interval None runs the task once, first seconds after the scheduler starts
+        if timeout is None:
+            timeout = max(MONITOR_MIN_TIMEOUT, MONITOR_TIMEOUT * (interval or first))
+        self.tasks.append({'name': name, 'function': function, 'interval': interval, 'first': first, 'timeout': timeout,
+                           'runs': 0, 'errors': 0, 'timeouts': 0, 'skipped': 0, 'total': 0.0, 'slowest': 0.0, 'last': None})
+
+    def stop(self):
+        # Callable from a task's thread
+        self.loop.call_soon_threadsafe(self.stopping.set)
+
+    def jittered(self, seconds):
+        return max(0, seconds * random.uniform(1 - MONITOR_JITTER, 1 + MONITOR_JITTER))
+
+    def finished(self, task, started, future):
+        if future.cancelled():
+            return
+        latency = time.monotonic() - started
+        task['runs'] += 1
+        task['last'] = latency
+        task['total'] += latency
+        task['slowest'] = max(task['slowest'], latency)
+        if future.exception() is not None:
+            task['errors'] += 1
+            print(datetime.datetime.now(), 'Monitor task', task['name'], 'failed:', repr(future.exception()))
+
+    async def runTask(self, task, executor):
+        await asyncio.sleep(self.jittered(task['first']))
+        due = time.monotonic()
+        running = None
+        while True:
+            if running is not None and not running.done():
+                task['skipped'] += 1
+                print(datetime.datetime.now(), 'Monitor task', task['name'], 'skipped: its previous run has not returned yet')
+            else:
+                started = time.monotonic()
+                running = self.loop.run_in_executor(executor, task['function'])
+                task['running'] = running
+                running.add_done_callback(lambda future, started=started: self.finished(task, started, future))
+                done, _ = await asyncio.wait({running}, timeout=task['timeout'])
+                if not done:
+                    task['timeouts'] += 1
+                    print(datetime.datetime.now(), 'Monitor task', task['name'], 'still running after', task['timeout'], 'seconds')
+            if task['interval'] is None:
+                return
+            # A late run is followed at once by the next one; a timed out one is checked again an interval later
+            now = time.monotonic()
+            due = max(due + task['interval'], now if running.done() else now + task['interval'])
+            await asyncio.sleep(self.jittered(due - now))
+
+    async def runAsync(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        # One thread per task: a task is never run twice at once, so none ever waits for a thread
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.tasks)))
+        runners = [asyncio.ensure_future(self.runTask(task, executor)) for task in self.tasks]
+        await self.stopping.wait()
+        for runner in runners:
+            runner.cancel()
+        await asyncio.gather(*runners, return_exceptions=True)
+        # Calls still running (already reported as timed out) are waited for, so none is left racing the
+        # monitor's cleanup, or finishing after the event loop has closed
+        outstanding = [task for task in self.tasks if task.get('running') is not None and not task['running'].done()]
+        for task in outstanding:
+            print(datetime.datetime.now(), 'Waiting for monitor task', task['name'], 'to finish')
+        await asyncio.gather(*[task['running'] for task in outstanding], return_exceptions=True)
+        executor.shutdown(wait=True)
+
+    def run(self):
+        # Returns once a task calls stop()
+        asyncio.run(self.runAsync())
+
+    def report(self):
+        print('Monitor task latency (seconds):')
+        for task in self.tasks:
+            if task['runs'] == 0:
+                print('  %-12s no finished runs; %d timeouts, %d skipped' % (task['name'], task['timeouts'], task['skipped']))
+            else:
+                print('  %-12s %5d runs, last %.2f, mean %.2f, max %.2f; %d errors, %d timeouts, %d skipped' % (
+                    task['name'], task['runs'], task['last'], task['total'] / task['runs'], task['slowest'],
+                    task['errors'], task['timeouts'], task['skipped']))
+
+#################################
+# CLASS TO SCALE THE FLEET WITH THE QUEUE
+#################################
+
+class FleetScaler():
+    # Sizes the spot fleet (and, when growing it, the ECS service) to the jobs left in the queue. Without a
+    # deadline that is enough machines to run every job left at once; with one, just enough to finish
+    # by the deadline at the throughput per machine measured so far. Never below what the jobs in
+    # process need, and always within SCALE_MIN_MACHINES and SCALE_MAX_MACHINES.
+
+    def __init__(self, fleetId, cluster, service, ec2, ecs, deadline=None):
+        self.fleetId = fleetId
+        self.cluster = cluster
+        self.service = service
+        self.ec2 = ec2
+        self.ecs = ecs
+        self.deadline = deadline        # time.time() by which the queue should be empty, or None
+        self.minimum = SCALE_MIN_MACHINES
+        self.maximum = SCALE_MAX_MACHINES
+        self.rate = None                # smoothed jobs finished per second per machine
+        self.last = None                # (time, jobs left, machines) at the previous step
+        self.lastChange = time.time()   # startCluster has just sized the fleet
+
+    def measure(self, now, left, machines):
+        if self.last is not None:
+            then, before, machinesBefore = self.last
+            meanMachines = (machines + machinesBefore) / 2
+            # Jobs added since the last step (e.g. a resubmission) make the count go up; such a step says nothing
+            if left <= before and meanMachines > 0 and now > then:
+                rate = (before - left) / (now - then) / meanMachines
+                if self.rate is None:
+                    self.rate = rate
+                else:
+                    self.rate = SCALE_RATE_SMOOTHING * rate + (1 - SCALE_RATE_SMOOTHING) * self.rate
+        self.last = (now, left, machines)
+
+    def desired(self, visible, inFlight, now):
+        jobsPerMachine = TASKS_PER_MACHINE * DOCKER_CORES
+        most = math.ceil((visible + inFlight) / jobsPerMachine)
+        least = math.ceil(inFlight / jobsPerMachine)
+        target = most
+        if self.deadline is not None and self.rate:
+            remaining = max(self.deadline - now, SCALE_SECONDS)
+            target = min(most, math.ceil((visible + inFlight) / (self.rate * remaining)))
+        return min(self.maximum, max(self.minimum, least, target))
+
+    def step(self, visible, inFlight):
+        now = time.time()
+        request = self.ec2.describe_spot_fleet_requests(SpotFleetRequestIds=[self.fleetId])['SpotFleetRequestConfigs'][0]
+        if request['SpotFleetRequestState'] != 'active':
+            # e.g. 'modifying' while the last resize is carried out
+            return None
+        current = request['SpotFleetRequestConfig']['TargetCapacity']
+        machines = len(self.ec2.describe_spot_fleet_instances(SpotFleetRequestId=self.fleetId)['ActiveInstances'])
+        self.measure(now, visible + inFlight, machines)
+        target = self.desired(visible, inFlight, now)
+
+        if target == current:
+            return None
+        # A fraction only, so small fleets still grow or shrink a machine at a time
+        small = abs(target - current) < SCALE_HYSTERESIS * current and target not in [self.minimum, self.maximum]
+        cooldown = SCALE_UP_COOLDOWN if target > current else SCALE_DOWN_COOLDOWN
+        if small or now - self.lastChange < cooldown:
+            return None
+
+        # Shrinking only lowers the fleet's target, as downscaleSpotFleet does: no machine is terminated and
+        # the service keeps its desiredCount, since ECS would stop containers in the middle of a job. Machines
+        # left idle are terminated by their alarms and not replaced.
+        self.ec2.modify_spot_fleet_request(SpotFleetRequestId=self.fleetId, TargetCapacity=target, ExcessCapacityTerminationPolicy='noTermination')
+        tasks = self.ecs.describe_services(cluster=self.cluster, services=[self.service])['services'][0]['desiredCount']
+        if target > current and target * TASKS_PER_MACHINE > tasks:
+            tasks = target * TASKS_PER_MACHINE
+            self.ecs.update_service(cluster=self.cluster, service=self.service, desiredCount=tasks)
+        self.lastChange = now
+        rate = 'not measured yet' if self.rate is None else '%.2f jobs/hour per machine' % (self.rate * 3600)
+        print(datetime.datetime.now(), 'Resized the fleet from', current, 'to', target, 'machines and', tasks, 'tasks;',
+              visible, 'pending,', inFlight, 'in process, throughput', rate)
+        return target
+
 #################################
 # CLASS TO HANDLE SQS QUEUE
 #################################
@@ -342,22 +1198,123 @@ class JobQueue():
 
     def __init__(self,name=None):
         self.sqs = boto3.resource('sqs')
+        # Throttling is handled by scheduleBatches' adaptive window, so botocore should not retry on its own
+        self.client = boto3.client('sqs', config=Config(retries={'total_max_attempts': 1, 'mode': 'standard'}))
         if name==None:
             self.queue = self.sqs.get_queue_by_name(QueueName=SQS_QUEUE_NAME)
         else:
             self.queue = self.sqs.get_queue_by_name(QueueName=name)
         self.inProcess = -1
         self.pending = -1
+        # boto3 resources are not thread safe, and the monitor reads the queue from several threads
+        self.loadLock = threading.Lock()
 
     def scheduleBatch(self, data):
-        msg = json.dumps(data)
+        msg = encodeMessage(data)
         response = self.queue.send_message(MessageBody=msg)
         print('Batch sent. Message ID:',response.get('MessageId'))
 
+    async def scheduleBatchesAsync(self, messages, journal=None):
+        # Send (group indexes, message) pairs with SendMessageBatch calls run on a thread pool, keeping
+        # at most window.limit calls in flight. Only the entries SQS reports as failed are retried; sender
+        # faults (e.g. an oversized message) will never succeed, so they are reported instead.
+        loop = asyncio.get_running_loop()
+        window = AdaptiveWindow(SUBMIT_START_CONCURRENCY, 1, SUBMIT_MAX_CONCURRENCY)
+        inFlight = asyncio.Condition()
+        stats = {'sent': 0, 'failed': [], 'throttled': 0, 'calls': 0, 'running': 0, 'latencies': []}
+        start = time.time()
+
+        def recordLatency(latency):
+            stats['calls'] += 1
+            if len(stats['latencies']) < SUBMIT_LATENCY_SAMPLES:
+                stats['latencies'].append(latency)
+            else:
+                slot = random.randrange(stats['calls'])
+                if slot < SUBMIT_LATENCY_SAMPLES:
+                    stats['latencies'][slot] = latency
+
+        async def send(entries, tags):
+            # Throttling doesn't use up the SUBMIT_RETRIES attempts: a throttled call shrinks the window and
+            # is retried, after a growing wait, until SQS takes it, so a throttled job is sent more slowly
+            # rather than dropped. Only other failures count as attempts.
+            attempts = 0
+            throttled = 0       # throttled calls in a row
+            while True:
+                async with inFlight:
+                    await inFlight.wait_for(lambda: stats['running'] < window.limit)
+                    stats['running'] += 1
+                callStart = time.monotonic()
+                try:
+                    response = await loop.run_in_executor(executor, lambda: self.client.send_message_batch(QueueUrl=self.queue.url, Entries=entries))
+                    error = None
+                except (BotoCoreError, ClientError) as e:
+                    response = None
+                    error = e
+                latency = time.monotonic() - callStart
+                recordLatency(latency)
+                async with inFlight:
+                    stats['running'] -= 1
+                    inFlight.notify_all()
+
+                if response is None:
+                    isThrottled = isinstance(error, ClientError) and error.response['Error']['Code'] in THROTTLING_ERRORS
+                else:
+                    for eachsuccess in response.get('Successful', []):
+                        stats['sent'] += 1
+                        if journal is not None:
+                            journal.record(tags[eachsuccess['Id']], eachsuccess['MessageId'])
+                        if stats['sent'] % SUBMIT_PROGRESS_EVERY == 0:
+                            print(datetime.datetime.now(), stats['sent'], 'messages sent, concurrency', window.limit)
+                    stats['failed'] += [f for f in response.get('Failed', []) if f.get('SenderFault')]
+                    retries = [f for f in response.get('Failed', []) if not f.get('SenderFault')]
+                    retryIds = {f['Id'] for f in retries}
+                    entries = [e for e in entries if e['Id'] in retryIds]
+                    if len(entries) == 0:
+                        window.increase()
+                        return
+                    isThrottled = all(f.get('Code') in THROTTLING_ERRORS for f in retries)
+                window.decrease(latency)
+                if isThrottled:
+                    stats['throttled'] += 1
+                    throttled += 1
+                else:
+                    throttled = 0
+                    attempts += 1
+                    if attempts == SUBMIT_RETRIES:
+                        break
+                await asyncio.sleep(random.uniform(0, min(SUBMIT_BACKOFF_MAX, 0.1 * 2 ** (attempts + throttled))))
+            stats['failed'] += [{'Id': e['Id'], 'SenderFault': False, 'Code': 'RetriesExhausted', 'Message': 'Gave up after '+str(SUBMIT_RETRIES)+' attempts'} for e in entries]
+
+        # Batches are only read from messages while fewer than 2*SUBMIT_MAX_CONCURRENCY are waiting,
+        # so messages may be a generator over a job of any size
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SUBMIT_MAX_CONCURRENCY) as executor:
+            pending = set()
+            for entries, tags in batchEntries(messages):
+                if len(pending) >= 2 * SUBMIT_MAX_CONCURRENCY:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        task.result()
+                pending.add(asyncio.ensure_future(send(entries, tags)))
+            if pending:
+                await asyncio.gather(*pending)
+
+        elapsed = max(time.time() - start, 1e-6)
+        print('%d messages sent in %.1f seconds (%.1f messages/sec)' % (stats['sent'], elapsed, stats['sent'] / elapsed))
+        if stats['latencies']:
+            latencies = sorted(stats['latencies'])
+            percentile = lambda p: 1000 * latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+            print('%d SendMessageBatch calls, latency p50 %.0f ms, p90 %.0f ms, p99 %.0f ms; %d throttled; final concurrency %d' % (
+                stats['calls'], percentile(0.5), percentile(0.9), percentile(0.99), stats['throttled'], window.limit))
+        if len(stats['failed']) > 0:
+            print(len(stats['failed']), 'messages could not be sent. First error:', stats['failed'][0].get('Code'), stats['failed'][0].get('Message'))
+        return stats['sent'], stats['failed']
+
+    def scheduleBatches(self, messages, journal=None):
+        # Each message is recorded in the journal, if given, once SQS has accepted it
+        return asyncio.run(self.scheduleBatchesAsync(messages, journal))
+
     def pendingLoad(self):
-        self.queue.load()
-        visible = int( self.queue.attributes['ApproximateNumberOfMessages'] )
-        nonVis = int( self.queue.attributes['ApproximateNumberOfMessagesNotVisible'] )
+        visible, nonVis = self.returnLoad()
         if [visible, nonVis] != [self.pending,self.inProcess]:
             self.pending = visible
             self.inProcess = nonVis
@@ -368,10 +1325,17 @@ class JobQueue():
         else:
             return False
 
+    def markDrained(self):
+        self.client.tag_queue(QueueUrl=self.queue.url, Tags={DRAINED_TAG: 'true'})
+
+    def clearDrained(self):
+        self.client.untag_queue(QueueUrl=self.queue.url, TagKeys=[DRAINED_TAG])
+
     def returnLoad(self):
-        self.queue.load()
-        visible = int( self.queue.attributes['ApproximateNumberOfMessages'] )
-        nonVis = int( self.queue.attributes['ApproximateNumberOfMessagesNotVisible'] )
+        with self.loadLock:
+            self.queue.load()
+            visible = int( self.queue.attributes['ApproximateNumberOfMessages'] )
+            nonVis = int( self.queue.attributes['ApproximateNumberOfMessagesNotVisible'] )
         return visible, nonVis
 
 
@@ -398,20 +1362,62 @@ def setup():
 
 def submitJob():
     if len(sys.argv) < 3:
-        print('Use: run.py submitJob jobfile')
+        print('Use: run.py submitJob jobfile [--resume] [--skip-done]')
         sys.exit()
 
-    # Step 1: Read the job configuration file
-    jobInfo = loadConfig(sys.argv[2])
-    templateMessage = {eachkey:jobInfo[eachkey] for eachkey in jobInfo.keys() if eachkey != "groups" and "_comment" not in eachkey}
+    resume = '--resume' in sys.argv[3:]
+    skipDone = '--skip-done' in sys.argv[3:]
+    if skipDone and not OUTPUT_PREFIX_TEMPLATE:
+        print('--skip-done needs OUTPUT_PREFIX_TEMPLATE in config.py, set to where your worker puts each group\'s outputs')
+        sys.exit()
+
+    # Step 1: Read the shared part of the job configuration file; groups are streamed while sending
+    sources = []
+    templateMessage, groups = loadJobStream(sys.argv[2], sources)
+    groups = enumerate(groups)
+
+    # Step 2: Open the journal of submitted groups; with --resume, it must belong to the same job files
+    try:
+        journal = SubmissionJournal(sys.argv[2] + '.journal', resume, filesHash(sources))
+    except ValueError as e:
+        print(e)
+        sys.exit()
 
-    # Step 2: Reach the queue and schedule tasks
+    # Optionally leave out groups whose outputs are already complete in AWS_BUCKET,
+    # writing the remaining ones to a new job file as they are sent
+    missing = None
+    if skipDone:
+        print('Indexing finished outputs in', AWS_BUCKET)
+        completed = buildCompletedIndex(boto3.client('s3'))
+        print(len(completed), 'output folders are already complete')
+        missing = JobFileWriter(os.path.splitext(sys.argv[2])[0] + '_missing.json', templateMessage)
+        groups = skipCompleted(groups, completed, missing)
+
+    if TEMPLATE_IN_S3_BOOL.upper() == 'TRUE':
+        templateMessage = {TEMPLATE_KEY: uploadTemplate(templateMessage, boto3.client('s3'))}
+
+    # With --resume, skip the groups the journal already lists
+    if resume:
+        print('Resuming submission,', journal.count, 'groups were already sent')
+    groups = ((index, group) for index, group in groups if not journal.wasSent(index))
+
+    # Step 3: Reach the queue and schedule tasks
     print('Contacting queue')
     queue = JobQueue()
+    try:
+        queue.clearDrained()
+    except (BotoCoreError, ClientError) as e:
+        print('Warning: could not clear the drained mark, so idle workers may exit before this work is done:', e)
     print('Scheduling tasks')
-    for batch in jobInfo["groups"]:
-        templateMessage["group"] = batch
-        queue.scheduleBatch(templateMessage)
+    messages = packMessages(templateMessage, groups, SQS_GROUPS_PER_MESSAGE)
+    try:
+        queue.scheduleBatches(messages, journal)
+    finally:
+        journal.close()
+        if missing is not None:
+            missing.close()
+    if missing is not None:
+        print(missing.skipped, 'groups were already done;', missing.written, 'missing groups written to', missing.path)
     print('Job submitted. Check your queue')
 
 #################################
@@ -534,31 +1540,60 @@ def monitor(cheapest=False):
     # Benefit: this will always be the cheapest possible way to run, because if machines die they'll die fast,
     # Potential downside- if machines are at low availability when you start to run, you'll only ever get a small number
     # of machines (as opposed to getting more later when they become available), so it might take VERY long to run if that happens.
-    if cheapest:
-        queue = JobQueue(name=queueId)
-        startcountdown = time.time()
-        while queue.pendingLoad():
-            if time.time() - startcountdown > 900:
-                downscaleSpotFleet(queue, fleetId, ec2, manual=1)
-                break
-            time.sleep(MONITOR_TIME)
 
-    # Step 1: Create job and count messages periodically
+    # Step 1: Count messages periodically until none are left, while the other monitor tasks run on their own schedules
     queue = JobQueue(name=queueId)
-    while queue.pendingLoad():
-        #Once an hour (except at midnight) check for terminated machines and delete their alarms.
-        #This is slooooooow, which is why we don't just do it at the end
-        curtime=datetime.datetime.now().strftime('%H%M')
-        if curtime[-2:]=='00':
-            if curtime[:2]!='00':
-                killdeadAlarms(fleetId,monitorapp,ec2,cloud)
-        #Once every 10 minutes, check if all jobs are in process, and if so scale the spot fleet size to match
-        #the number of jobs still in process WITHOUT force terminating them.
-        #This can help keep costs down if, for example, you start up 100+ machines to run a large job, and
-        #1-10 jobs with errors are keeping it rattling around for hours.
-        if curtime[-1:]=='9':
-            downscaleSpotFleet(queue, fleetId, ec2)
-        time.sleep(MONITOR_TIME)
+    scheduler = MonitorScheduler()
+    fleet = {}
+
+    def sampleQueue():
+        if not queue.pendingLoad():
+            scheduler.stop()
+
+    def checkFleet():
+        request = ec2.describe_spot_fleet_requests(SpotFleetRequestIds=[fleetId])['SpotFleetRequestConfigs'][0]
+        state = {'target': request['SpotFleetRequestConfig']['TargetCapacity'],
+                 'fulfilled': request['SpotFleetRequestConfig'].get('FulfilledCapacity'),
+                 'state': request['SpotFleetRequestState']}
+        if state != fleet:
+            fleet.update(state)
+            print(datetime.datetime.now(), 'Spot fleet', fleetId, state['state'] + ': target capacity', state['target'], 'fulfilled', state['fulfilled'])
+
+    scheduler.add('queue', sampleQueue, MONITOR_TIME)
+    scheduler.add('fleet', checkFleet, FLEET_CHECK_SECONDS)
+    #Check for terminated machines and delete their alarms.
+    #This is slooooooow, which is why we don't just do it at the end
+    scheduler.add('alarms', lambda: killdeadAlarms(fleetId,monitorapp,ec2,cloud), ALARM_SWEEP_SECONDS, first=ALARM_SWEEP_SECONDS)
+    #Resize the spot fleet and the ECS service to the jobs left: up when a backlog builds or machines were
+    #reclaimed, down (WITHOUT force terminating anything) when, for example, you start up 100+ machines to run a
+    #large job and 1-10 jobs with errors are keeping it rattling around for hours.
+    deadline = None
+    if SCALE_DEADLINE_HOURS:
+        deadline = int(monitorInfo["MONITOR_START_TIME"]) / 1000 + SCALE_DEADLINE_HOURS * 60 * 60
+    scaler = FleetScaler(fleetId, monitorcluster, monitorapp+'Service', ec2, boto3.client('ecs'), deadline)
+
+    def scale():
+        # Uses the queue task's latest sample rather than reading the queue from a second thread
+        if queue.pending >= 0:
+            scaler.step(queue.pending, queue.inProcess)
+
+    def cutToOne():
+        scaler.maximum = 1
+        downscaleSpotFleet(queue, fleetId, ec2, manual=1)
+
+    if cheapest:
+        # The fleet never grows past its starting size, nor past one machine after the cut
+        scaler.maximum = min(scaler.maximum, CLUSTER_MACHINES)
+        scheduler.add('cheapest', cutToOne, None, first=CHEAPEST_SECONDS)
+    scheduler.add('scale', scale, SCALE_SECONDS, first=SCALE_SECONDS)
+    scheduler.run()
+    scheduler.report()
+
+    # Tell any workers waiting for more work that none is coming
+    try:
+        queue.markDrained()
+    except (BotoCoreError, ClientError) as e:
+        print('Could not mark the queue as drained:', e)
 
     # Step 2: When no messages are pending, stop service
     # Reload the monitor info, because for long jobs new fleets may have been started, etc
@@ -619,13 +1654,99 @@ def monitor(cheapest=False):
 
     print('All export tasks done')
 
+#################################
+# SERVICE 5: TRIAGE DEAD LETTERS
+#################################
+
+def deadletters():
+    usage = 'Use: run.py deadletters summary | redrive | export jobfile  [key=value ...]'
+    if len(sys.argv) < 3 or sys.argv[2] not in ['summary', 'redrive', 'export']:
+        print(usage)
+        sys.exit()
+    action = sys.argv[2]
+    args = sys.argv[3:]
+    if action == 'export':
+        if len(args) == 0 or '=' in args[0]:
+            print(usage)
+            sys.exit()
+        jobFile = args.pop(0)
+    # Only dead letters with a group matching every key=value given are redriven or exported
+    filters = [arg.split('=', 1) for arg in args]
+
+    # Step 1: Read the whole dead letter queue
+    sqs = boto3.client('sqs')
+    deadUrl = get_queue_url(sqs, SQS_DEAD_LETTER_QUEUE)
+    if deadUrl is None:
+        print('Dead letter queue '+SQS_DEAD_LETTER_QUEUE+' does not exist')
+        return
+    print('Reading dead letters from '+SQS_DEAD_LETTER_QUEUE)
+    received = drainDeadLetters(sqs, deadUrl)
+    redriven = []
+    try:
+        # Letters that can't be decoded are left in the dead letter queue for a closer look
+        deadMessages = []
+        undecodable = []
+        for eachmessage in received:
+            try:
+                data = decodeMessage(eachmessage['Body'])
+                messageGroups(data)
+                deadMessages.append((eachmessage, data))
+            except (ValueError, KeyError, TypeError, ImportError, zlib.error) as e:
+                undecodable.append(repr(e))
+        if len(undecodable) > 0:
+            print(len(undecodable), 'dead letters could not be decoded and were skipped; the first error was', undecodable[0])
+        selected = [(eachmessage, data) for eachmessage, data in deadMessages
+                    if any([groupMatches(group, filters) for group in messageGroups(data)])]
+        if len(filters) > 0:
+            print(len(selected), 'of', len(deadMessages), 'dead letters match', ' '.join(args))
+
+        # Step 2: Summarize, redrive or export the selected ones
+        summarizeDeadLetters([data for eachmessage, data in selected])
+        if action == 'redrive' and len(selected) > 0:
+            redriven = redriveDeadLetters(selected, filters)
+            settleDeadLetters(sqs, deadUrl, redriven, delete=True)
+            print(len(redriven), 'dead letters sent back to '+SQS_QUEUE_NAME)
+        elif action == 'export':
+            exportDeadLetters(selected, filters, jobFile)
+    finally:
+        # Step 3: Everything not redriven goes back to the dead letter queue, even if something above failed
+        redriven = set(redriven)
+        settleDeadLetters(sqs, deadUrl, [eachmessage['ReceiptHandle'] for eachmessage in received if eachmessage['ReceiptHandle'] not in redriven], delete=False)
+
+#################################
+# SERVICE 6: COLLECT RESULTS
+#################################
+
+def collect():
+    if len(sys.argv) > 3:
+        print('Use: run.py collect [outputfile.parquet | outputfile.arrow]')
+        sys.exit()
+    # Imported here rather than at the top, so other commands don't pay for loading it
+    try:
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        print('run.py collect needs the pyarrow package (pip install pyarrow)')
+        sys.exit()
+    outFile = sys.argv[2] if len(sys.argv) == 3 else os.path.join('files', APP_NAME+'_results.parquet')
+
+    s3client = boto3.client('s3', config=Config(max_pool_connections=COLLECT_THREADS))
+    records = readResultRecords(s3client)
+    table = resultsTable(records)
+    if outFile.endswith('.parquet'):
+        pyarrow.parquet.write_table(table, outFile, compression='zstd')
+    else:
+        # Arrow IPC (Feather v2) file
+        pyarrow.feather.write_feather(table, outFile, compression='zstd')
+    print(table.num_rows, 'task results written to', outFile)
+
 #################################
 # MAIN USER INTERACTION
 #################################
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
-        print('Use: run.py setup | submitJob | startCluster | monitor')
+        print('Use: run.py setup | submitJob | startCluster | monitor | deadletters | collect')
         sys.exit()
 
     if sys.argv[1] == 'setup':
@@ -636,6 +1757,10 @@ if __name__ == '__main__':
         startCluster()
     elif sys.argv[1] == 'monitor':
         monitor()
+    elif sys.argv[1] == 'deadletters':
+        deadletters()
+    elif sys.argv[1] == 'collect':
+        collect()
     else:
-        print('Use: run.py setup | submitJob | startCluster | monitor')
+        print('Use: run.py setup | submitJob | startCluster | monitor | deadletters | collect')
         sys.exit()
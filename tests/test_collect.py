@@ -0,0 +1,46 @@
+import json
+import sys
+
+import boto3
+import pytest
+from moto import mock_s3
+
+import run
+import config
+
+pyarrow = pytest.importorskip("pyarrow")
+import pyarrow.parquet
+
+
+def result_record(s3, well, result, durations, files):
+    prefix = f"output/P1-{well}"
+    record = {"task": f"P1-{well}", "group": {"plate": "P1", "well": well}, "outputPrefix": prefix,
+              "result": result, "exitCode": 0 if result == "SUCCESS" else 1, "completed": "2024-01-01T00:00:00Z",
+              "durations": durations, "outputBytes": sum(size for name, size in files),
+              "files": [{"key": f"{prefix}/{name}", "size": size} for name, size in files]}
+    digest = f"{ord(well[0]):02x}"
+    s3.put_object(Bucket=config.AWS_BUCKET, Key=f"{run.RESULTS_PREFIX}{config.APP_NAME}/{digest}/{well}.json",
+                  Body=json.dumps(record))
+
+
+class TestCollect:
+    @mock_s3
+    def test_collect_parquet(self, tmp_path, monkeypatch):
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=config.AWS_BUCKET)
+        result_record(s3, "A01", "SUCCESS", {"Download": 1.5, "Run": 10.0}, [("a.csv", 10), ("b.csv", 20)])
+        result_record(s3, "B01", "FAILURE", {"Download": 2.0}, [])
+        s3.put_object(Bucket=config.AWS_BUCKET, Key=f"{run.RESULTS_PREFIX}Other/00/x.json", Body=b"{}")
+
+        out = tmp_path / "results.parquet"
+        monkeypatch.setattr(sys, "argv", ["run.py", "collect", str(out)])
+        run.collect()
+
+        table = pyarrow.parquet.read_table(out).sort_by("task")
+        assert table.num_rows == 2
+        rows = table.to_pylist()
+        assert rows[0]["group_well"] == "A01" and rows[1]["group_plate"] == "P1"
+        assert [row["result"] for row in rows] == ["SUCCESS", "FAILURE"]
+        assert [row["RunSeconds"] for row in rows] == [10.0, None]
+        assert [row["fileCount"] for row in rows] == [2, 0]
+        assert rows[0]["files"] == [{"key": "output/P1-A01/a.csv", "size": 10}, {"key": "output/P1-A01/b.csv", "size": 20}]
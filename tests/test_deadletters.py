@@ -0,0 +1,116 @@
+import json
+import sys
+
+import boto3
+from moto import mock_sqs, mock_ecs
+
+import run
+import config
+
+
+def dead_letters(groups):
+    # Put one dead letter per entry of groups (a list of groups is sent as a packed message)
+    sqs = boto3.client("sqs")
+    dead_url = run.get_queue_url(sqs, config.SQS_DEAD_LETTER_QUEUE)
+    for group in groups:
+        if isinstance(group, list):
+            body = run.encodeMessage({"favorite_color": "Blue", "groups": group}, "zlib")
+        else:
+            body = json.dumps({"favorite_color": "Blue", "group": group})
+        sqs.send_message(QueueUrl=dead_url, MessageBody=body)
+    return sqs, dead_url
+
+
+def queue_bodies(sqs, url):
+    bodies = []
+    while True:
+        response = sqs.receive_message(QueueUrl=url, MaxNumberOfMessages=10)
+        if len(response.get("Messages", [])) == 0:
+            return bodies
+        bodies += [run.decodeMessage(m["Body"]) for m in response["Messages"]]
+
+
+class TestDeadLetters:
+    @mock_sqs
+    @mock_ecs
+    def test_summary_releases_messages(self, run_setup, monkeypatch, capsys):
+        monkeypatch.setattr(run, "DLQ_WAIT_SECONDS", 0)
+        run_setup()
+        sqs, dead_url = dead_letters([{"plate": "P1", "well": "A01"}, {"plate": "P1", "well": "A02"}, [{"plate": "P2", "well": "A01"}]])
+
+        monkeypatch.setattr(sys, "argv", ["run.py", "deadletters", "summary"])
+        run.deadletters()
+
+        out = capsys.readouterr().out
+        assert "3 dead letters holding 3 groups" in out
+        assert "By plate (2 values):\n       2  P1\n       1  P2" in out
+        assert len(queue_bodies(sqs, dead_url)) == 3
+
+    @mock_sqs
+    @mock_ecs
+    def test_redrive_selected(self, run_setup, monkeypatch):
+        monkeypatch.setattr(run, "DLQ_WAIT_SECONDS", 0)
+        run_setup()
+        sqs, dead_url = dead_letters([{"plate": "P1", "well": "A01"}, {"plate": "P2", "well": "A01"}, [{"plate": "P2", "well": "B01"}, {"plate": "P1", "well": "B02"}]])
+
+        monkeypatch.setattr(sys, "argv", ["run.py", "deadletters", "redrive", "plate=P1"])
+        run.deadletters()
+
+        # Only the matching group of the packed letter is redriven; the rest stays dead
+        redriven = queue_bodies(sqs, run.JobQueue().queue.url)
+        assert sorted(json.dumps(run.messageGroups(m)) for m in redriven) == [
+            '[{"plate": "P1", "well": "A01"}]', '[{"plate": "P1", "well": "B02"}]']
+        assert all(m["favorite_color"] == "Blue" for m in redriven)
+        assert sorted(m["group"]["well"] for m in queue_bodies(sqs, dead_url)) == ["A01", "B01"]
+
+    @mock_sqs
+    @mock_ecs
+    def test_undecodable_letters_are_skipped(self, run_setup, monkeypatch, capsys):
+        monkeypatch.setattr(run, "DLQ_WAIT_SECONDS", 0)
+        run_setup()
+        sqs, dead_url = dead_letters([{"plate": "P1", "well": "A01"}])
+        sqs.send_message(QueueUrl=dead_url, MessageBody="DS1:zlib:bm90IHpsaWI=")
+        sqs.send_message(QueueUrl=dead_url, MessageBody="not json")
+
+        monkeypatch.setattr(sys, "argv", ["run.py", "deadletters", "redrive"])
+        run.deadletters()
+
+        assert "2 dead letters could not be decoded" in capsys.readouterr().out
+        assert [m["group"]["well"] for m in queue_bodies(sqs, run.JobQueue().queue.url)] == ["A01"]
+        # The undecodable ones are released, not held for DLQ_HOLD_SECONDS
+        bodies = sqs.receive_message(QueueUrl=dead_url, MaxNumberOfMessages=10)["Messages"]
+        assert sorted(m["Body"] for m in bodies) == ["DS1:zlib:bm90IHpsaWI=", "not json"]
+
+    @mock_sqs
+    @mock_ecs
+    def test_export_job_file(self, run_setup, monkeypatch, tmp_path):
+        monkeypatch.setattr(run, "DLQ_WAIT_SECONDS", 0)
+        run_setup()
+        sqs, dead_url = dead_letters([{"plate": "P1", "well": "A01"}, [{"plate": "P2", "well": "B01"}, {"plate": "P1", "well": "B02"}]])
+        job_file = tmp_path / "dead.json"
+
+        monkeypatch.setattr(sys, "argv", ["run.py", "deadletters", "export", str(job_file), "plate=P1"])
+        run.deadletters()
+
+        job = json.loads(job_file.read_text())
+        assert job["favorite_color"] == "Blue"
+        assert sorted(g["well"] for g in job["groups"]) == ["A01", "B02"]
+        assert len(queue_bodies(sqs, dead_url)) == 2
+
+    @mock_sqs
+    @mock_ecs
+    def test_export_keeps_each_template(self, run_setup, monkeypatch, tmp_path, capsys):
+        monkeypatch.setattr(run, "DLQ_WAIT_SECONDS", 0)
+        run_setup()
+        sqs, dead_url = dead_letters([{"plate": "P1", "well": "A01"}, [{"plate": "P1", "well": "B02"}]])
+        sqs.send_message(QueueUrl=dead_url, MessageBody=json.dumps({"favorite_color": "Red", "group": {"plate": "P1", "well": "C03"}}))
+        job_file = tmp_path / "dead.json"
+
+        monkeypatch.setattr(sys, "argv", ["run.py", "deadletters", "export", str(job_file)])
+        run.deadletters()
+
+        jobs = [json.loads(path.read_text()) for path in [job_file, tmp_path / "dead_2.json"]]
+        exported = sorted((job["favorite_color"], sorted(g["well"] for g in job["groups"])) for job in jobs)
+        assert exported == [("Blue", ["A01", "B02"]), ("Red", ["C03"])]
+        assert not (tmp_path / "dead_3.json").exists()
+        assert "dead_2.json" in capsys.readouterr().out
@@ -0,0 +1,86 @@
+import json
+
+import boto3
+from moto import mock_ecs, mock_sqs, mock_s3, mock_ec2, mock_logs
+
+import run
+import config
+from tests.conftest import MONITOR_FILE
+
+
+def fleet_scaler(monkeypatch, deadline=None, maximum=10):
+    monkeypatch.setattr(run, "SCALE_MAX_MACHINES", maximum)
+    monkeypatch.setattr(run, "TASKS_PER_MACHINE", 2)
+    monkeypatch.setattr(run, "DOCKER_CORES", 2)
+    monitorInfo = json.loads(MONITOR_FILE.read_text())
+    scaler = run.FleetScaler(monitorInfo["MONITOR_FLEET_ID"], config.ECS_CLUSTER, config.APP_NAME + "Service",
+                             boto3.client("ec2"), boto3.client("ecs"), deadline)
+    scaler.lastChange = 0
+    return scaler
+
+
+def fleet_size(scaler):
+    request = scaler.ec2.describe_spot_fleet_requests(SpotFleetRequestIds=[scaler.fleetId])["SpotFleetRequestConfigs"][0]
+    service = scaler.ecs.describe_services(cluster=scaler.cluster, services=[scaler.service])["services"][0]
+    return request["SpotFleetRequestConfig"]["TargetCapacity"], service["desiredCount"]
+
+
+class TestFleetScaler:
+    def test_desired(self, monkeypatch):
+        monkeypatch.setattr(run, "SCALE_MAX_MACHINES", 50)
+        monkeypatch.setattr(run, "TASKS_PER_MACHINE", 2)
+        monkeypatch.setattr(run, "DOCKER_CORES", 2)
+        scaler = run.FleetScaler("sfr", "default", "Service", None, None)
+        # Without a deadline, enough machines for every job left, within the bounds
+        assert scaler.desired(visible=30, inFlight=10, now=0) == 10
+        assert scaler.desired(visible=1000, inFlight=10, now=0) == 50
+        assert scaler.desired(visible=0, inFlight=0, now=0) == 1
+
+        # With one, just enough at the measured rate: 2 jobs/hour per machine, 40 jobs left, 5 hours to go
+        scaler.deadline = 5 * 3600
+        scaler.measure(0, 42, 1)
+        scaler.measure(3600, 40, 1)
+        assert abs(scaler.rate * 3600 - 2) < 1e-9
+        assert scaler.desired(visible=32, inFlight=8, now=0) == 4
+        # ...but never fewer than the jobs in process need
+        assert scaler.desired(visible=0, inFlight=40, now=0) == 10
+
+    @mock_ecs
+    @mock_sqs
+    @mock_s3
+    @mock_ec2
+    @mock_logs
+    def test_step_scales_both_ways(self, run_startCluster, monkeypatch):
+        run_startCluster()
+        scaler = fleet_scaler(monkeypatch)
+
+        assert scaler.step(visible=30, inFlight=4) == 9
+        assert fleet_size(scaler) == (9, 18)
+        # Cooling down after a resize
+        assert scaler.step(visible=100, inFlight=4) is None
+
+        # A small change is not worth making; a large one shrinks the fleet, but never the service, which
+        # would have ECS stop containers running the jobs in process
+        scaler.lastChange = 0
+        assert scaler.step(visible=26, inFlight=4) is None
+        assert scaler.step(visible=0, inFlight=12) == 3
+        assert fleet_size(scaler) == (3, 18)
+        scaler.lastChange = 0
+        assert scaler.step(visible=0, inFlight=1) == 1
+        assert fleet_size(scaler) == (1, 18)
+
+    @mock_ecs
+    @mock_sqs
+    @mock_s3
+    @mock_ec2
+    @mock_logs
+    def test_small_fleets_grow_a_machine_at_a_time(self, run_startCluster, monkeypatch):
+        run_startCluster()
+        scaler = fleet_scaler(monkeypatch)
+        scaler.ec2.modify_spot_fleet_request(SpotFleetRequestId=scaler.fleetId, TargetCapacity=1)
+
+        assert scaler.step(visible=6, inFlight=1) == 2
+        assert fleet_size(scaler) == (2, 4)
+        scaler.lastChange = 0
+        assert scaler.step(visible=10, inFlight=1) == 3
+        assert fleet_size(scaler) == (3, 6)
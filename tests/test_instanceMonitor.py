@@ -0,0 +1,46 @@
+from pathlib import Path
+
+import pytest
+
+WORKER_DIR = Path(__file__).parent.parent / "worker"
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def instance_monitor(monkeypatch):
+    monkeypatch.syspath_prepend(str(WORKER_DIR))
+    import instance_monitor
+    monkeypatch.setattr(instance_monitor, "readMeminfo", lambda: {"MemAvailable": 64 * 1024 * 1024})
+    return instance_monitor
+
+
+def write_cgroup(root, files):
+    for name, text in files.items():
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(text)
+
+
+class TestAvailableMemory:
+    def test_cgroup_v2_leaves_out_inactive_page_cache(self, instance_monitor, monkeypatch, tmp_path):
+        write_cgroup(tmp_path, {
+            "memory.max": "%d\n" % (1000 * MB),
+            "memory.current": "%d\n" % (900 * MB),
+            "memory.stat": "anon %d\nfile %d\ninactive_file %d\nactive_file %d\n" % (300 * MB, 600 * MB, 500 * MB, 100 * MB),
+        })
+        monkeypatch.setattr(instance_monitor, "CGROUP_ROOT", str(tmp_path))
+        assert instance_monitor.readCgroup()[:2] == (400 * MB, 1000 * MB)
+        assert instance_monitor.availableMemoryMB() == 600
+
+    def test_cgroup_v1(self, instance_monitor, monkeypatch, tmp_path):
+        write_cgroup(tmp_path, {
+            "memory/memory.limit_in_bytes": "%d\n" % (1000 * MB),
+            "memory/memory.usage_in_bytes": "%d\n" % (900 * MB),
+            "memory/memory.stat": "cache %d\ninactive_file 0\ntotal_inactive_file %d\n" % (600 * MB, 200 * MB),
+        })
+        monkeypatch.setattr(instance_monitor, "CGROUP_ROOT", str(tmp_path))
+        assert instance_monitor.availableMemoryMB() == 300
+
+    def test_without_a_limit_the_host_decides(self, instance_monitor, monkeypatch, tmp_path):
+        write_cgroup(tmp_path, {"memory.max": "max\n", "memory.current": "%d\n" % (900 * MB)})
+        monkeypatch.setattr(instance_monitor, "CGROUP_ROOT", str(tmp_path))
+        assert instance_monitor.availableMemoryMB() == 64 * 1024
@@ -0,0 +1,56 @@
+import threading
+import time
+
+import run
+
+
+class TestMonitorScheduler:
+    def test_tasks_run_independently(self, monkeypatch, capsys):
+        monkeypatch.setattr(run, "MONITOR_JITTER", 0)
+        scheduler = run.MonitorScheduler()
+        samples = []
+        release = threading.Event()
+        sweeps = []
+
+        def sweep():
+            sweeps.append(time.monotonic())
+            release.wait()
+
+        def sample():
+            samples.append(time.monotonic())
+            if len(samples) == 10:
+                scheduler.stop()
+
+        def fail():
+            raise RuntimeError("describe failed")
+
+        scheduler.add("queue", sample, 0.02)
+        scheduler.add("alarms", sweep, 0.05, timeout=0.05)
+        scheduler.add("fleet", fail, 0.05)
+        threading.Timer(0.6, release.set).start()
+        start = time.monotonic()
+        scheduler.run()
+
+        # A hung alarm sweep neither delays queue sampling nor gets started twice...
+        assert len(samples) == 10 and samples[-1] - start < 0.5
+        alarms = scheduler.tasks[1]
+        assert alarms["timeouts"] == 1 and alarms["skipped"] > 0 and len(sweeps) == 1
+        assert "alarms skipped: its previous run has not returned yet" in capsys.readouterr().out
+        # ...and is waited for before run() returns, so it can't race the monitor's cleanup
+        assert time.monotonic() - start >= 0.6 and alarms["runs"] == 1
+        fleet = scheduler.tasks[2]
+        assert fleet["runs"] == fleet["errors"] > 0
+
+    def test_one_shot_and_latency(self, monkeypatch, capsys):
+        monkeypatch.setattr(run, "MONITOR_JITTER", 0)
+        scheduler = run.MonitorScheduler()
+        calls = []
+        scheduler.add("cheapest", lambda: (time.sleep(0.05), calls.append("cheapest")), None, first=0.01)
+        scheduler.add("stop", scheduler.stop, None, first=0.2)
+        scheduler.run()
+        scheduler.report()
+
+        assert calls == ["cheapest"]
+        task = scheduler.tasks[0]
+        assert task["runs"] == 1 and 0.05 <= task["slowest"] < 0.2
+        assert "cheapest         1 runs" in capsys.readouterr().out
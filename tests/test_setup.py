@@ -238,3 +238,21 @@ class TestSetup:
                 service_created = True
 
         assert all([dead_letter_queue_created, queue_created, cluster_created, task_definition_registered, service_created])
+
+
+class TestQueueVisibility:
+    def test_heartbeat_caps_visibility(self, sqs, monkeypatch):
+        monkeypatch.setattr(run, "SQS_HEARTBEAT_BOOL", "True")
+        monkeypatch.setattr(run, "SQS_MESSAGE_VISIBILITY", 6*60*60)
+        run.get_or_create_queue(sqs)
+
+        queue_url = run.get_queue_url(sqs, config.SQS_QUEUE_NAME)
+        attributes = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=["VisibilityTimeout"])["Attributes"]
+
+        assert int(attributes["VisibilityTimeout"]) == run.HEARTBEAT_VISIBILITY
+
+    def test_without_heartbeat(self, monkeypatch):
+        monkeypatch.setattr(run, "SQS_HEARTBEAT_BOOL", "False")
+        monkeypatch.setattr(run, "SQS_MESSAGE_VISIBILITY", 6*60*60)
+
+        assert run.queue_visibility() == 6*60*60
@@ -1,7 +1,13 @@
 import json
+import sys
+import time
+import zlib
+from base64 import b64decode
 
 import boto3
-from moto import mock_sqs, mock_ecs
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_sqs, mock_ecs, mock_s3
 
 import run
 import config
@@ -57,3 +63,503 @@ class TestSubmitJob:
         # should have no more messages
         final_received_msg = queue.receive_messages(MaxNumberOfMessages=1)
         assert len(final_received_msg) == 0
+
+    @mock_sqs
+    @mock_ecs
+    def test_submit_clears_drained_mark(self, run_setup, run_submitJob):
+        run_setup()
+        queue = run.JobQueue()
+        queue.markDrained()
+        assert queue.client.list_queue_tags(QueueUrl=queue.queue.url)["Tags"] == {run.DRAINED_TAG: "true"}
+
+        run_submitJob()
+
+        assert run.DRAINED_TAG not in queue.client.list_queue_tags(QueueUrl=queue.queue.url).get("Tags", {})
+
+    @mock_sqs
+    @mock_ecs
+    def test_submit_without_untag_permission(self, run_setup, run_submitJob, monkeypatch, capsys):
+        def denied(self):
+            raise ClientError({"Error": {"Code": "AccessDenied", "Message": "not allowed"}}, "UntagQueue")
+
+        monkeypatch.setattr(run.JobQueue, "clearDrained", denied)
+        run_submitJob()
+
+        assert "could not clear the drained mark" in capsys.readouterr().out
+        attributes = run.JobQueue().queue.attributes
+        assert int(attributes["ApproximateNumberOfMessages"]) > 0
+
+
+class TestScheduleBatches:
+    @mock_sqs
+    @mock_ecs
+    def test_schedule_batches(self, run_setup):
+        run_setup()
+
+        job_queue = run.JobQueue()
+        messages = [([i], {"group": {"index": i}}) for i in range(25)]
+
+        sent, failed = job_queue.scheduleBatches(iter(messages))
+
+        assert sent == 25
+        assert failed == []
+
+        received = []
+        while True:
+            res = job_queue.queue.receive_messages(MaxNumberOfMessages=10)
+            if len(res) == 0:
+                break
+            received += [json.loads(m.body) for m in res]
+
+        assert sorted(m["group"]["index"] for m in received) == list(range(25))
+
+    def test_batch_entries_respect_limits(self):
+        messages = [("tag%d" % i, {"group": {"index": i}}) for i in range(25)]
+        batches = list(run.batchEntries(messages))
+
+        assert [len(b) for b, _ in batches] == [10, 10, 5]
+        assert [e["Id"] for b, _ in batches for e in b] == [str(i) for i in range(25)]
+        assert [tags[e["Id"]] for b, tags in batches for e in b] == ["tag%d" % i for i in range(25)]
+
+        big = [(None, {"group": {"blob": "x" * 100000}}) for _ in range(5)]
+        batches = list(run.batchEntries(big))
+
+        assert [len(b) for b, _ in batches] == [2, 2, 1]
+
+    @mock_sqs
+    @mock_ecs
+    def test_only_failed_entries_are_retried(self, run_setup, monkeypatch):
+        run_setup()
+
+        job_queue = run.JobQueue()
+        client = job_queue.client
+        real_send = client.send_message_batch
+        calls = []
+
+        def flaky_send(QueueUrl, Entries):
+            calls.append([e["Id"] for e in Entries])
+            if len(calls) == 1:
+                res = real_send(QueueUrl=QueueUrl, Entries=Entries[:5])
+                res["Failed"] = [{"Id": e["Id"], "SenderFault": False, "Code": "InternalError"} for e in Entries[5:]]
+                return res
+            return real_send(QueueUrl=QueueUrl, Entries=Entries)
+
+        monkeypatch.setattr(client, "send_message_batch", flaky_send)
+
+        sent, failed = job_queue.scheduleBatches(([i], {"group": {"index": i}}) for i in range(10))
+
+        assert sent == 10
+        assert failed == []
+        assert calls == [[str(i) for i in range(10)], [str(i) for i in range(5, 10)]]
+        assert run.JobQueue().returnLoad() == (10, 0)
+
+    @mock_sqs
+    @mock_ecs
+    def test_throttled_calls_shrink_the_window(self, run_setup, monkeypatch):
+        run_setup()
+
+        job_queue = run.JobQueue()
+        client = job_queue.client
+        real_send = client.send_message_batch
+        calls = []
+
+        def throttled_send(QueueUrl, Entries):
+            calls.append(len(Entries))
+            if len(calls) <= 2:
+                raise ClientError({"Error": {"Code": "RequestThrottled", "Message": "slow down"}}, "SendMessageBatch")
+            return real_send(QueueUrl=QueueUrl, Entries=Entries)
+
+        monkeypatch.setattr(client, "send_message_batch", throttled_send)
+
+        sent, failed = job_queue.scheduleBatches(([i], {"group": {"index": i}}) for i in range(10))
+
+        assert sent == 10
+        assert failed == []
+        assert calls == [10, 10, 10]
+        assert run.JobQueue().returnLoad() == (10, 0)
+
+    @mock_sqs
+    @mock_ecs
+    def test_sustained_throttling_slows_down_without_dropping(self, run_setup, monkeypatch):
+        run_setup()
+        monkeypatch.setattr(run, "SUBMIT_BACKOFF_MAX", 0.2)
+
+        job_queue = run.JobQueue()
+        client = job_queue.client
+        real_send = client.send_message_batch
+        throttledUntil = time.monotonic() + 3.5
+        calls = {"throttled": 0}
+
+        def throttled_send(QueueUrl, Entries):
+            # Every call is throttled for longer than SUBMIT_RETRIES attempts used to last
+            if time.monotonic() < throttledUntil:
+                calls["throttled"] += 1
+                raise ClientError({"Error": {"Code": "Throttling", "Message": "slow down"}}, "SendMessageBatch")
+            return real_send(QueueUrl=QueueUrl, Entries=Entries)
+
+        monkeypatch.setattr(client, "send_message_batch", throttled_send)
+
+        sent, failed = job_queue.scheduleBatches(([i], {"group": {"index": i}}) for i in range(30))
+
+        assert sent == 30
+        assert failed == []
+        assert calls["throttled"] > 3 * run.SUBMIT_RETRIES
+        assert run.JobQueue().returnLoad() == (30, 0)
+
+
+class TestAdaptiveWindow:
+    def test_additive_increase(self):
+        window = run.AdaptiveWindow(4, 1, 6)
+        for _ in range(4):
+            window.increase()
+
+        assert window.limit == 4
+        window.increase()
+        assert window.limit == 5
+
+        for _ in range(100):
+            window.increase()
+        assert window.limit == 6
+
+    def test_multiplicative_decrease(self):
+        window = run.AdaptiveWindow(16, 1, 64)
+
+        window.decrease(0)
+        assert window.limit == 8
+
+        # a second error within one call latency of the first is part of the same congestion event
+        window.decrease(60)
+        assert window.limit == 8
+
+        for _ in range(10):
+            window.decrease(0)
+        assert window.limit == 1
+
+
+class TestLoadJobStream:
+    job = {
+        "_comment0": "ignored",
+        "favorite_color": "Blue",
+        "groups": [
+            {"ice_cream": "chocolate", "pizza": "pepperoni", "count": 12345},
+            {"ice_cream": "cookie [dough]", "pizza": "mush\"room", "nested": [1, {"a": "}"}]},
+            {},
+        ],
+        "after_groups": 1234567,
+        "threshold": 0.5,
+    }
+
+    def test_matches_json_load(self, tmp_path, monkeypatch):
+        # tiny chunks force values to straddle buffer boundaries
+        monkeypatch.setattr(run, "JOB_READ_BYTES", 7)
+        job_file = tmp_path / "job.json"
+        job_file.write_text(json.dumps(self.job, indent=2))
+
+        template, groups = run.loadJobStream(str(job_file))
+
+        assert template == {"favorite_color": "Blue", "after_groups": 1234567, "threshold": 0.5}
+        assert list(groups) == self.job["groups"]
+
+    def test_example_job_file(self):
+        template, groups = run.loadJobStream(str(JOB_FILE))
+        job_info = json.loads(JOB_FILE.read_text())
+
+        assert template == {"favorite_color": "Blue"}
+        assert list(groups) == job_info["groups"]
+
+    def test_referenced_group_files(self, tmp_path):
+        (tmp_path / "groups.ndjson").write_text('{"plate": "P1", "well": "A01"}\n\n{"plate": "P1", "well": "A02"}\n')
+        (tmp_path / "groups.csv").write_text("plate,well\nP2,B01\nP2,B02\n")
+
+        for name, expected in [
+            ("groups.ndjson", [{"plate": "P1", "well": "A01"}, {"plate": "P1", "well": "A02"}]),
+            ("groups.csv", [{"plate": "P2", "well": "B01"}, {"plate": "P2", "well": "B02"}]),
+        ]:
+            job_file = tmp_path / "job.json"
+            job_file.write_text(json.dumps({"favorite_color": "Blue", "groups": name}))
+
+            template, groups = run.loadJobStream(str(job_file))
+            assert template == {"favorite_color": "Blue"}
+            assert list(groups) == expected
+
+            template, groups = run.loadJobStream(str(tmp_path / name))
+            assert template == {}
+            assert list(groups) == expected
+
+
+class TestPackMessages:
+    template = {"favorite_color": "Blue"}
+
+    def test_no_packing(self):
+        groups = [{"index": i} for i in range(3)]
+        messages = list(run.packMessages(self.template, enumerate(groups)))
+
+        assert messages == [([i], {"favorite_color": "Blue", "group": g}) for i, g in enumerate(groups)]
+
+    def test_pack_by_count(self):
+        groups = [{"index": i} for i in range(7)]
+        messages = list(run.packMessages(self.template, enumerate(groups), 3))
+
+        assert [m["groups"] for _, m in messages] == [groups[0:3], groups[3:6], groups[6:7]]
+        assert [indexes for indexes, _ in messages] == [[0, 1, 2], [3, 4, 5], [6]]
+        assert all(m["favorite_color"] == "Blue" and "group" not in m for _, m in messages)
+
+    def test_pack_by_size(self):
+        groups = [{"blob": "x" * 50000, "index": i} for i in range(12)]
+        messages = list(run.packMessages(self.template, enumerate(groups), 0))
+
+        assert [g for _, m in messages for g in m["groups"]] == groups
+        assert all(len(json.dumps(m).encode("utf-8")) <= run.SQS_MAX_MESSAGE_BYTES for _, m in messages)
+        assert [len(m["groups"]) for _, m in messages] == [5, 5, 2]
+
+    @mock_sqs
+    @mock_ecs
+    def test_submit_packed_job(self, run_submitJob, monkeypatch):
+        monkeypatch.setattr(run, "SQS_GROUPS_PER_MESSAGE", 0)
+        run_submitJob()
+
+        queue = run.JobQueue()
+        job_info = json.loads(JOB_FILE.read_text())
+
+        received_msg = queue.queue.receive_messages(MaxNumberOfMessages=10)
+        assert len(received_msg) == 1
+        assert json.loads(received_msg[0].body) == {"favorite_color": "Blue", "groups": job_info["groups"]}
+
+
+class TestEncodeMessage:
+    message = {"pipeline": "x" * 5000, "group": {"plate": "P1", "well": "A01"}}
+
+    def test_json_is_unchanged(self):
+        assert run.encodeMessage(self.message, "json") == json.dumps(self.message)
+
+    def test_zlib(self):
+        body = run.encodeMessage(self.message, "zlib")
+        version, codec, payload = body.split(":", 2)
+
+        assert (version, codec) == ("DS1", "zlib")
+        assert len(body) < len(json.dumps(self.message))
+        assert json.loads(zlib.decompress(b64decode(payload))) == self.message
+
+    def test_incompressible_stays_json(self):
+        small = {"group": {"a": 1}}
+
+        assert run.encodeMessage(small, "zlib") == json.dumps(small)
+
+    def test_msgpack(self):
+        msgpack = pytest.importorskip("msgpack")
+        body = run.encodeMessage(self.message, "msgpack")
+        version, codec, payload = body.split(":", 2)
+
+        assert (version, codec) == ("DS1", "msgpack")
+        assert msgpack.unpackb(b64decode(payload), raw=False) == self.message
+
+    def test_unknown_codec(self):
+        with pytest.raises(ValueError):
+            run.encodeMessage(self.message, "bzip")
+
+    @mock_sqs
+    @mock_ecs
+    def test_submit_compressed_job(self, run_setup, monkeypatch):
+        monkeypatch.setattr(run, "SQS_MESSAGE_CODEC", "zlib")
+        run_setup()
+
+        queue = run.JobQueue()
+        queue.scheduleBatches([([0], self.message)])
+
+        received_msg = queue.queue.receive_messages(MaxNumberOfMessages=1)
+        assert received_msg[0].body.startswith("DS1:zlib:")
+
+
+class TestTemplateInS3:
+    @mock_sqs
+    @mock_ecs
+    @mock_s3
+    def test_submit_with_shared_template(self, run_submitJob, monkeypatch, capsys):
+        monkeypatch.setattr(run, "TEMPLATE_IN_S3_BOOL", "True")
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=config.AWS_BUCKET)
+
+        run_submitJob()
+
+        queue = run.JobQueue()
+        job_info = json.loads(JOB_FILE.read_text())
+        received = [json.loads(m.body) for m in queue.queue.receive_messages(MaxNumberOfMessages=10)]
+
+        assert len(received) == len(job_info["groups"])
+        template_key = received[0][run.TEMPLATE_KEY]
+        assert template_key.startswith(run.TEMPLATE_PREFIX)
+        assert all(m.keys() == {run.TEMPLATE_KEY, "group"} and m[run.TEMPLATE_KEY] == template_key for m in received)
+        assert sorted(m["group"]["pizza"] for m in received) == sorted(g["pizza"] for g in job_info["groups"])
+
+        template = json.loads(s3.get_object(Bucket=config.AWS_BUCKET, Key=template_key)["Body"].read())
+        assert template == {"favorite_color": "Blue"}
+
+        # the same template is not uploaded twice
+        assert run.uploadTemplate({"favorite_color": "Blue"}, s3) == template_key
+        assert "already stored" in capsys.readouterr().out
+
+    @mock_s3
+    def test_template_head_errors_are_raised(self, monkeypatch):
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=config.AWS_BUCKET)
+
+        def forbidden(**kwargs):
+            raise ClientError({"Error": {"Code": "403", "Message": "Forbidden"}}, "HeadObject")
+
+        monkeypatch.setattr(s3, "head_object", forbidden)
+        with pytest.raises(ClientError, match="403"):
+            run.uploadTemplate({"favorite_color": "Blue"}, s3)
+        assert "Contents" not in s3.list_objects_v2(Bucket=config.AWS_BUCKET)
+
+
+class TestSubmissionJournal:
+    def test_bitmap_and_partial_lines(self, tmp_path):
+        path = tmp_path / "job.json.journal"
+        path.write_text("0\tid-0\n3\tid-3\n1000\tid-1000\n7\t")
+
+        journal = run.SubmissionJournal(str(path), resume=True)
+
+        assert journal.count == 3
+        assert [i for i in range(1001) if journal.wasSent(i)] == [0, 3, 1000]
+
+        journal.record([7, 8], "id-7")
+        journal.close()
+
+        assert path.read_text().splitlines()[-3:] == ["7\t", "7\tid-7", "8\tid-7"]
+        assert run.SubmissionJournal(str(path), resume=True).count == 5
+
+    def test_without_resume_starts_over(self, tmp_path):
+        path = tmp_path / "job.json.journal"
+        path.write_text("0\tid-0\n")
+
+        journal = run.SubmissionJournal(str(path))
+        journal.close()
+
+        assert journal.count == 0
+        assert path.read_text() == ""
+
+    @mock_sqs
+    @mock_ecs
+    def test_resume_skips_sent_groups(self, run_setup, monkeypatch, tmp_path):
+        job_file = tmp_path / "job.json"
+        job_file.write_text(json.dumps({"favorite_color": "Blue", "groups": [{"index": i} for i in range(5)]}))
+        (tmp_path / "job.json.journal").write_text(run.JOURNAL_HASH_PREFIX + run.filesHash([str(job_file)]) + "\n0\tid-0\n2\tid-2\n")
+
+        run_setup()
+        monkeypatch.setattr(sys, "argv", ["run.py", "submitJob", str(job_file), "--resume"])
+        run.submitJob()
+
+        queue = run.JobQueue()
+        received = [json.loads(m.body) for m in queue.queue.receive_messages(MaxNumberOfMessages=10)]
+
+        assert sorted(m["group"]["index"] for m in received) == [1, 3, 4]
+
+        journal = run.SubmissionJournal(str(tmp_path / "job.json.journal"), resume=True)
+        assert [i for i in range(5) if journal.wasSent(i)] == [0, 1, 2, 3, 4]
+
+
+    @mock_sqs
+    @mock_ecs
+    def test_resume_refuses_a_changed_job(self, run_setup, monkeypatch, tmp_path, capsys):
+        job_file = tmp_path / "job.json"
+        job_file.write_text(json.dumps({"groups": "groups.ndjson"}))
+        group_file = tmp_path / "groups.ndjson"
+        group_file.write_text("".join(json.dumps({"index": i}) + "\n" for i in range(3)))
+        run_setup()
+        monkeypatch.setattr(sys, "argv", ["run.py", "submitJob", str(job_file)])
+        run.submitJob()
+        journal = (tmp_path / "job.json.journal").read_text()
+        assert journal.startswith(run.JOURNAL_HASH_PREFIX + run.filesHash([str(job_file), str(group_file)]) + "\n")
+
+        # A group was inserted, so every index after it now names another group
+        group_file.write_text("".join(json.dumps({"index": i}) + "\n" for i in [0, 9, 1, 2]))
+        monkeypatch.setattr(sys, "argv", ["run.py", "submitJob", str(job_file), "--resume"])
+        with pytest.raises(SystemExit):
+            run.submitJob()
+        assert "without --resume" in capsys.readouterr().out
+        assert (tmp_path / "job.json.journal").read_text() == journal
+
+
+class TestSkipDone:
+    @mock_s3
+    def test_completed_index(self, monkeypatch):
+        monkeypatch.setattr(run, "OUTPUT_PREFIX_TEMPLATE", "{plate}")
+        monkeypatch.setattr(run, "EXPECTED_NUMBER_FILES", 2)
+        monkeypatch.setattr(run, "MIN_FILE_SIZE_BYTES", 2)
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=config.AWS_BUCKET)
+        objects = {
+            "a/" + run.COMPLETION_MANIFEST: b"{}",
+            "b/one.txt": b"ok",
+            "b/nested/two.txt": b"ok",
+            "c/one.txt": b"ok",
+            "c/tiny.txt": b"x",
+            "d/e/f/one.txt": b"ok",
+            "d/e/g/two.txt": b"ok",
+            "e/f/" + run.COMPLETION_MANIFEST: b"{}",
+        }
+        for key, body in objects.items():
+            s3.put_object(Bucket=config.AWS_BUCKET, Key=key, Body=body)
+
+        # Objects only count toward the output prefix they are under, not every folder above them
+        assert run.buildCompletedIndex(s3) == {"a", "b", "d"}
+
+        monkeypatch.setattr(run, "OUTPUT_PREFIX_TEMPLATE", "{plate}/{well}/")
+        assert run.buildCompletedIndex(s3) == {"d/e", "e/f"}
+
+        monkeypatch.setattr(run, "OUTPUT_PREFIX_TEMPLATE", "{plate}")
+        monkeypatch.setattr(run, "NECESSARY_STRING", "one")
+        assert run.buildCompletedIndex(s3) == {"a"}
+
+    @mock_s3
+    def test_index_lists_under_the_template_root(self, monkeypatch):
+        monkeypatch.setattr(run, "OUTPUT_PREFIX_TEMPLATE", "output/{plate}/{well}")
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=config.AWS_BUCKET)
+        for key in ["output/P1/A01/" + run.COMPLETION_MANIFEST, "output/P2/A01/" + run.COMPLETION_MANIFEST,
+                    "output/P3/A02/" + run.COMPLETION_MANIFEST, "raw/P1/A01/" + run.COMPLETION_MANIFEST,
+                    "results/x.json"]:
+            s3.put_object(Bucket=config.AWS_BUCKET, Key=key, Body=b"{}")
+        listed = []
+        indexPartition = run.indexPartition
+
+        def recordPartition(s3client, prefix, depth):
+            listed.append(prefix)
+            return indexPartition(s3client, prefix, depth)
+
+        monkeypatch.setattr(run, "indexPartition", recordPartition)
+        assert run.buildCompletedIndex(s3) == {"output/P1/A01", "output/P2/A01", "output/P3/A02"}
+        # One listing per plate, and nothing outside output/
+        assert sorted(listed) == ["output/P1/", "output/P2/", "output/P3/"]
+
+    @mock_sqs
+    @mock_ecs
+    @mock_s3
+    def test_submit_skips_completed_groups(self, run_setup, monkeypatch, tmp_path):
+        monkeypatch.setattr(run, "OUTPUT_PREFIX_TEMPLATE", "out/{a}")
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=config.AWS_BUCKET)
+        s3.put_object(Bucket=config.AWS_BUCKET, Key="out/1/" + run.COMPLETION_MANIFEST, Body=b"{}")
+        job_file = tmp_path / "job.json"
+        job_file.write_text(json.dumps({"favorite_color": "Blue", "groups": [{"a": 1}, {"b": 2}, {"a": 3, "b": 4}]}))
+
+        run_setup()
+        monkeypatch.setattr(sys, "argv", ["run.py", "submitJob", str(job_file), "--skip-done"])
+        run.submitJob()
+
+        queue = run.JobQueue()
+        received = [json.loads(m.body) for m in queue.queue.receive_messages(MaxNumberOfMessages=10)]
+        assert sorted(json.dumps(m["group"]) for m in received) == ['{"a": 3, "b": 4}', '{"b": 2}']
+
+        missing = json.loads((tmp_path / "job_missing.json").read_text())
+        assert missing == {"favorite_color": "Blue", "groups": [{"b": 2}, {"a": 3, "b": 4}]}
+
+    def test_skip_done_needs_a_prefix_template(self, monkeypatch, tmp_path, capsys):
+        monkeypatch.setattr(run, "OUTPUT_PREFIX_TEMPLATE", "")
+        job_file = tmp_path / "job.json"
+        job_file.write_text(json.dumps({"groups": [{"a": 1}]}))
+        monkeypatch.setattr(sys, "argv", ["run.py", "submitJob", str(job_file), "--skip-done"])
+
+        with pytest.raises(SystemExit):
+            run.submitJob()
+        assert "OUTPUT_PREFIX_TEMPLATE" in capsys.readouterr().out
@@ -0,0 +1,728 @@
+import base64
+import gzip
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_sqs, mock_s3, mock_logs
+
+import run
+
+WORKER_DIR = Path(__file__).parent.parent / "worker"
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    # generic-worker.py reads its settings from the environment when it is loaded
+    for name, value in {"SQS_QUEUE_URL": "", "AWS_BUCKET": "bucket", "LOG_GROUP_NAME": "group", "MY_NAME": "me",
+                        "SQS_PREFETCH_MESSAGES": "10", "CHECK_IF_DONE_BOOL": "False"}.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.syspath_prepend(str(WORKER_DIR))
+    spec = importlib.util.spec_from_file_location("generic_worker", WORKER_DIR / "generic-worker.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def metadata():
+    # Stub of the instance metadata service: a token for PUT /token, and a 404 from /notice until notice is set
+    notice = threading.Event()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_PUT(self):
+            self.reply(200, b"token")
+
+        def do_GET(self):
+            self.reply(200 if notice.is_set() else 404, b'{"action": "terminate"}')
+
+        def reply(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:%d" % server.server_port, notice
+    server.shutdown()
+
+
+def job_queue(worker, messages):
+    sqs = boto3.client("sqs")
+    url = sqs.create_queue(QueueName="WorkerQueue", Attributes={"VisibilityTimeout": "600"})["QueueUrl"]
+    for index in range(messages):
+        sqs.send_message(QueueUrl=url, MessageBody='{"group": {"well": "A%02d"}}' % index)
+    queue = worker.JobQueue(url)
+    queue.taskSeconds = 0.001   # prefetch as many as allowed
+    return sqs, url, queue
+
+
+def visible(sqs, url):
+    return len(sqs.receive_message(QueueUrl=url, MaxNumberOfMessages=10, WaitTimeSeconds=0).get("Messages", []))
+
+
+class TestSpotInterruption:
+    @mock_sqs
+    def test_notice_hands_back_held_messages(self, worker, metadata, monkeypatch):
+        base, notice = metadata
+        monkeypatch.setattr(worker, "SPOT_TOKEN_URL", base + "/token")
+        monkeypatch.setattr(worker, "SPOT_NOTICE_URL", base + "/notice")
+        monkeypatch.setattr(worker, "SPOT_CHECK_SECONDS", 0.05)
+        sqs, url, queue = job_queue(worker, 3)
+        data, handle = queue.readMessage()
+        assert data["group"]["well"] == "A00" and len(queue.buffer) == 2
+        assert visible(sqs, url) == 0
+
+        watcher = worker.SpotWatcher(queue)
+        time.sleep(0.2)
+        assert not worker.interrupted.is_set()
+        notice.set()
+        watcher.thread.join(5)
+
+        assert worker.interrupted.is_set() and queue.handedOff
+        assert queue.readMessage() == (None, None)
+        assert visible(sqs, url) == 3
+
+    @mock_sqs
+    def test_messages_received_during_hand_off_go_back(self, worker):
+        sqs, url, queue = job_queue(worker, 3)
+        receive = queue.client.receive_message
+
+        def receiveThenHandOff(**kwargs):
+            # The notice arrives while the long poll is waiting
+            response = receive(**kwargs)
+            queue.handOff()
+            return response
+
+        queue.client.receive_message = receiveThenHandOff
+        assert queue.readMessage() == (None, None)
+        assert len(queue.buffer) == 0 and len(queue.extendedAt) == 0
+        assert visible(sqs, url) == 3
+
+
+class FakeQueue:
+    # Hands out the given messages, then reports the queue empty
+    def __init__(self, messages):
+        self.messages = [(message, "handle-%d" % index) for index, message in enumerate(messages)]
+        self.deleted = []
+        self.returned = []
+
+    def nextMessage(self):
+        return self.messages.pop(0) if self.messages else (None, None)
+
+    def deleteMessage(self, handle):
+        self.deleted.append(handle)
+
+    def returnMessage(self, handle):
+        self.returned.append(handle)
+
+
+def failing_tasks(worker, monkeypatch, tmp_path, well):
+    # Run tasks in tmp_path with the stock program, except that computing the group with the given well raises.
+    # Returns the list of (well, result, local folder) of the result records written.
+    boto3.client("s3").create_bucket(Bucket="bucket")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(worker, "localIn", str(tmp_path / "input"))
+    monkeypatch.setattr(worker, "mountWarmed", True)
+    monkeypatch.setattr(worker, "OUTPUT_QUIET_SECONDS", 0)
+    records = []
+    monkeypatch.setattr(worker, "writeResultRecord", lambda task: records.append((task["group"]["well"], task["result"], task["localOut"])))
+    computeTask = worker.computeTask
+
+    def failingCompute(task):
+        if task["group"]["well"] == well:
+            raise RuntimeError("program crashed")
+        return computeTask(task)
+
+    monkeypatch.setattr(worker, "computeTask", failingCompute)
+    return records
+
+
+class TestPipeline:
+    @mock_s3
+    def test_tasks_keep_apart_and_failures_are_recorded(self, worker, monkeypatch, tmp_path):
+        records = failing_tasks(worker, monkeypatch, tmp_path, "A02")
+        queue = FakeQueue([{"group": {"plate": "P1", "well": well}} for well in ["A01", "A02", "A03"]])
+        worker.Pipeline(queue).run()
+
+        assert queue.deleted == ["handle-0", "handle-2"] and queue.returned == ["handle-1"]
+        assert [(well, result) for well, result, localOut in records] == [("A01", "SUCCESS"), ("A02", "PROBLEM"), ("A03", "SUCCESS")]
+        # Groups with the same keys still get a local folder each
+        assert len({localOut for well, result, localOut in records}) == 3
+
+
+class TestPacks:
+    @mock_s3
+    def test_pack_fails_as_a_whole_but_runs_every_group(self, worker, monkeypatch, tmp_path):
+        records = failing_tasks(worker, monkeypatch, tmp_path, "A02")
+        message = {"favorite": "blue", "groups": [{"plate": "P1", "well": well} for well in ["A01", "A02", "A03"]]}
+        assert worker.runPack(message) == "PROBLEM"
+        assert [(well, result) for well, result, localOut in records] == [("A01", "SUCCESS"), ("A02", "PROBLEM"), ("A03", "SUCCESS")]
+
+        records.clear()
+        message["groups"] = [{"plate": "P1", "well": well} for well in ["A01", "A03"]]
+        assert worker.runPack(message) == "SUCCESS"
+        assert [result for well, result, localOut in records] == ["SUCCESS", "SUCCESS"]
+
+
+class TestAlreadyDone:
+    @mock_s3
+    def test_counts_past_the_first_page(self, worker, monkeypatch):
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="bucket")
+        for index in range(1001):
+            s3.put_object(Bucket="bucket", Key="P1-A01/image%04d.tif" % index, Body=b"ok")
+        monkeypatch.setattr(worker, "EXPECTED_NUMBER_FILES", 1001)
+        assert worker.isAlreadyDone(s3, "P1-A01")
+        monkeypatch.setattr(worker, "EXPECTED_NUMBER_FILES", 1002)
+        assert not worker.isAlreadyDone(s3, "P1-A01")
+
+    @mock_s3
+    def test_necessary_string(self, worker, monkeypatch):
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="bucket")
+        s3.put_object(Bucket="bucket", Key="P1-A01/Cells.csv", Body=b"ok")
+        s3.put_object(Bucket="bucket", Key="P1-A01/Image.csv", Body=b"ok")
+        # The string is matched against names under the prefix, not the prefix itself
+        s3.put_object(Bucket="bucket", Key="P1-A01-Nuclei/other.csv", Body=b"ok")
+        monkeypatch.setattr(worker, "EXPECTED_NUMBER_FILES", 1)
+        monkeypatch.setattr(worker, "NECESSARY_STRING", "Cells")
+        assert worker.isAlreadyDone(s3, "P1-A01")
+        monkeypatch.setattr(worker, "NECESSARY_STRING", "Nuclei")
+        assert not worker.isAlreadyDone(s3, "P1-A01")
+        monkeypatch.setattr(worker, "NECESSARY_STRING", "A01")
+        assert not worker.isAlreadyDone(s3, "P1-A01")
+
+    @mock_s3
+    def test_manifest_skips_the_listing(self, worker, monkeypatch):
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="bucket")
+        s3.put_object(Bucket="bucket", Key="P1-A01/" + worker.COMPLETION_MANIFEST, Body=b"{}")
+        monkeypatch.setattr(worker, "EXPECTED_NUMBER_FILES", 5)
+
+        def noListing(name):
+            raise AssertionError("listed the prefix despite its manifest")
+
+        monkeypatch.setattr(s3, "get_paginator", noListing)
+        assert worker.isAlreadyDone(s3, "P1-A01")
+        assert not worker.isAlreadyDone(boto3.client("s3"), "P1-A02")
+
+
+def cache_bucket(objects):
+    s3 = boto3.client("s3")
+    s3.create_bucket(Bucket="bucket")
+    for key, size in objects.items():
+        s3.put_object(Bucket="bucket", Key=key, Body=key[0].encode() * size)
+    return s3
+
+
+def count_downloads(cache):
+    downloads = []
+    download_file = cache.s3client.download_file
+
+    def counted(bucket, key, path, **kwargs):
+        downloads.append(key)
+        time.sleep(0.2)     # long enough for another fetch of the same key to arrive meanwhile
+        return download_file(bucket, key, path, **kwargs)
+
+    cache.s3client.download_file = counted
+    return downloads
+
+
+class TestInputCache:
+    @mock_s3
+    def test_hit_after_the_first_fetch(self, worker, tmp_path):
+        cache_bucket({"illum.npy": 1000})
+        cache = worker.InputCache(str(tmp_path / "cache"), budgetMB=1)
+        downloads = count_downloads(cache)
+        assert not cache.fetch("illum.npy", str(tmp_path / "task1" / "illum.npy"))
+        assert cache.fetch("illum.npy", str(tmp_path / "task2" / "illum.npy"))
+        assert downloads == ["illum.npy"]
+        assert (tmp_path / "task2" / "illum.npy").read_bytes() == b"i" * 1000
+
+    @mock_s3
+    def test_concurrent_fills_download_once(self, worker, tmp_path):
+        cache_bucket({"illum.npy": 1000})
+        cache = worker.InputCache(str(tmp_path / "cache"), budgetMB=1)
+        downloads = count_downloads(cache)
+        hits = []
+        threads = [threading.Thread(target=lambda n=n: hits.append(cache.fetch("illum.npy", str(tmp_path / ("task%d" % n) / "illum.npy"))))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert downloads == ["illum.npy"] and sorted(hits) == [False, True, True, True]
+
+    @mock_s3
+    def test_evicts_least_recently_used_entries_not_in_use(self, worker, tmp_path):
+        kb = 1024
+        cache_bucket({"a": 500 * kb, "b": 500 * kb, "c": 500 * kb, "d": 20 * kb})
+        cache = worker.InputCache(str(tmp_path / "cache"), budgetMB=1)
+        downloads = count_downloads(cache)
+        cache.fetch("a", str(tmp_path / "task1" / "a"))
+        cache.fetch("b", str(tmp_path / "task1" / "b"))
+        age = time.time() - 100
+        os.utime(tmp_path / "task1" / "b", (age, age))
+        os.utime(tmp_path / "task1" / "a", (age + 10, age + 10))    # a was used last (entries share their links' times)
+
+        # Both entries are still linked into task1, so c goes over the budget rather than evicting them
+        cache.fetch("c", str(tmp_path / "task2" / "c"))
+        assert len([p for p in (tmp_path / "cache").iterdir() if len(p.name) == 64]) == 3
+
+        # Once the tasks are cleaned up, the least recently used entry (b) makes room for d
+        shutil.rmtree(tmp_path / "task1")
+        shutil.rmtree(tmp_path / "task2")
+        cache.fetch("d", str(tmp_path / "task3" / "d"))
+        for key in ["a", "c", "b"]:
+            cache.fetch(key, str(tmp_path / "task4" / key))
+        assert downloads == ["a", "b", "c", "d", "b"]
+
+    @mock_s3
+    def test_stale_partial_downloads_are_removed(self, worker, tmp_path):
+        cache_bucket({})
+        (tmp_path / "cache").mkdir()
+        stale = tmp_path / "cache" / ("ab" * 32 + ".part")
+        stale.write_bytes(b"half a file")
+        worker.InputCache(str(tmp_path / "cache"), budgetMB=1)
+        assert not stale.exists()
+
+
+def spy(client, name):
+    # Record the keyword arguments of every call to one of a client's methods
+    calls = []
+    method = getattr(client, name)
+
+    def recorded(**kwargs):
+        calls.append(kwargs)
+        return method(**kwargs)
+
+    setattr(client, name, recorded)
+    return calls
+
+
+def in_queue(sqs, url):
+    attributes = sqs.get_queue_attributes(QueueUrl=url, AttributeNames=["All"])["Attributes"]
+    return int(attributes["ApproximateNumberOfMessages"]) + int(attributes["ApproximateNumberOfMessagesNotVisible"])
+
+
+class TestPrefetchAndDelete:
+    @mock_sqs
+    def test_buffered_messages_are_served_without_receiving(self, worker):
+        sqs, url, queue = job_queue(worker, 4)
+        receives = spy(queue.client, "receive_message")
+        wells = [queue.readMessage()[0]["group"]["well"] for index in range(4)]
+        assert sorted(wells) == ["A00", "A01", "A02", "A03"]
+        assert len(receives) == 1 and receives[0]["MaxNumberOfMessages"] == 10
+        queue.close()
+
+    @mock_sqs
+    def test_stale_buffered_message_is_extended_or_dropped(self, worker, monkeypatch):
+        sqs, url, queue = job_queue(worker, 4)
+        queue.readMessage()
+        extends = spy(queue.client, "change_message_visibility")
+        # The next buffered message has waited longer than half its visibility timeout
+        body, handle = queue.buffer[0]
+        queue.extendedAt[handle] = time.time() - worker.SQS_MESSAGE_VISIBILITY
+        assert queue.readMessage()[1] == handle
+        assert [call["ReceiptHandle"] for call in extends] == [handle]
+
+        # If it can't be extended any more, it is already back in the queue and is skipped
+        body, handle = queue.buffer[0]
+        queue.extendedAt[handle] = time.time() - worker.SQS_MESSAGE_VISIBILITY
+
+        def lost(**kwargs):
+            raise ClientError({"Error": {"Code": "ReceiptHandleIsInvalid"}}, "ChangeMessageVisibility")
+
+        queue.client.change_message_visibility = lost
+        last = queue.buffer[1][1]
+        assert queue.readMessage()[1] == last
+        assert handle not in queue.extendedAt and len(queue.buffer) == 0
+        queue.close()
+
+    @mock_sqs
+    def test_deletes_are_batched_and_flushed_on_close(self, worker):
+        sqs, url, queue = job_queue(worker, 6)
+        deletes = spy(queue.client, "delete_message_batch")
+        singles = spy(queue.client, "delete_message")
+        handles = [queue.readMessage()[1] for index in range(3)]
+        for handle in handles:
+            queue.deleteMessage(handle)
+        queue.close()
+
+        deleted = [entry["ReceiptHandle"] for call in deletes for entry in call["Entries"]]
+        assert sorted(deleted) == sorted(handles) and len(deletes) == 1 and singles == []
+        # The three buffered messages were handed back, not deleted
+        assert in_queue(sqs, url) == 3 and visible(sqs, url) == 3
+
+
+class TestHeartbeat:
+    @mock_sqs
+    def test_running_message_stays_invisible_until_released(self, worker, monkeypatch):
+        monkeypatch.setattr(worker, "SQS_HEARTBEAT", "True")
+        monkeypatch.setattr(worker, "SQS_MESSAGE_VISIBILITY", 2)
+        sqs = boto3.client("sqs")
+        url = sqs.create_queue(QueueName="HeartbeatQueue", Attributes={"VisibilityTimeout": "2"})["QueueUrl"]
+        for index in range(2):
+            sqs.send_message(QueueUrl=url, MessageBody='{"group": {"well": "A%02d"}}' % index)
+        queue = worker.JobQueue(url)
+        queue.taskSeconds = 0.001
+        extends = spy(queue.client, "change_message_visibility_batch")
+        running = queue.readMessage()[1]
+        finished = queue.buffer[0][1]
+        queue.deleteMessage(queue.readMessage()[1])
+
+        # Well past the queue's 2 second timeout, the running message is still held
+        time.sleep(3.5)
+        assert visible(sqs, url) == 0
+        extended = [entry["ReceiptHandle"] for call in extends for entry in call["Entries"]]
+        assert running in extended and finished not in extended
+
+        # Once released (the task ended), it is no longer extended and reappears
+        queue.release(running)
+        del extends[:]
+        time.sleep(3)
+        assert [call for call in extends if call["Entries"]] == []
+        assert visible(sqs, url) == 1
+        queue.close()
+
+    @mock_sqs
+    def test_failed_extension_drops_the_handle(self, worker, monkeypatch):
+        monkeypatch.setattr(worker, "SQS_HEARTBEAT", "True")
+        monkeypatch.setattr(worker, "SQS_MESSAGE_VISIBILITY", 3)
+        sqs, url, queue = job_queue(worker, 2)
+        kept = queue.readMessage()[1]
+        lost = queue.buffer[0][1]
+
+        def partlyFailed(QueueUrl, Entries):
+            return {"Successful": [{"Id": entry["Id"]} for entry in Entries if entry["ReceiptHandle"] == kept],
+                    "Failed": [{"Id": entry["Id"], "Code": "ReceiptHandleIsInvalid", "SenderFault": True}
+                               for entry in Entries if entry["ReceiptHandle"] != kept]}
+
+        queue.client.change_message_visibility_batch = partlyFailed
+        time.sleep(1.5)
+        assert list(queue.extendedAt) == [kept]
+        queue.close()
+
+    @mock_sqs
+    def test_pipelined_workers_always_send_heartbeats(self, worker, monkeypatch):
+        monkeypatch.setattr(worker, "SQS_HEARTBEAT", "False")
+        sqs, url, queue = job_queue(worker, 0)
+        assert not hasattr(queue, "heartbeat")
+        queue.close()
+        monkeypatch.setattr(worker, "PIPELINE", "True")
+        queue = worker.JobQueue(url)
+        assert queue.heartbeat.is_alive()
+        queue.close()
+
+
+def log_events(logs, stream):
+    return [event["message"] for event in logs.get_log_events(logGroupName="group", logStreamName=stream, startFromHead=True)["events"]]
+
+
+class TestCloudWatchHandler:
+    def handler(self, worker, name):
+        logs = boto3.client("logs")
+        logs.create_log_group(logGroupName="group")
+        handler = worker.CloudWatchHandler("group")
+        logger = logging.getLogger(name)
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        return logs, handler, logger
+
+    @mock_logs
+    def test_batches_by_count_and_size_per_stream_and_flushes_on_close(self, worker, monkeypatch):
+        monkeypatch.setattr(worker, "LOG_BATCH_EVENTS", 5)
+        monkeypatch.setattr(worker, "LOG_BATCH_BYTES", 400)
+        logs, handler, logger = self.handler(worker, "test.batches")
+        calls = spy(handler.client, "put_log_events")
+        for index in range(23):
+            logging.LoggerAdapter(logger, {"logStream": "task-%d" % (index % 2)}).info("event %02d", index)
+        logger.info("x" * 200)   # goes to the logger's own stream
+        logger.info("y" * 200)
+        handler.close()
+        logger.removeHandler(handler)
+
+        assert log_events(logs, "task-0") == ["event %02d" % index for index in range(0, 23, 2)]
+        assert log_events(logs, "task-1") == ["event %02d" % index for index in range(1, 23, 2)]
+        assert log_events(logs, "test.batches") == ["x" * 200, "y" * 200]
+        batches = [(call["logStreamName"], len(call["logEvents"])) for call in calls]
+        # 12 and 11 events in batches of at most 5; the two long messages don't fit in one 400 byte batch
+        assert sorted(batches) == sorted([("task-0", 5), ("task-0", 5), ("task-0", 2), ("task-1", 5), ("task-1", 5),
+                                          ("task-1", 1), ("test.batches", 1), ("test.batches", 1)])
+
+    @mock_logs
+    def test_sends_after_the_flush_interval(self, worker, monkeypatch):
+        monkeypatch.setattr(worker, "LOG_FLUSH_SECONDS", 0.2)
+        logs, handler, logger = self.handler(worker, "test.interval")
+        logger.info("soon")
+        time.sleep(1)
+        assert log_events(logs, "test.interval") == ["soon"]
+        handler.close()
+        logger.removeHandler(handler)
+
+    @mock_logs
+    def test_counts_records_dropped_under_backpressure(self, worker, monkeypatch, capsys):
+        monkeypatch.setattr(worker, "LOG_BUFFER_RECORDS", 2)
+        monkeypatch.setattr(worker, "LOG_BLOCK_SECONDS", 0.01)
+        monkeypatch.setattr(worker, "LOG_FLUSH_SECONDS", 0)
+        logs, handler, logger = self.handler(worker, "test.dropped")
+        unblock = threading.Event()
+        put_log_events = handler.client.put_log_events
+
+        def slow(**kwargs):
+            unblock.wait()
+            return put_log_events(**kwargs)
+
+        handler.client.put_log_events = slow
+        logger.info("first")
+        time.sleep(0.2)         # the sender is now stuck sending it
+        for index in range(5):
+            logger.info("more %d", index)
+        unblock.set()
+        handler.close()
+        logger.removeHandler(handler)
+
+        assert handler.dropped == 3
+        assert log_events(logs, "test.dropped") == ["first", "more 0", "more 1"]
+        assert "Dropped 3 log records" in capsys.readouterr().out
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.records = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+        self.records.append(record)
+
+
+def output_logger(name):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = RecordingHandler()
+    logger.addHandler(handler)
+    return logger, handler
+
+
+class TestOutputCapture:
+    def run(self, worker, command, logFile=None):
+        process = subprocess.Popen([sys.executable, "-c", command], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        logger, handler = output_logger("test.output.%d" % process.pid)
+        tail = worker.monitorAndLog(process, logger, logFile)
+        return process, tail, handler.messages
+
+    def test_fast_output_is_rate_limited_but_kept_whole(self, worker, monkeypatch, tmp_path):
+        monkeypatch.setattr(worker, "OUTPUT_LOG_SECONDS", 0.2)
+        monkeypatch.setattr(worker, "OUTPUT_LOG_RATE", 5000)
+        monkeypatch.setattr(worker, "OUTPUT_TAIL_BYTES", 100)
+        lines = ["line %05d" % index for index in range(20000)]
+        command = "import sys, time\nfor i in range(20000):\n    print('line %05d' % i)\n    if i % 5000 == 4999: time.sleep(0.5)"
+        process, tail, messages = self.run(worker, command, str(tmp_path / "output.log.gz"))
+        output = "\n".join(lines) + "\n"
+
+        assert process.returncode == 0
+        assert tail == output[-100:]
+        assert gzip.open(tmp_path / "output.log.gz").read().decode() == output
+        notices = [message for message in messages if "bytes of output were not logged" in message]
+        logged = [message for message in messages if message not in notices]
+        assert len(notices) > 0
+        # What was logged is whole lines, in order, and within the allowance: a burst plus the rate over the run
+        assert all(message.endswith("\n") for message in logged)
+        loggedLines = "".join(logged).splitlines()
+        assert loggedLines == sorted(loggedLines) and set(loggedLines) <= set(lines)
+        assert len(loggedLines) < len(lines)
+        skipped = sum(int(notice.split()[0].strip("[")) for notice in notices)
+        assert skipped + len("".join(logged)) == len(output)
+
+    def test_program_without_output(self, worker, tmp_path):
+        process, tail, messages = self.run(worker, "import sys; sys.exit(3)", str(tmp_path / "output.log.gz"))
+        assert process.returncode == 3 and tail == "" and messages == []
+        assert gzip.open(tmp_path / "output.log.gz").read() == b""
+
+
+class TestUpload:
+    def outputs(self, tmp_path):
+        localOut = tmp_path / "out"
+        (localOut / "sub").mkdir(parents=True)
+        (localOut / "a.txt").write_bytes(b"alpha")
+        (localOut / "sub" / "b.txt").write_bytes(b"beta")
+        return localOut
+
+    @mock_s3
+    def test_verified_upload(self, worker, monkeypatch, tmp_path):
+        monkeypatch.setattr(worker, "OUTPUT_QUIET_SECONDS", 0)
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="bucket")
+        localOut = self.outputs(tmp_path)
+        uploaded = worker.uploadOutputs(str(localOut), "P1-A01", logging.getLogger("test.upload"))
+        assert uploaded == {"a.txt": (5, hashlib.sha256(b"alpha").hexdigest()), "sub/b.txt": (4, hashlib.sha256(b"beta").hexdigest())}
+        assert s3.get_object(Bucket="bucket", Key="P1-A01/sub/b.txt")["Body"].read() == b"beta"
+        assert not localOut.exists()
+
+    @mock_s3
+    def test_checksum_mismatch_is_retried_then_given_up(self, worker, monkeypatch, tmp_path):
+        monkeypatch.setattr(worker, "OUTPUT_QUIET_SECONDS", 0)
+        monkeypatch.setattr(worker.time, "sleep", lambda seconds: None)
+        boto3.client("s3").create_bucket(Bucket="bucket")
+        localOut = self.outputs(tmp_path)
+        s3 = boto3.client("s3")
+        uploads = []
+        upload_file = s3.upload_file
+        head_object = s3.head_object
+        corrupt = {"a.txt": worker.UPLOAD_RETRIES, "sub/b.txt": 1}
+
+        def counted_upload(path, bucket, key, **kwargs):
+            uploads.append(key)
+            return upload_file(path, bucket, key, **kwargs)
+
+        def bad_checksum(**kwargs):
+            head = head_object(**kwargs)
+            name = kwargs["Key"].split("/", 1)[1]
+            if corrupt[name] > 0:
+                corrupt[name] -= 1
+                head["ChecksumSHA256"] = base64.b64encode(hashlib.sha256(b"something else").digest()).decode()
+            return head
+
+        s3.upload_file = counted_upload
+        s3.head_object = bad_checksum
+        monkeypatch.setattr(worker.boto3, "client", lambda service, **kwargs: s3)
+        logger, handler = output_logger("test.upload.retry")
+        assert worker.uploadOutputs(str(localOut), "P1-A01", logger) is None
+
+        # b.txt went through on its second attempt; a.txt never matched
+        assert sorted(uploads) == ["P1-A01/a.txt"] * worker.UPLOAD_RETRIES + ["P1-A01/sub/b.txt"] * 2
+        assert len([m for m in handler.messages if "checksum mismatch" in m]) == worker.UPLOAD_RETRIES + 1
+        assert "Could not upload a.txt" in handler.messages
+        # The outputs stay put for the task's failure handling
+        assert (localOut / "a.txt").exists()
+
+
+class TestIdle:
+    def idle_queue(self, worker, monkeypatch):
+        monkeypatch.setattr(worker, "IDLE_SECONDS", 1)
+        monkeypatch.setattr(worker, "IDLE_BACKOFF_START", 0.1)
+        monkeypatch.setattr(worker, "IDLE_BACKOFF_MAX", 0.4)
+        sqs, url, queue = job_queue(worker, 0)
+        queue.client.receive_message = lambda **kwargs: {}    # an empty long poll, without the wait
+        waits = []
+        sleep = time.sleep
+
+        def recorded(seconds):
+            waits.append(seconds)
+            sleep(seconds)
+
+        monkeypatch.setattr(worker.time, "sleep", recorded)
+        return sqs, url, queue, waits
+
+    @mock_sqs
+    def test_polls_with_growing_waits_then_gives_up(self, worker, monkeypatch):
+        sqs, url, queue, waits = self.idle_queue(worker, monkeypatch)
+        started = time.time()
+        assert queue.nextMessage() == (None, None)
+        assert 1 <= time.time() - started < 2
+        assert waits[:3] == [0.1, 0.2, 0.4] and max(waits) == 0.4
+        assert queue.lastRead is None
+        queue.close()
+
+    @mock_sqs
+    def test_drained_queue_ends_at_once(self, worker, monkeypatch):
+        sqs, url, queue, waits = self.idle_queue(worker, monkeypatch)
+        sqs.tag_queue(QueueUrl=url, Tags={worker.DRAINED_TAG: "true"})
+        assert queue.nextMessage() == (None, None)
+        assert waits == []
+        queue.close()
+
+
+class TestTaskMetrics:
+    def test_record_is_valid_embedded_metric_format(self, worker, monkeypatch, tmp_path):
+        monkeypatch.setattr(worker, "METRICS_FILE", str(tmp_path / "metrics.jsonl"))
+        logger, handler = output_logger(worker.__name__ + ".metrics")
+        task = {"metadataID": "plate-well", "result": "SUCCESS", "exitCode": 0, "outputBytes": 1234,
+                "timings": {"Receive": 0.5, "Fetch": 1.25, "Compute": 10.0, "Upload": 2.0, "Ack": 0.01}}
+        worker.emitTaskMetrics(task)
+        worker.emitTaskMetrics(dict(task, result="PROBLEM", exitCode=None, timings={"Compute": 1.0}))
+        logger.removeHandler(handler)
+
+        lines = (tmp_path / "metrics.jsonl").read_text().splitlines()
+        assert lines == handler.messages
+        assert [record.logStream for record in handler.records] == [worker.METRICS_STREAM] * 2
+        for line in lines:
+            record = json.loads(line)
+            directive = record["_aws"]
+            assert isinstance(directive["Timestamp"], int)
+            for metrics in directive["CloudWatchMetrics"]:
+                assert metrics["Namespace"] == worker.METRICS_NAMESPACE
+                for dimensions in metrics["Dimensions"]:
+                    assert all(isinstance(record[name], str) for name in dimensions)
+                for metric in metrics["Metrics"]:
+                    assert isinstance(record[metric["Name"]], (int, float))
+        first = json.loads(lines[0])
+        assert first["ComputeSeconds"] == 10.0 and first["Task"] == "plate-well" and first["OutputBytes"] == 1234
+        assert sorted(m["Name"] for m in first["_aws"]["CloudWatchMetrics"][0]["Metrics"]) == \
+            ["AckSeconds", "ComputeSeconds", "FetchSeconds", "OutputBytes", "ReceiveSeconds", "UploadSeconds"]
+
+
+JOB = {"pipeline": "analysis.cppipe", "output": "out", "input": "in", "data_file": "load_data.csv",
+       "group": {"Metadata_Plate": "Plate1", "Metadata_Well": "A01", "Metadata_Site": "1"},
+       "input_files": ["illum/Plate1_IllumDNA.npy"] * 20}
+
+
+class TestMessageCodecs:
+    @pytest.mark.parametrize("codec", ["json", "zlib", "msgpack"])
+    def test_round_trip(self, worker, codec):
+        if codec == "msgpack":
+            pytest.importorskip("msgpack")
+        body = run.encodeMessage(JOB, codec)
+        if codec != "json":
+            assert body.startswith("DS1:" + codec + ":")
+        assert worker.decodeMessage(body) == JOB
+
+    def test_plain_json_and_unknown_codecs(self, worker):
+        assert worker.decodeMessage(json.dumps(JOB)) == JOB
+        with pytest.raises(ValueError):
+            worker.decodeMessage("DS1:brotli:AAAA")
+
+    def test_msgpack_needs_the_package(self, worker, monkeypatch):
+        monkeypatch.setattr(worker, "msgpack", None)
+        with pytest.raises(ImportError):
+            worker.decodeMessage("DS1:msgpack:gA==")
+
+
+class TestJobTemplates:
+    @mock_s3
+    def test_expanded_from_s3_once_per_template(self, worker, monkeypatch):
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="bucket")
+        monkeypatch.setattr(run, "AWS_BUCKET", "bucket")
+        template = {key: value for key, value in JOB.items() if key != "group"}
+        key = run.uploadTemplate(template, s3)
+        fetches = spy(s3, "get_object")
+        monkeypatch.setattr(worker.boto3, "client", lambda service, **kwargs: s3)
+
+        for well in ["A01", "A02"]:
+            message = worker.expandTemplate(worker.decodeMessage(json.dumps({"_template": key, "group": {"Metadata_Well": well}})))
+            assert message == dict(template, group={"Metadata_Well": well})
+        assert [call["Key"] for call in fetches] == [key]
+        # Messages without a template reference are left as they are
+        assert worker.expandTemplate(JOB) is JOB
@@ -0,0 +1,111 @@
+import importlib.util
+import time
+from pathlib import Path
+
+import pytest
+
+WORKER_DIR = Path(__file__).parent.parent / "worker"
+
+
+@pytest.fixture
+def supervisor(monkeypatch):
+    for name, value in {"DOCKER_CORES": "3", "TASK_MEMORY_MB": "500", "TASK_DISK_MB": "1000"}.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.syspath_prepend(str(WORKER_DIR))
+    spec = importlib.util.spec_from_file_location("worker_supervisor", WORKER_DIR / "worker-supervisor.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeProcess:
+    def __init__(self, returncode=None):
+        self.returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+
+def resources(monkeypatch, supervisor, memory, disk):
+    monkeypatch.setattr(supervisor, "availableMemoryMB", lambda: memory)
+    monkeypatch.setattr(supervisor, "availableDiskMB", lambda path: disk)
+
+
+class TestAdmit:
+    def test_first_worker_is_always_admitted(self, supervisor, monkeypatch):
+        resources(monkeypatch, supervisor, 0, 0)
+        assert supervisor.Supervisor().admit()
+
+    def test_needs_memory_and_disk_for_one_more_task(self, supervisor, monkeypatch):
+        workers = supervisor.Supervisor()
+        workers.workers[0] = (FakeProcess(), time.time() - 2 * supervisor.WARMUP_SECONDS)
+        resources(monkeypatch, supervisor, 500, 1000)
+        assert workers.admit()
+        resources(monkeypatch, supervisor, 499, 1000)
+        assert not workers.admit()
+        resources(monkeypatch, supervisor, 500, 999)
+        assert not workers.admit()
+
+    def test_warming_workers_count_against_free_resources(self, supervisor, monkeypatch):
+        workers = supervisor.Supervisor()
+        workers.workers[0] = (FakeProcess(), time.time())
+        resources(monkeypatch, supervisor, 999, 2000)
+        assert not workers.admit()
+        resources(monkeypatch, supervisor, 1000, 1999)
+        assert not workers.admit()
+        resources(monkeypatch, supervisor, 1000, 2000)
+        assert workers.admit()
+
+
+class TestReap:
+    def test_clean_exit_means_drained(self, supervisor):
+        workers = supervisor.Supervisor()
+        workers.workers = {0: (FakeProcess(0), time.time()), 1: (FakeProcess(), time.time())}
+        workers.reap()
+        assert workers.drained and list(workers.workers) == [1]
+        assert workers.nextStart == 0
+
+    def test_quick_crashes_back_off(self, supervisor):
+        workers = supervisor.Supervisor()
+        delays = []
+        for attempt in range(8):
+            workers.workers[0] = (FakeProcess(1), time.time())
+            workers.reap()
+            delays.append(workers.restartDelay)
+        assert not workers.drained and workers.workers == {}
+        assert delays[:3] == [2 * supervisor.CHECK_SECONDS, 4 * supervisor.CHECK_SECONDS, 8 * supervisor.CHECK_SECONDS]
+        assert delays[-1] == supervisor.MAX_RESTART_DELAY
+        assert workers.nextStart == pytest.approx(time.time() + supervisor.MAX_RESTART_DELAY, abs=5)
+
+        # A worker that ran for a while before crashing is replaced promptly again
+        workers.workers[0] = (FakeProcess(1), time.time() - 2 * supervisor.WARMUP_SECONDS)
+        workers.reap()
+        assert workers.restartDelay == supervisor.CHECK_SECONDS
+
+    def test_no_replacement_while_stopping(self, supervisor):
+        workers = supervisor.Supervisor()
+        workers.stopping = True
+        workers.workers[0] = (FakeProcess(-15), time.time())
+        workers.reap()
+        assert workers.workers == {} and workers.nextStart == 0
+
+
+class TestRun:
+    def test_fills_slots_that_fit_then_stops_when_drained(self, supervisor, monkeypatch):
+        monkeypatch.setattr(supervisor, "CHECK_SECONDS", 0)
+        resources(monkeypatch, supervisor, 1200, 10000)
+        workers = supervisor.Supervisor()
+        started = []
+
+        def start(slot):
+            started.append(slot)
+            workers.workers[slot] = (FakeProcess(), time.time() - 2 * supervisor.WARMUP_SECONDS)
+            if len(started) == 2:
+                # the memory is now taken; the first worker then finds the queue empty
+                resources(monkeypatch, supervisor, 200, 10000)
+                workers.workers[0][0].returncode = 0
+                workers.workers[1][0].returncode = 0
+
+        monkeypatch.setattr(workers, "start", start)
+        workers.run()
+        assert started == [0, 1] and workers.drained and workers.workers == {}
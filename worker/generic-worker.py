@@ -1,15 +1,38 @@
 from __future__ import print_function
+import base64
 import boto3
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
 import glob
+import gzip
+import hashlib
+import itertools
 import json
 import logging
 import os
 import re
+import select
+import shutil
+import signal
 import subprocess
 import sys
+import threading
 import time
-import watchtower
 import string
+import urllib.error
+import urllib.request
+import zlib
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from queue import Queue, Empty, Full
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 #################################
 # CONSTANT PATHS IN THE CONTAINER
@@ -44,10 +67,335 @@ if 'DOWNLOAD_FILES' not in os.environ:
     DOWNLOAD_FILES = False
 else:
     DOWNLOAD_FILES = os.environ['DOWNLOAD_FILES']
+if 'INPUT_CACHE_MB' not in os.environ:
+    INPUT_CACHE_MB = 0
+else:
+    INPUT_CACHE_MB = int(os.environ['INPUT_CACHE_MB'])
+if 'PIPELINE' not in os.environ:
+    PIPELINE = 'False'
+else:
+    PIPELINE = os.environ['PIPELINE']
+if 'SAVE_OUTPUT' not in os.environ:
+    SAVE_OUTPUT = 'False'
+else:
+    SAVE_OUTPUT = os.environ['SAVE_OUTPUT']
+if 'IDLE_SECONDS' not in os.environ:
+    IDLE_SECONDS = 0
+else:
+    IDLE_SECONDS = int(os.environ['IDLE_SECONDS'])
+if 'SPOT_NOTICE_URL' not in os.environ:
+    SPOT_NOTICE_URL = 'http://169.254.169.254/latest/meta-data/spot/instance-action'
+else:
+    SPOT_NOTICE_URL = os.environ['SPOT_NOTICE_URL']
+if 'SPOT_TOKEN_URL' not in os.environ:
+    SPOT_TOKEN_URL = 'http://169.254.169.254/latest/api/token'
+else:
+    SPOT_TOKEN_URL = os.environ['SPOT_TOKEN_URL']
+if 'METRICS_FILE' not in os.environ:
+    METRICS_FILE = ''
+else:
+    METRICS_FILE = os.environ['METRICS_FILE']
+if 'SQS_MESSAGE_VISIBILITY' not in os.environ:
+    SQS_MESSAGE_VISIBILITY = 60
+else:
+    SQS_MESSAGE_VISIBILITY = int(os.environ['SQS_MESSAGE_VISIBILITY'])
+if 'SQS_HEARTBEAT' not in os.environ:
+    SQS_HEARTBEAT = 'False'
+else:
+    SQS_HEARTBEAT = os.environ['SQS_HEARTBEAT']
+if 'SQS_PREFETCH_MESSAGES' not in os.environ:
+    SQS_PREFETCH_MESSAGES = 1
+else:
+    SQS_PREFETCH_MESSAGES = max(1, min(10, int(os.environ['SQS_PREFETCH_MESSAGES'])))
+if 'APP_NAME' not in os.environ:
+    APP_NAME = 'DistributedSomething'
+else:
+    APP_NAME = os.environ['APP_NAME']
 MY_NAME = os.environ['MY_NAME']
 
 localIn = '/home/ubuntu/local_input'
 
+MESSAGE_CODEC_VERSION = 'DS1'
+TEMPLATE_KEY = '_template'
+TEMPLATE_CACHE_SIZE = 8
+DRAINED_TAG = 'ds:drained'  # Set on the queue by the monitor once the job is done
+IDLE_BACKOFF_START = 5      # While the queue is empty, wait this long between polls at first,
+IDLE_BACKOFF_MAX = 2*60     # doubling up to this
+
+UPLOAD_THREADS = 8          # Files uploaded at once
+UPLOAD_RETRIES = 3          # Attempts per file
+OUTPUT_QUIET_SECONDS = 2    # Outputs must stop changing for this long before they are uploaded...
+OUTPUT_SETTLE_SECONDS = 30  # ...but we wait no longer than this
+COMPLETION_MANIFEST = '_DS_COMPLETE.json'   # Written last under a task's output prefix once all its outputs are uploaded
+RESULTS_PREFIX = 'results/'     # Per-task result records go under results/<APP_NAME>/, for run.py collect
+INPUT_CACHE_DIR = os.path.join(localIn, 'cache')
+INPUT_CACHE_FRACTION = 0.25 # Share of the local volume the input cache may use when INPUT_CACHE_MB is 0
+LOG_BUFFER_RECORDS = 10000  # Log records held in memory before logging blocks the task (backpressure)...
+LOG_BLOCK_SECONDS = 30      # ...for at most this long; records that still don't fit are counted and dropped
+LOG_FLUSH_SECONDS = 5       # Longest a record waits before it is sent to CloudWatch
+LOG_BATCH_EVENTS = 10000    # PutLogEvents limits: events per call,
+LOG_BATCH_BYTES = 1048576   # bytes per call (each event counts 26 bytes on top of its message),
+LOG_EVENT_BYTES = 262118    # and bytes per event
+LOG_RETRIES = 5
+OUTPUT_LOG_SECONDS = 5      # A running program's output is logged in chunks at least this often...
+OUTPUT_LOG_BYTES = 65536    # ...or whenever this much has built up,
+OUTPUT_LOG_RATE = 32768     # sending at most this many bytes a second on average; the console gets everything
+OUTPUT_TAIL_BYTES = 16384   # Last part of the output kept for error reports
+OUTPUT_LOG_NAME = 'output.log.gz'   # With SAVE_OUTPUT, the full output is saved under this name with the results
+SPOT_CHECK_SECONDS = 5      # How often to look for a spot interruption notice
+SPOT_STOP_SECONDS = 10      # After a notice, running programs get this long to exit (e.g. checkpoint) after SIGTERM
+SPOT_TOKEN_SECONDS = 6*60*60    # Lifetime requested for instance metadata (IMDSv2) tokens
+METRICS_NAMESPACE = 'DistributedSomething'  # CloudWatch namespace of the per-task metrics
+METRICS_STREAM = 'taskMetrics'  # Log stream (in LOG_GROUP_NAME) the per-task metric records are written to
+PIPELINE_DEPTH = 1          # With PIPELINE, tasks that may wait prepared for the CPU, and finished ones that may wait for upload
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=64*1024*1024, multipart_chunksize=64*1024*1024, max_concurrency=4)
+
+
+#################################
+# CLASS TO CACHE DOWNLOADED INPUTS
+#################################
+
+class InputCache():
+    # Inputs downloaded from AWS_BUCKET, stored under INPUT_CACHE_DIR by a hash of their ETag and size, so
+    # the same bytes are only fetched once per container however many jobs (and workers) use them.
+    # Workers coordinate through flock: one lock per hash prefix while an entry is fetched, and one for
+    # eviction. Least recently used entries are evicted to stay within the size budget; entries still
+    # linked into a running job's folder are left alone, as removing them would free nothing.
+
+    def __init__(self, root=INPUT_CACHE_DIR, budgetMB=INPUT_CACHE_MB):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        if budgetMB > 0:
+            self.budget = budgetMB * 1024 * 1024
+        else:
+            stats = os.statvfs(root)
+            self.budget = int(stats.f_blocks * stats.f_frsize * INPUT_CACHE_FRACTION)
+        self.s3client = boto3.client('s3')
+        self.sweep()
+
+    def sweep(self):
+        # Remove partial downloads left by a worker that died mid-fetch. A fetch holds its prefix lock
+        # until its .part file is gone, so any .part found while holding that lock is stale.
+        for name in os.listdir(self.root):
+            if name.endswith('.part'):
+                with self.locked(name[:2]):
+                    try:
+                        os.remove(os.path.join(self.root, name))
+                    except FileNotFoundError:
+                        pass
+
+    def locked(self, name):
+        lockfile = open(os.path.join(self.root, '.lock-'+name), 'a')
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        return lockfile  # closing it releases the lock
+
+    def fetch(self, key, dest):
+        # Put the object at key into dest (a hard link to the cache entry, so evicting the entry doesn't
+        # pull the file out from under a running job). Returns True on a cache hit.
+        head = self.s3client.head_object(Bucket=AWS_BUCKET, Key=key)
+        digest = hashlib.sha256((head['ETag']+':'+str(head['ContentLength'])).encode()).hexdigest()
+        path = os.path.join(self.root, digest)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with self.locked(digest[:2]):
+            try:
+                self.link(path, dest)
+                os.utime(path)  # mark as recently used
+                return True
+            except FileNotFoundError:
+                pass
+            self.makeRoom(head['ContentLength'])
+            partial = path+'.part'
+            self.s3client.download_file(AWS_BUCKET, key, partial, Config=TRANSFER_CONFIG)
+            if os.path.getsize(partial) != head['ContentLength']:
+                os.remove(partial)
+                raise IOError(key+' changed while it was being downloaded')
+            os.replace(partial, path)
+            self.link(path, dest)
+            return False
+
+    def link(self, path, dest):
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            os.link(path, dest)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            shutil.copyfile(path, dest)
+
+    def makeRoom(self, incoming):
+        with self.locked('evict'):
+            entries = []
+            for name in os.listdir(self.root):
+                if len(name) != 64:
+                    continue
+                try:
+                    stats = os.stat(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stats.st_mtime, stats.st_size, stats.st_nlink, name))
+            used = sum([size for mtime, size, links, name in entries])
+            entries.sort()
+            for mtime, size, links, name in entries:
+                if used + incoming <= self.budget:
+                    break
+                if links > 1:
+                    continue    # still linked into a job's folder
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    pass
+                used -= size
+
+#################################
+# CLASS TO WATCH FOR SPOT INTERRUPTIONS
+#################################
+
+class SpotWatcher():
+    # Polls the instance metadata for a spot interruption notice (SPOT_NOTICE_URL answers 200 once the
+    # instance is scheduled to be reclaimed, 404 before). On a notice the worker stops taking work, its
+    # held messages are handed back and running programs are stopped. Point SPOT_NOTICE_URL at a local
+    # stub to try this out, or set it to '' to turn the watcher off.
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.token = None
+        self.tokenExpires = 0
+        self.thread = threading.Thread(target=self.watchLoop, daemon=True)
+        self.thread.start()
+
+    def headers(self):
+        # IMDSv2 needs a session token; without one (IMDSv1, or a stub) the request is sent without it
+        if time.time() > self.tokenExpires:
+            self.token = None
+            try:
+                request = urllib.request.Request(SPOT_TOKEN_URL, method='PUT', headers={'X-aws-ec2-metadata-token-ttl-seconds': str(SPOT_TOKEN_SECONDS)})
+                with urllib.request.urlopen(request, timeout=2) as response:
+                    self.token = response.read().decode()
+            except Exception:
+                pass
+            self.tokenExpires = time.time() + (SPOT_TOKEN_SECONDS / 2 if self.token else 60)
+        return {'X-aws-ec2-metadata-token': self.token} if self.token else {}
+
+    def noticed(self):
+        try:
+            with urllib.request.urlopen(urllib.request.Request(SPOT_NOTICE_URL, headers=self.headers()), timeout=2) as response:
+                return response.status == 200
+        except urllib.error.HTTPError as e:
+            if e.code == 401:
+                self.tokenExpires = 0
+            return False
+        except Exception:
+            return False
+
+    def watchLoop(self):
+        while not interrupted.is_set():
+            if self.noticed():
+                print('Spot interruption notice received; handing off held messages')
+                interrupted.set()
+                self.queue.handOff()
+                stopPrograms()
+                return
+            time.sleep(SPOT_CHECK_SECONDS)
+
+#################################
+# CLASS TO SEND LOGS TO CLOUDWATCH
+#################################
+
+class CloudWatchHandler(logging.Handler):
+    # One handler per worker process, shared by every task (plus one for metric records). Records go to the log stream named by their
+    # logStream attribute (set through a LoggerAdapter), or by their logger's name. A single thread sends
+    # them with PutLogEvents, one call per stream per LOG_FLUSH_SECONDS or whenever a batch is full.
+
+    def __init__(self, logGroup, emf=False):
+        logging.Handler.__init__(self)
+        self.logGroup = logGroup
+        self.client = boto3.client('logs')
+        if emf:
+            # Records are Embedded Metric Format JSON; CloudWatch turns them into metrics
+            self.client.meta.events.register('before-sign.cloudwatch-logs.PutLogEvents', self.markEmf)
+        self.records = Queue(maxsize=LOG_BUFFER_RECORDS)
+        self.streams = set()
+        self.dropped = 0
+        self.sender = threading.Thread(target=self.sendLoop, daemon=True)
+        self.sender.start()
+
+    def markEmf(self, request, **kwargs):
+        request.headers['x-amzn-logs-format'] = 'json/emf'
+
+    def emit(self, record):
+        try:
+            message = self.format(record)
+            if len(message.encode()) > LOG_EVENT_BYTES:
+                message = message.encode()[:LOG_EVENT_BYTES].decode(errors='ignore')
+            stream = str(getattr(record, 'logStream', record.name))
+            self.records.put((stream, int(record.created * 1000), message), timeout=LOG_BLOCK_SECONDS)
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        # Returns once everything logged so far has been sent
+        if self.sender.is_alive():
+            flushed = threading.Event()
+            self.records.put(flushed)
+            flushed.wait()
+
+    def close(self):
+        if self.sender.is_alive():
+            self.records.put(None)
+            self.sender.join()
+        if self.dropped > 0:
+            print('Dropped', self.dropped, 'log records while CloudWatch was not keeping up')
+        logging.Handler.close(self)
+
+    def sendLoop(self):
+        pending = {}    # stream -> [events, bytes]
+        deadline = time.time() + LOG_FLUSH_SECONDS
+        while True:
+            try:
+                item = self.records.get(timeout=max(0, deadline - time.time()))
+            except Empty:
+                item = False
+            if isinstance(item, tuple):
+                stream, timestamp, message = item
+                batch = pending.setdefault(stream, [[], 0])
+                size = len(message.encode()) + 26
+                if len(batch[0]) >= LOG_BATCH_EVENTS or batch[1] + size > LOG_BATCH_BYTES:
+                    self.send(stream, batch[0])
+                    batch[0], batch[1] = [], 0
+                batch[0].append({'timestamp': timestamp, 'message': message})
+                batch[1] += size
+                if time.time() < deadline:
+                    continue
+            for stream in pending.keys():
+                self.send(stream, pending[stream][0])
+            pending = {}
+            deadline = time.time() + LOG_FLUSH_SECONDS
+            if item is None:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+
+    def send(self, stream, events):
+        events.sort(key=lambda event: event['timestamp'])
+        for attempt in range(LOG_RETRIES):
+            try:
+                if stream not in self.streams:
+                    try:
+                        self.client.create_log_stream(logGroupName=self.logGroup, logStreamName=stream)
+                    except ClientError as e:
+                        if e.response['Error']['Code'] != 'ResourceAlreadyExistsException':
+                            raise
+                    self.streams.add(stream)
+                self.client.put_log_events(logGroupName=self.logGroup, logStreamName=stream, logEvents=events)
+                return
+            except Exception as e:
+                if attempt == LOG_RETRIES - 1:
+                    print('Could not send', len(events), 'log records to CloudWatch:', e)
+                else:
+                    time.sleep(2 ** attempt)
 
 #################################
 # CLASS TO HANDLE THE SQS QUEUE
@@ -58,56 +406,543 @@ class JobQueue():
     def __init__(self, queueURL):
         self.client = boto3.client('sqs')
         self.queueURL = queueURL
+        # Received but not yet started messages, as (body, handle)
+        self.buffer = collections.deque()
+        # Every message this worker holds (buffered or running): handle -> time its visibility was last set
+        self.extendedAt = {}
+        self.lock = threading.Lock()
+        self.taskSeconds = None
+        self.lastRead = None
+        self.deletes = Queue()
+        self.deleter = threading.Thread(target=self.deleteLoop, daemon=True)
+        self.deleter.start()
+        self.stopping = threading.Event()
+        self.handedOff = False
+        # A pipelined worker also holds messages that wait, prepared or finished, outside any task's run
+        # time, which a visibility timeout sized to one job doesn't cover; it always sends heartbeats
+        if SQS_HEARTBEAT.upper() == 'TRUE' or PIPELINE.upper() == 'TRUE':
+            self.heartbeat = threading.Thread(target=self.heartbeatLoop, daemon=True)
+            self.heartbeat.start()
+
+    def prefetchCount(self):
+        # Only buffer as many messages as this worker can expect to start within half a visibility timeout,
+        # so long tasks don't hoard messages other workers could be running
+        if self.taskSeconds is None:
+            return 1
+        return max(1, min(SQS_PREFETCH_MESSAGES, int(SQS_MESSAGE_VISIBILITY / (2 * max(self.taskSeconds, 0.001)))))
 
     def readMessage(self):
-        response = self.client.receive_message(QueueUrl=self.queueURL, WaitTimeSeconds=20)
+        if self.handedOff:
+            return None, None
+        now = time.time()
+        if self.lastRead is not None:
+            elapsed = now - self.lastRead
+            self.taskSeconds = elapsed if self.taskSeconds is None else 0.8 * self.taskSeconds + 0.2 * elapsed
+        self.lastRead = now
+
+        while True:
+            with self.lock:
+                if len(self.buffer) == 0:
+                    break
+                body, handle = self.buffer.popleft()
+            if self.keepAlive(handle):
+                return expandTemplate(decodeMessage(body)), handle
+
+        response = self.client.receive_message(QueueUrl=self.queueURL, WaitTimeSeconds=20, MaxNumberOfMessages=self.prefetchCount())
         if 'Messages' in response.keys():
-            data = json.loads(response['Messages'][0]['Body'])
+            receivedAt = time.time()
+            with self.lock:
+                handedOff = self.handedOff
+                if not handedOff:
+                    for eachmessage in response['Messages']:
+                        self.extendedAt[eachmessage['ReceiptHandle']] = receivedAt
+                    for eachmessage in response['Messages'][1:]:
+                        self.buffer.append((eachmessage['Body'], eachmessage['ReceiptHandle']))
+            if handedOff:
+                # handOff() ran while this receive was waiting; these go straight back as well
+                self.makeVisible([eachmessage['ReceiptHandle'] for eachmessage in response['Messages']])
+                return None, None
+            data = expandTemplate(decodeMessage(response['Messages'][0]['Body']))
             handle = response['Messages'][0]['ReceiptHandle']
             return data, handle
         else:
             return None, None
 
+    def keepAlive(self, handle):
+        # A buffered message that has sat for more than half its visibility timeout is extended before
+        # it is started; if that fails it has already gone back to the queue and is dropped here
+        with self.lock:
+            extendedAt = self.extendedAt.get(handle, 0)
+        if time.time() - extendedAt < SQS_MESSAGE_VISIBILITY / 2:
+            return True
+        try:
+            self.client.change_message_visibility(QueueUrl=self.queueURL, ReceiptHandle=handle, VisibilityTimeout=SQS_MESSAGE_VISIBILITY)
+            with self.lock:
+                self.extendedAt[handle] = time.time()
+            return True
+        except Exception as e:
+            print('Dropping a buffered message that could not be extended:', e)
+            self.release(handle)
+            return False
+
+    def release(self, handle):
+        # Stop extending a message's visibility (it was deleted, returned or lost)
+        with self.lock:
+            self.extendedAt.pop(handle, None)
+
+    def heartbeatLoop(self):
+        # While a message is held, keep pushing its visibility out by SQS_MESSAGE_VISIBILITY every third
+        # of that time. The queue can then use a short visibility timeout: a job that runs long is never
+        # handed to a second machine, and a job on a machine that dies reappears within minutes.
+        interval = max(1, SQS_MESSAGE_VISIBILITY / 3)
+        while not self.stopping.wait(interval):
+            with self.lock:
+                handles = list(self.extendedAt.keys())
+            for start in range(0, len(handles), 10):
+                chunk = handles[start:start+10]
+                entries = [{'Id': str(index), 'ReceiptHandle': handle, 'VisibilityTimeout': SQS_MESSAGE_VISIBILITY} for index, handle in enumerate(chunk)]
+                try:
+                    response = self.client.change_message_visibility_batch(QueueUrl=self.queueURL, Entries=entries)
+                except Exception as e:
+                    print('Heartbeat failed, will retry:', e)
+                    continue
+                extendedAt = time.time()
+                failed = {int(f['Id']) for f in response.get('Failed', [])}
+                with self.lock:
+                    for index, handle in enumerate(chunk):
+                        if handle not in self.extendedAt:
+                            continue
+                        if index in failed:
+                            print('Lost the visibility of a held message; another worker may pick it up')
+                            self.extendedAt.pop(handle)
+                        else:
+                            self.extendedAt[handle] = extendedAt
+
     def deleteMessage(self, handle):
-        self.client.delete_message(QueueUrl=self.queueURL, ReceiptHandle=handle)
+        # Acknowledged in the background by deleteLoop
+        self.release(handle)
+        self.deletes.put(handle)
         return
 
+    def deleteLoop(self):
+        # Collect handles for up to a second (or 10 handles) and delete them with one DeleteMessageBatch call
+        stopping = False
+        while not stopping:
+            handles = []
+            deadline = None
+            while len(handles) < 10:
+                try:
+                    timeout = None if deadline is None else max(0, deadline - time.time())
+                    handle = self.deletes.get(timeout=timeout)
+                except Empty:
+                    break
+                if handle is None:
+                    stopping = True
+                    break
+                handles.append(handle)
+                if deadline is None:
+                    deadline = time.time() + 1
+            if len(handles) > 0:
+                self.deleteBatch(handles)
+
+    def deleteBatch(self, handles):
+        entries = [{'Id': str(index), 'ReceiptHandle': handle} for index, handle in enumerate(handles)]
+        try:
+            response = self.client.delete_message_batch(QueueUrl=self.queueURL, Entries=entries)
+            failed = response.get('Failed', [])
+        except Exception as e:
+            print('Batch delete failed, deleting one by one:', e)
+            failed = [{'Id': entry['Id']} for entry in entries]
+        for eachfailure in failed:
+            try:
+                self.client.delete_message(QueueUrl=self.queueURL, ReceiptHandle=handles[int(eachfailure['Id'])])
+            except Exception as e:
+                print('Could not delete message:', e)
+
     def returnMessage(self, handle):
+        self.release(handle)
+        if self.handedOff:
+            return  # already visible again
         self.client.change_message_visibility(QueueUrl=self.queueURL, ReceiptHandle=handle, VisibilityTimeout=60)
         return
 
+    def handOff(self):
+        # Stop taking messages and make every message this worker holds, buffered or running, visible
+        # again right away, so other workers pick them up within seconds instead of after a timeout
+        self.stopping.set()
+        with self.lock:
+            self.handedOff = True
+            handles = list(self.extendedAt.keys())
+            self.extendedAt.clear()
+            self.buffer.clear()
+        self.makeVisible(handles)
+        print('Handed off', len(handles), 'held messages')
+
+    def makeVisible(self, handles):
+        for start in range(0, len(handles), 10):
+            entries = [{'Id': str(index), 'ReceiptHandle': handle, 'VisibilityTimeout': 0} for index, handle in enumerate(handles[start:start+10])]
+            try:
+                self.client.change_message_visibility_batch(QueueUrl=self.queueURL, Entries=entries)
+            except Exception as e:
+                print('Could not hand off held messages:', e)
+
+    def isDrained(self):
+        try:
+            tags = self.client.list_queue_tags(QueueUrl=self.queueURL).get('Tags', {})
+        except Exception as e:
+            print('Could not read the queue tags:', e)
+            return False
+        return tags.get(DRAINED_TAG) == 'true'
+
+    def nextMessage(self):
+        # Like readMessage, but an empty queue is polled again, with growing waits in between, for up to
+        # IDLE_SECONDS before giving up, so workers stay up between waves of a job. Gives up at once if
+        # the monitor has marked the queue drained.
+        idleSince = None
+        delay = IDLE_BACKOFF_START
+        while True:
+            data, handle = self.readMessage()
+            if data is not None:
+                return data, handle
+            self.lastRead = None    # idle time is not task time
+            if idleSince is None:
+                idleSince = time.time()
+            remaining = IDLE_SECONDS - (time.time() - idleSince)
+            if remaining <= 0 or self.handedOff or self.isDrained():
+                return None, None
+            wait = min(delay, remaining)
+            print('No messages in the queue; polling again in', round(wait), 'seconds')
+            time.sleep(wait)
+            delay = min(IDLE_BACKOFF_MAX, delay * 2)
+
+    def close(self):
+        # Hand buffered messages straight back to other workers and wait for pending deletes
+        self.stopping.set()
+        while len(self.buffer) > 0:
+            body, handle = self.buffer.popleft()
+            self.release(handle)
+            try:
+                self.client.change_message_visibility(QueueUrl=self.queueURL, ReceiptHandle=handle, VisibilityTimeout=0)
+            except Exception as e:
+                print('Could not release a buffered message:', e)
+        self.deletes.put(None)
+        self.deleter.join()
+
 #################################
 # AUXILIARY FUNCTIONS
 #################################
 
+def decodeMessage(body):
+    # Bodies are either plain JSON or 'DS1:<codec>:<base64 payload>' as written by run.py encodeMessage
+    if not body.startswith(MESSAGE_CODEC_VERSION+':'):
+        return json.loads(body)
+    _, codec, payload = body.split(':', 2)
+    payload = base64.b64decode(payload)
+    if codec == 'zlib':
+        return json.loads(zlib.decompress(payload).decode('utf-8'))
+    elif codec == 'msgpack':
+        if msgpack is None:
+            raise ImportError('Message was encoded with msgpack, but msgpack is not installed in this container')
+        return msgpack.unpackb(payload, raw=False)
+    else:
+        raise ValueError('Unknown message codec '+codec)
 
-def monitorAndLog(process,logger):
-    while True:
-        output= process.stdout.readline().decode()
-        if output== '' and process.poll() is not None:
-            break
-        if output:
-            print(output.strip())
-            logger.info(output)
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def loadTemplate(key):
+    # Shared job templates are immutable (named by content hash), so each is fetched once per process
+    s3client = boto3.client('s3')
+    body = s3client.get_object(Bucket=AWS_BUCKET, Key=key)['Body'].read()
+    return json.loads(body.decode('utf-8'))
+
+def expandTemplate(data):
+    # Messages submitted with TEMPLATE_IN_S3_BOOL only carry the group(s) and a reference to the template
+    if TEMPLATE_KEY not in data:
+        return data
+    message = dict(loadTemplate(data[TEMPLATE_KEY]))
+    message.update({eachkey:data[eachkey] for eachkey in data.keys() if eachkey != TEMPLATE_KEY})
+    return message
+
+def monitorAndLog(process,logger,logFile=None):
+    # Read the output in large chunks as it becomes available, rather than line by line, so a chatty
+    # program is never held up by this loop. Everything goes to the console (and to logFile, gzipped, if
+    # given); the logger gets whole lines in aggregated records, rate limited so CloudWatch isn't flooded.
+    # Returns the last OUTPUT_TAIL_BYTES of output.
+    fd = process.stdout.fileno()
+    archive = gzip.open(logFile, 'wb') if logFile else None
+    tail = bytearray()
+    pending = bytearray()
+    allowance = OUTPUT_LOG_RATE * OUTPUT_LOG_SECONDS
+    skipped = 0
+    lastLog = time.time()
+    finished = False
+    while not finished:
+        ready = select.select([fd], [], [], OUTPUT_LOG_SECONDS)[0]
+        if ready:
+            chunk = os.read(fd, 1024*1024)
+            finished = len(chunk) == 0
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            if archive:
+                archive.write(chunk)
+            tail += chunk
+            del tail[:-OUTPUT_TAIL_BYTES]
+            pending += chunk
+        now = time.time()
+        if finished or len(pending) >= OUTPUT_LOG_BYTES or now - lastLog >= OUTPUT_LOG_SECONDS:
+            allowance = min(OUTPUT_LOG_RATE * OUTPUT_LOG_SECONDS, allowance + (now - lastLog) * OUTPUT_LOG_RATE)
+            lastLog = now
+            cut = len(pending) if finished else pending.rfind(b'\n') + 1
+            if cut == 0 and len(pending) >= OUTPUT_LOG_BYTES:
+                cut = len(pending)  # one very long line
+            if cut > 0:
+                if cut <= allowance:
+                    if skipped > 0:
+                        logger.info('['+str(skipped)+' bytes of output were not logged here to stay under the rate limit]')
+                        skipped = 0
+                    logger.info(pending[:cut].decode(errors='replace'))
+                    allowance -= cut
+                else:
+                    skipped += cut
+                del pending[:cut]
+    if skipped > 0:
+        logger.info('['+str(skipped)+' bytes of output were not logged here to stay under the rate limit]')
+    if archive:
+        archive.close()
+    process.wait()
+    return tail.decode(errors='replace')
 
 def printandlog(text,logger):
     print(text)
     logger.info(text)
 
-#################################
-# RUN SOME PROCESS
-#################################
+@contextlib.contextmanager
+def timed(timings, phase):
+    # Add the time spent in the block to timings[phase], in seconds
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0) + time.time() - start
 
-def runSomething(message):
+def emitTaskMetrics(task):
+    # One Embedded Metric Format record per task: CloudWatch extracts a metric per phase duration
+    # (with percentiles) from it, and the same line goes to METRICS_FILE if one is set
+    record = {'AppName': APP_NAME, 'Task': task['metadataID'], 'Result': task['result'],
+              'ExitCode': task.get('exitCode'), 'OutputBytes': task.get('outputBytes', 0)}
+    metrics = [{'Name': 'OutputBytes', 'Unit': 'Bytes'}]
+    for phase in task['timings'].keys():
+        record[phase+'Seconds'] = round(task['timings'][phase], 3)
+        metrics.append({'Name': phase+'Seconds', 'Unit': 'Seconds'})
+    record['_aws'] = {'Timestamp': int(time.time() * 1000),
+                      'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE, 'Dimensions': [['AppName']], 'Metrics': metrics}]}
+    line = json.dumps(record)
+    logging.getLogger(__name__+'.metrics').info(line, extra={'logStream': METRICS_STREAM})
+    if METRICS_FILE:
+        with open(METRICS_FILE, 'a') as metricsFile:
+            metricsFile.write(line+'\n')
+
+def isAlreadyDone(s3client, remoteOut):
+    # A task that committed successfully left a completion manifest, so one HEAD settles it.
+    # Otherwise (e.g. outputs from before manifests existed) count the objects under the prefix.
+    try:
+        s3client.head_object(Bucket=AWS_BUCKET, Key=remoteOut+'/'+COMPLETION_MANIFEST)
+        return True
+    except ClientError:
+        pass
+    count = 0
+    paginator = s3client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=AWS_BUCKET, Prefix=remoteOut+'/'):
+        for eachobject in page.get('Contents', []):
+            name = eachobject['Key'][len(remoteOut)+1:]
+            if name == COMPLETION_MANIFEST or eachobject['Size'] < MIN_FILE_SIZE_BYTES:
+                continue
+            if NECESSARY_STRING and NECESSARY_STRING not in name:
+                continue
+            count += 1
+            if count >= int(EXPECTED_NUMBER_FILES):
+                return True
+    return False
+
+def writeCompletionManifest(remoteOut, group, uploaded, logger):
+    # Record what this task produced, as the last object written under its output prefix
+    manifest = {
+        'group': group,
+        'completed': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'files': [{'name': name, 'size': uploaded[name][0], 'sha256': uploaded[name][1]} for name in sorted(uploaded.keys())],
+    }
+    try:
+        s3client = boto3.client('s3')
+        s3client.put_object(Bucket=AWS_BUCKET, Key=remoteOut+'/'+COMPLETION_MANIFEST, Body=json.dumps(manifest).encode('utf-8'), ContentType='application/json')
+    except Exception as e:
+        # the outputs are safely uploaded; without a manifest the done check just falls back to listing
+        printandlog('Could not write completion manifest: '+str(e), logger)
+
+def writeResultRecord(task):
+    # One small record per task that ran, whatever its result, under a prefix run.py collect reads in
+    # parallel: results/<APP_NAME>/<2 hex digits>/<hash of the output prefix>.json. A rerun replaces it.
+    digest = hashlib.sha256(task['remoteOut'].encode('utf-8')).hexdigest()
+    files = task.get('files', {})
+    record = {
+        'task': task['metadataID'],
+        'group': task['group'],
+        'outputPrefix': task['remoteOut'],
+        'result': task['result'],
+        'exitCode': task.get('exitCode'),
+        'completed': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'durations': {phase: round(task['timings'][phase], 3) for phase in task['timings'].keys()},
+        'outputBytes': task.get('outputBytes', 0),
+        'files': [{'key': task['remoteOut']+'/'+name, 'size': files[name][0]} for name in sorted(files.keys())],
+    }
+    try:
+        s3client = boto3.client('s3')
+        s3client.put_object(Bucket=AWS_BUCKET, Key=RESULTS_PREFIX+APP_NAME+'/'+digest[:2]+'/'+digest+'.json',
+                            Body=json.dumps(record).encode('utf-8'), ContentType='application/json')
+    except Exception as e:
+        printandlog('Could not write result record: '+str(e), task['logger'])
+
+def snapshotOutputs(localOut):
+    snapshot = {}
+    for root, dirs, files in os.walk(localOut):
+        for eachfile in files:
+            path = os.path.join(root, eachfile)
+            try:
+                stats = os.stat(path)
+            except OSError: # removed while we were looking
+                continue
+            snapshot[path] = (stats.st_size, stats.st_mtime_ns)
+    return snapshot
+
+def waitForOutputs(localOut):
+    # Return the output files once nothing in localOut has changed for OUTPUT_QUIET_SECONDS
+    # (or after OUTPUT_SETTLE_SECONDS), rather than always sleeping
+    start = time.time()
+    snapshot = snapshotOutputs(localOut)
+    quietSince = time.time()
+    while time.time() - quietSince < OUTPUT_QUIET_SECONDS and time.time() - start < OUTPUT_SETTLE_SECONDS:
+        time.sleep(0.5)
+        current = snapshotOutputs(localOut)
+        if current != snapshot:
+            snapshot = current
+            quietSince = time.time()
+    return snapshot
+
+def fileSha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            digest.update(chunk)
+    return digest
+
+def uploadFile(s3client, path, key, logger):
+    # Upload one file, letting S3 verify a SHA256 checksum (per part for multipart uploads), then check
+    # the stored object. Returns the file's size and hex SHA256, or None if every attempt failed.
+    digest = fileSha256(path)
+    size = os.path.getsize(path)
+    for attempt in range(UPLOAD_RETRIES):
+        try:
+            s3client.upload_file(path, AWS_BUCKET, key, ExtraArgs={'ChecksumAlgorithm': 'SHA256'}, Config=TRANSFER_CONFIG)
+            head = s3client.head_object(Bucket=AWS_BUCKET, Key=key, ChecksumMode='ENABLED')
+            if head['ContentLength'] != size:
+                raise ValueError('size mismatch, local '+str(size)+' remote '+str(head['ContentLength']))
+            remoteChecksum = head.get('ChecksumSHA256', '')
+            # multipart objects carry a checksum of the part checksums, of the form '<checksum>-<parts>'
+            if remoteChecksum and '-' not in remoteChecksum and remoteChecksum != base64.b64encode(digest.digest()).decode('ascii'):
+                raise ValueError('checksum mismatch')
+            return size, digest.hexdigest()
+        except Exception as e:
+            printandlog('Upload attempt #'+str(attempt+1)+' of '+path+' failed: '+str(e), logger)
+            time.sleep(2 ** attempt)
+    return None
+
+def uploadOutputs(localOut, remoteOut, logger):
+    # Move everything under localOut to s3://AWS_BUCKET/remoteOut in parallel.
+    # Returns {relative name: (size, sha256)} for the uploaded files, or None if any file failed.
+    files = sorted(waitForOutputs(localOut).keys())
+    s3client = boto3.client('s3')
+    uploaded = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+        futures = {}
+        for path in files:
+            name = os.path.relpath(path, localOut).replace(os.sep, '/')
+            futures[executor.submit(uploadFile, s3client, path, remoteOut+'/'+name, logger)] = name
+        for future in concurrent.futures.as_completed(futures):
+            uploaded[futures[future]] = future.result()
+    failed = [name for name in uploaded.keys() if uploaded[name] is None]
+    if len(failed) > 0:
+        printandlog('Could not upload '+', '.join(failed), logger)
+        return None
+    printandlog('Uploaded '+str(len(uploaded))+' files to s3://'+AWS_BUCKET+'/'+remoteOut, logger)
+    shutil.rmtree(localOut, ignore_errors=True)
+    return uploaded
+
+def warmMount():
     #List the directories in the bucket- this prevents a strange s3fs error
+    #Once per worker is enough
+    global mountWarmed
+    if mountWarmed:
+        return
     rootlist=os.listdir(DATA_ROOT)
     for eachSubDir in rootlist:
         subDirName=os.path.join(DATA_ROOT,eachSubDir)
         if os.path.isdir(subDirName):
             trashvar=os.system('ls '+subDirName)
+    mountWarmed = True
 
-    # Configure the logs
-    logger = logging.getLogger(__name__)
+def fetchInputs(keys, taskIn, logger):
+    # Local paths for a job's input_files (keys in AWS_BUCKET). With DOWNLOAD_FILES they are copied
+    # through the shared input cache into taskIn; otherwise they're read over the s3fs mount.
+    if str(DOWNLOAD_FILES).upper() != 'TRUE':
+        return {key:os.path.join(DATA_ROOT, key) for key in keys}
+    global inputCache
+    if inputCache is None:
+        inputCache = InputCache()
+    paths = {}
+    hits = 0
+    for key in keys:
+        paths[key] = os.path.join(taskIn, key)
+        if inputCache.fetch(key, paths[key]):
+            hits += 1
+    if len(keys) > 0:
+        printandlog('Fetched '+str(len(keys))+' input files ('+str(hits)+' from the local cache)', logger)
+    return paths
+
+def stopPrograms():
+    # Ask running programs to stop (SIGTERM gives them a chance to checkpoint), then kill what is left
+    with programsLock:
+        programs = list(runningPrograms)
+    for program in programs:
+        try:
+            os.killpg(program.pid, signal.SIGTERM)
+        except OSError:
+            pass
+    deadline = time.time() + SPOT_STOP_SECONDS
+    while time.time() < deadline and any([program.poll() is None for program in programs]):
+        time.sleep(0.5)
+    for program in programs:
+        if program.poll() is None:
+            try:
+                os.killpg(program.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+mountWarmed = False
+inputCache = None
+interrupted = threading.Event()    # set once a spot interruption notice arrives
+taskNumbers = itertools.count()    # numbers each task's local folders
+runningPrograms = set()            # subprocesses started by computeTask
+programsLock = threading.Lock()
+
+#################################
+# RUN SOME PROCESS
+#################################
+
+def prepareTask(message):
+    # First stage: everything before your program runs. Returns the task, a dict carried through
+    # computeTask and finishTask; once task['result'] is set the remaining stages skip their work.
+    timings = {}
+    if str(DOWNLOAD_FILES).upper() != 'TRUE':
+        with timed(timings, 'Warmup'):
+            warmMount()
 
     # Parse your message somehow to pull out a name variable that's going to make sense to you when you want to look at the logs later
     # What's commented out below will work, otherwise, create your own
@@ -116,113 +951,288 @@ def runSomething(message):
     groupkeys.sort()
     metadataID = '-'.join(groupkeys)
 
-    # Add a handler with
-    watchtowerlogger=watchtower.CloudWatchLogHandler(log_group=LOG_GROUP_NAME, stream_name=str(metadataID),create_log_group=False)
-    logger.addHandler(watchtowerlogger)
+    # Configure the logs; this task's records go to a log stream named after it
+    logger = logging.LoggerAdapter(logging.getLogger(__name__), {'logStream': str(metadataID)})
 
     # See if this is a message you've already handled, if you've so chosen
     # First, build a variable called remoteOut that equals your unique prefix of where your output should be
     # Then check if there are too many files
     remoteOut = metadataID
 
-    if CHECK_IF_DONE_BOOL.upper() == 'TRUE':
-        try:
-            s3client=boto3.client('s3')
-            bucketlist=s3client.list_objects(Bucket=AWS_BUCKET,Prefix=remoteOut+'/')
-            objectsizelist=[k['Size'] for k in bucketlist['Contents']]
-            objectsizelist = [i for i in objectsizelist if i >= MIN_FILE_SIZE_BYTES]
-            if NECESSARY_STRING:
-                if NECESSARY_STRING != '':
-                    objectsizelist = [i for i in objectsizelist if NECESSARY_STRING in i]
-            if len(objectsizelist)>=int(EXPECTED_NUMBER_FILES):
-                printandlog('File not run due to > expected number of files',logger)
-                logger.removeHandler(watchtowerlogger)
-                return 'SUCCESS'
-        except KeyError: #Returned if that folder does not exist
-            pass
+    # You should assign the variable "localOut" to the output location where you expect your program to put files
+    # Local folders are numbered per task: with PIPELINE, the next task is fetched and the last one uploaded
+    # while this one runs, and tasks for groups with the same keys would otherwise share a folder
+    localOut = metadataID+'_'+str(next(taskNumbers))
+    taskIn = os.path.join(localIn, localOut)
+    task = {'message':message, 'group':group_to_run, 'groupkeys':groupkeys, 'metadataID':metadataID, 'logger':logger,
+            'remoteOut':remoteOut, 'localOut':localOut, 'taskIn':taskIn, 'timings':timings, 'result':None}
 
-    # Build and run your program's command
-    # ie cmd = my-program --my-flag-1 True --my-flag-2 VARIABLE
-    # you should assign the variable "localOut" to the output location where you expect your program to put files
+    if CHECK_IF_DONE_BOOL.upper() == 'TRUE':
+        s3client=boto3.client('s3')
+        with timed(timings, 'DoneCheck'):
+            alreadyDone = isAlreadyDone(s3client, remoteOut)
+        if alreadyDone:
+            printandlog('File not run due to > expected number of files',logger)
+            task['result'] = 'SUCCESS'
+            return task
 
-    localOut = metadataID
-    local_file_name = os.path.join(localOut,'HelloWorld.txt')
     if not os.path.exists(localOut):
         os.makedirs(localOut,exist_ok=True)
 
+    # Get any input_files the message lists; inputs[key] is the local path to read each one from
+    try:
+        with timed(timings, 'Fetch'):
+            task['inputs'] = fetchInputs(message.get('input_files', []), taskIn, logger)
+    except Exception as e:
+        printandlog('PROBLEM: Could not fetch the inputs for '+metadataID+': '+str(e), logger)
+        shutil.rmtree(taskIn, ignore_errors=True)
+        task['result'] = 'PROBLEM'
+    return task
+
+def computeTask(task):
+    # Second stage: run your program
+    if task['result'] is not None:
+        return task
+    logger = task['logger']
+    if interrupted.is_set():
+        shutil.rmtree(task['taskIn'], ignore_errors=True)
+        shutil.rmtree(task['localOut'], ignore_errors=True)
+        task['result'] = 'INTERRUPTED'
+        return task
+    group_to_run = task['group']
+    groupkeys = task['groupkeys']
+
+    # Build and run your program's command
+    # ie cmd = my-program --my-flag-1 True --my-flag-2 VARIABLE
+    local_file_name = os.path.join(task['localOut'],'HelloWorld.txt')
+
     cmd = f'printf "Hi, my name is {MY_NAME}, and my favorite {groupkeys[0]} is {group_to_run[groupkeys[0]]}, and my favorite {groupkeys[1]} is {group_to_run[groupkeys[1]]}" > {local_file_name}'
 
     print('Running', cmd)
     logger.info(cmd)
     #typically, changes to the subprocess command aren't needed at all
-    subp = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    monitorAndLog(subp,logger)
+    #(it runs in its own process group, so it can be stopped as a whole on a spot interruption)
+    with timed(task['timings'], 'Compute'):
+        subp = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+        with programsLock:
+            runningPrograms.add(subp)
+        logFile = os.path.join(task['localOut'], OUTPUT_LOG_NAME) if SAVE_OUTPUT.upper() == 'TRUE' else None
+        outputTail = monitorAndLog(subp,logger,logFile)
+        with programsLock:
+            runningPrograms.discard(subp)
+    task['exitCode'] = subp.returncode
+    shutil.rmtree(task['taskIn'], ignore_errors=True)
+
+    if interrupted.is_set():
+        printandlog('Stopped by a spot interruption notice; the message was handed back to the queue',logger)
+        shutil.rmtree(task['localOut'], ignore_errors=True)
+        task['result'] = 'INTERRUPTED'
+        return task
 
     # Figure out a done condition - a number of files being created, a particular file being created, an exit code, etc.
 
     done = True
 
-    # If done, get the outputs and move them to S3
-    if done:
-        time.sleep(30)
-        mvtries=0
-        while mvtries <3:
-            try:
-                    printandlog('Move attempt #'+str(mvtries+1),logger)
-                    cmd = 'aws s3 mv ' + localOut + ' s3://' + AWS_BUCKET + '/' + remoteOut + ' --recursive'
-                    subp = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    out,err = subp.communicate()
-                    out=out.decode()
-                    err=err.decode()
-                    printandlog('== OUT \n'+out, logger)
-                    if err == '':
-                        break
-                    else:
-                        printandlog('== ERR \n'+err,logger)
-                        mvtries+=1
-            except:
-                printandlog('Move failed',logger)
-                printandlog('== ERR \n'+err,logger)
-                time.sleep(30)
-                mvtries+=1
-        if mvtries < 3:
+    if not done:
+        printandlog('PROBLEM: Failed exit condition for '+task['metadataID'],logger)
+        printandlog('Last output:\n'+outputTail,logger)
+        shutil.rmtree(task['localOut'], ignore_errors=True)
+        task['result'] = 'PROBLEM'
+    return task
+
+def finishTask(task):
+    # Third stage: if done, get the outputs and move them to S3
+    logger = task['logger']
+    if task['result'] is None:
+        with timed(task['timings'], 'Upload'):
+            uploaded = uploadOutputs(task['localOut'], task['remoteOut'], logger)
+            if uploaded is not None:
+                writeCompletionManifest(task['remoteOut'], task['group'], uploaded, logger)
+        if uploaded is not None:
+            task['files'] = uploaded
+            task['outputBytes'] = sum([size for size, checksum in uploaded.values()])
             printandlog('SUCCESS',logger)
-            logger.removeHandler(watchtowerlogger)
-            return 'SUCCESS'
+            task['result'] = 'SUCCESS'
         else:
-            printandlog('SYNC PROBLEM. Giving up on trying to sync '+metadataID,logger)
-            import shutil
-            shutil.rmtree(localOut, ignore_errors=True)
-            logger.removeHandler(watchtowerlogger)
-            return 'PROBLEM'
-    else:
-        printandlog('PROBLEM: Failed exit condition for '+metadataID,logger)
-        logger.removeHandler(watchtowerlogger)
-        import shutil
-        shutil.rmtree(localOut, ignore_errors=True)
+            printandlog('SYNC PROBLEM. Giving up on trying to sync '+task['metadataID'],logger)
+            shutil.rmtree(task['localOut'], ignore_errors=True)
+            task['result'] = 'PROBLEM'
+    # Tasks that ran leave a result record (skipped ones already have one; interrupted ones run again elsewhere)
+    if 'exitCode' in task and task['result'] != 'INTERRUPTED':
+        writeResultRecord(task)
+    return task['result']
+
+def failTask(task):
+    # A stage raised: the task is still finished, as a failure, so it leaves a result record and metrics
+    printandlog('PROBLEM: '+task['metadataID']+' failed with an error; see the worker output', task['logger'])
+    shutil.rmtree(task['taskIn'], ignore_errors=True)
+    shutil.rmtree(task['localOut'], ignore_errors=True)
+    task['result'] = 'PROBLEM'
+    task.setdefault('exitCode', None)
+    return task
+
+def runSomething(message):
+    task = prepareTask(message)
+    try:
+        result = finishTask(computeTask(task))
+    except Exception as e:
+        print('Task failed:', repr(e))
+        result = failTask(task)['result']
+        writeResultRecord(task)
+    emitTaskMetrics(task)
+    return result
+
+def runPack(message):
+    # A message packed with several groups is acknowledged as a whole: it is deleted only if every
+    # group succeeded, otherwise the entire pack goes back to the queue. Every group is still attempted,
+    # so with CHECK_IF_DONE_BOOL the groups that finished are skipped when the pack comes back.
+    shared = {eachkey:message[eachkey] for eachkey in message.keys() if eachkey != 'groups'}
+    failures = 0
+    for group in message['groups']:
+        try:
+            result = runSomething(dict(shared, group=group))
+        except Exception as e:   # e.g. a group prepareTask can't make sense of
+            print('Group', group, 'failed with an error:', repr(e))
+            result = 'PROBLEM'
+        if result != 'SUCCESS':
+            failures += 1
+    if failures > 0:
+        print(failures, 'of', len(message['groups']), 'groups in this pack failed')
         return 'PROBLEM'
+    return 'SUCCESS'
 
 
+#################################
+# CLASS TO OVERLAP THE STAGES OF CONSECUTIVE TASKS
+#################################
+
+class Pipeline():
+    # While one task computes, a fetcher thread receives the next message and prepares it (downloading
+    # its inputs) and an uploader thread finishes the previous task. At most PIPELINE_DEPTH prepared tasks
+    # wait for the CPU and PIPELINE_DEPTH finished ones wait for upload, which bounds the extra disk used.
+    # Packed messages are run whole in the compute stage.
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.slots = threading.Semaphore(PIPELINE_DEPTH)
+        self.ready = Queue()
+        self.finished = Queue(maxsize=PIPELINE_DEPTH)
+
+    def stage(self, function, argument):
+        # A failing stage fails its task rather than stalling the pipeline
+        try:
+            return function(argument)
+        except Exception as e:
+            print('Task failed in', function.__name__+':', repr(e))
+            return None
+
+    def fetchLoop(self):
+        while True:
+            self.slots.acquire()
+            timings = {}
+            with timed(timings, 'Receive'):
+                msg, handle = self.queue.nextMessage()
+            if msg is None:
+                self.ready.put(None)
+                return
+            if 'groups' in msg:
+                self.ready.put((msg, handle))
+            else:
+                task = self.stage(prepareTask, msg)
+                if task is not None:
+                    task['timings'].update(timings)
+                self.ready.put((task, handle))
+
+    def uploadLoop(self):
+        while True:
+            item = self.finished.get()
+            if item is None:
+                return
+            task, handle = item
+            if isinstance(task, dict):
+                result = self.stage(finishTask, task)
+                if result is None:
+                    result = failTask(task)['result']
+                    writeResultRecord(task)
+                acknowledge(self.queue, handle, result, task)
+            else:
+                acknowledge(self.queue, handle, task)
+
+    def run(self):
+        fetcher = threading.Thread(target=self.fetchLoop, daemon=True)
+        uploader = threading.Thread(target=self.uploadLoop, daemon=True)
+        fetcher.start()
+        uploader.start()
+        while True:
+            item = self.ready.get()
+            self.slots.release()
+            if item is None:
+                break
+            task, handle = item
+            if task is None:
+                result = 'PROBLEM'
+            elif 'groups' in task:
+                result = self.stage(runPack, task)
+            else:
+                result = self.stage(computeTask, task)
+                if result is None:
+                    result = failTask(task)
+            self.finished.put((result, handle))
+        self.finished.put(None)
+        uploader.join()
+
 #################################
 # MAIN WORKER LOOP
 #################################
 
+def acknowledge(queue, handle, result, task=None):
+    # Deletes are sent in the background, so for them the Ack phase only covers handing the message over
+    with timed(task['timings'] if task else {}, 'Ack'):
+        if result == 'SUCCESS':
+            print('Batch completed successfully.')
+            queue.deleteMessage(handle)
+        else:
+            print('Returning message to the queue.')
+            queue.returnMessage(handle)
+    if task:
+        emitTaskMetrics(task)
+
 def main():
+    logHandler = CloudWatchHandler(LOG_GROUP_NAME)
+    logging.getLogger(__name__).addHandler(logHandler)
+    metricsHandler = CloudWatchHandler(LOG_GROUP_NAME, emf=True)
+    metricsLogger = logging.getLogger(__name__+'.metrics')
+    metricsLogger.addHandler(metricsHandler)
+    metricsLogger.setLevel(logging.INFO)
+    metricsLogger.propagate = False
     queue = JobQueue(QUEUE_URL)
+    if SPOT_NOTICE_URL:
+        SpotWatcher(queue)
+    if PIPELINE.upper() == 'TRUE':
+        Pipeline(queue).run()
+        print('No messages in the queue')
+        queue.close()
+        logHandler.close()
+        metricsHandler.close()
+        return
     # Main loop. Keep reading messages while they are available in SQS
     while True:
-        msg, handle = queue.readMessage()
+        timings = {}
+        with timed(timings, 'Receive'):
+            msg, handle = queue.nextMessage()
         if msg is not None:
-            result = runSomething(msg)
-            if result == 'SUCCESS':
-                print('Batch completed successfully.')
-                queue.deleteMessage(handle)
+            if 'groups' in msg:
+                acknowledge(queue, handle, runPack(msg))
             else:
-                print('Returning message to the queue.')
-                queue.returnMessage(handle)
+                task = prepareTask(msg)
+                task['timings'].update(timings)
+                acknowledge(queue, handle, finishTask(computeTask(task)), task)
         else:
             print('No messages in the queue')
             break
+    queue.close()
+    logHandler.close()
+    metricsHandler.close()
 
 #################################
 # MODULE ENTRY POINT
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 12 17:39:49 2016
+
+@author: bcimini
+"""
+
+import json
+import logging
+import os
+import time
+
+LOCAL_OUTPUT = '/home/ubuntu/local_output'
+CGROUP_ROOT = '/sys/fs/cgroup'
+if 'INSTANCE_METRICS_SECONDS' not in os.environ:
+    INSTANCE_METRICS_SECONDS = 30
+else:
+    INSTANCE_METRICS_SECONDS = int(os.environ['INSTANCE_METRICS_SECONDS'])
+
+SECTOR_BYTES = 512
+MB = 1024 * 1024
+
+#################################
+# RAW READINGS
+#################################
+
+def readFirstInt(paths):
+    for path in paths:
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+            if value != 'max':
+                return int(value)
+        except (IOError, ValueError):
+            pass
+    return None
+
+def readStatValue(sources):
+    # The value of the first (path, key) found in flat 'key value' stat files such as memory.stat
+    for path, key in sources:
+        try:
+            with open(path) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[0] == key:
+                        return int(fields[1])
+        except (IOError, ValueError):
+            pass
+    return None
+
+def readMeminfo():
+    # /proc/meminfo values, in kB
+    values = {}
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            name, rest = line.split(':', 1)
+            values[name] = int(rest.split()[0])
+    return values
+
+def readCpu():
+    # Jiffies since boot: (busy, iowait, total), summed over all CPUs
+    with open('/proc/stat') as stat:
+        fields = [int(x) for x in stat.readline().split()[1:]]
+    idle, iowait = fields[3], fields[4]
+    total = sum(fields[:8])    # guest time is already counted in user time
+    return total - idle - iowait, iowait, total
+
+def readDisks():
+    # (sectors read, sectors written, milliseconds busy), summed over whole block devices
+    read, written, busy = 0, 0, 0
+    with open('/proc/diskstats') as diskstats:
+        for line in diskstats:
+            fields = line.split()
+            name = fields[2]
+            if name.startswith(('loop', 'ram')) or not os.path.exists('/sys/block/'+name):
+                continue
+            read += int(fields[5])
+            written += int(fields[9])
+            busy += int(fields[12])
+    return read, written, busy
+
+def readCgroup():
+    # (memory used, memory limit, CPU seconds used) of this container, or None where unavailable.
+    # Like docker stats, memory used leaves out inactive page cache, which the kernel reclaims before
+    # the limit is reached; otherwise a container that has read and written a few files looks full.
+    usage = readFirstInt([CGROUP_ROOT+'/memory.current', CGROUP_ROOT+'/memory/memory.usage_in_bytes'])
+    inactive = readStatValue([(CGROUP_ROOT+'/memory.stat', 'inactive_file'), (CGROUP_ROOT+'/memory/memory.stat', 'total_inactive_file')])
+    if usage is not None and inactive is not None:
+        usage = max(0, usage - inactive)
+    limit = readFirstInt([CGROUP_ROOT+'/memory.max', CGROUP_ROOT+'/memory/memory.limit_in_bytes'])
+    if limit is not None and limit >= 1 << 60:
+        limit = None
+    cpu = None
+    try:
+        with open(CGROUP_ROOT+'/cpu.stat') as cpustat:
+            for line in cpustat:
+                if line.startswith('usage_usec'):
+                    cpu = int(line.split()[1]) / 1e6
+    except IOError:
+        nanoseconds = readFirstInt([CGROUP_ROOT+'/cpuacct/cpuacct.usage'])
+        if nanoseconds is not None:
+            cpu = nanoseconds / 1e9
+    return usage, limit, cpu
+
+#################################
+# READINGS FOR ADMISSION DECISIONS
+#################################
+
+def availableMemoryMB():
+    # MemAvailable of the host, further limited by what is left of the container's cgroup memory limit if it has one
+    available = readMeminfo()['MemAvailable'] // 1024
+    usage, limit, cpu = readCgroup()
+    if limit is not None and usage is not None:
+        available = min(available, (limit - usage) // MB)
+    return available
+
+def availableDiskMB(path):
+    stats = os.statvfs(path)
+    return stats.f_bavail * stats.f_frsize // MB
+
+#################################
+# CLASS TO SAMPLE THE INSTANCE
+#################################
+
+class Sampler():
+    # Reads /proc, statvfs and the cgroup files directly (no df/vmstat/iostat processes) and turns the
+    # counters into rates over the time since the previous sample
+
+    def __init__(self, path=LOCAL_OUTPUT):
+        self.path = path
+        self.previous = None
+
+    def read(self):
+        return {'time': time.time(), 'cpu': readCpu(), 'disks': readDisks(), 'cgroup': readCgroup()}
+
+    def sample(self):
+        current = self.read()
+        meminfo = readMeminfo()
+        volume = os.statvfs(self.path)
+        usage, limit, cgroupCpu = current['cgroup']
+        metrics = {
+            'memAvailableMB': meminfo['MemAvailable'] // 1024,
+            'memTotalMB': meminfo['MemTotal'] // 1024,
+            'swapUsedMB': (meminfo.get('SwapTotal', 0) - meminfo.get('SwapFree', 0)) // 1024,
+            'volumeFreeMB': volume.f_bavail * volume.f_frsize // MB,
+            'volumeFreeInodes': volume.f_favail,
+        }
+        if usage is not None:
+            metrics['containerMemoryMB'] = usage // MB
+        if limit is not None:
+            metrics['containerMemoryLimitMB'] = limit // MB
+        previous = self.previous
+        self.previous = current
+        if previous is not None:
+            elapsed = current['time'] - previous['time']
+            busy, iowait, total = [now - before for now, before in zip(current['cpu'], previous['cpu'])]
+            read, written, diskBusy = [now - before for now, before in zip(current['disks'], previous['disks'])]
+            if total > 0:
+                metrics['cpuPercent'] = round(100.0 * busy / total, 1)
+                metrics['iowaitPercent'] = round(100.0 * iowait / total, 1)
+            if elapsed > 0:
+                metrics['diskReadMBps'] = round(read * SECTOR_BYTES / MB / elapsed, 2)
+                metrics['diskWriteMBps'] = round(written * SECTOR_BYTES / MB / elapsed, 2)
+                metrics['diskBusyPercent'] = round(min(100.0, diskBusy / 10.0 / elapsed), 1)
+                if cgroupCpu is not None and previous['cgroup'][2] is not None:
+                    metrics['containerCpuCores'] = round((cgroupCpu - previous['cgroup'][2]) / elapsed, 2)
+        return metrics
+
+def monitor():
+    # Log one compact JSON line of instance metrics every INSTANCE_METRICS_SECONDS
+    logger = logging.getLogger(__name__)
+    sampler = Sampler()
+    sampler.sample()
+    while True:
+        time.sleep(INSTANCE_METRICS_SECONDS)
+        logger.info(json.dumps(sampler.sample()))
+
+if __name__=='__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    monitor()
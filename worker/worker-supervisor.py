@@ -0,0 +1,121 @@
+from __future__ import print_function
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from instance_monitor import availableMemoryMB, availableDiskMB
+
+#################################
+# CONSTANT PATHS IN THE CONTAINER
+#################################
+
+LOCAL_OUTPUT = '/home/ubuntu/local_output'
+WORKER_COMMAND = [sys.executable, 'generic-worker.py']
+if 'DOCKER_CORES' not in os.environ:
+    DOCKER_CORES = 1
+else:
+    DOCKER_CORES = int(os.environ['DOCKER_CORES'])
+if 'TASK_MEMORY_MB' not in os.environ:
+    TASK_MEMORY_MB = 0
+else:
+    TASK_MEMORY_MB = int(os.environ['TASK_MEMORY_MB'])
+if 'TASK_DISK_MB' not in os.environ:
+    TASK_DISK_MB = 0
+else:
+    TASK_DISK_MB = int(os.environ['TASK_DISK_MB'])
+
+CHECK_SECONDS = 5           # How often to reap workers and reconsider admitting another one
+WARMUP_SECONDS = 120        # A new worker counts against free memory/disk for this long, until its usage shows up
+MAX_RESTART_DELAY = 5*60    # Longest wait before replacing a crashed worker
+
+#################################
+# CLASS TO SUPERVISE THE WORKERS
+#################################
+
+class Supervisor():
+
+    def __init__(self):
+        self.workers = {}       # slot -> (process, start time)
+        self.drained = False    # a worker exited cleanly, i.e. found the queue empty
+        self.stopping = False
+        self.restartDelay = CHECK_SECONDS
+        self.nextStart = 0
+
+    def admit(self):
+        # Admit another worker only if free memory and disk, minus what recently started workers
+        # are still expected to claim, cover one more task. The first worker is always admitted.
+        if len(self.workers) == 0:
+            return True
+        now = time.time()
+        warming = len([1 for process, started in self.workers.values() if now - started < WARMUP_SECONDS])
+        memory = availableMemoryMB() - warming * TASK_MEMORY_MB
+        disk = availableDiskMB(LOCAL_OUTPUT) - warming * TASK_DISK_MB
+        return memory >= TASK_MEMORY_MB and disk >= TASK_DISK_MB
+
+    def start(self, slot):
+        process = subprocess.Popen(WORKER_COMMAND, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        threading.Thread(target=self.tee, args=(process, str(slot)+'.out'), daemon=True).start()
+        self.workers[slot] = (process, time.time())
+        print('Started worker', slot, 'pid', process.pid)
+
+    def tee(self, process, logFile):
+        # Copy a worker's output to the container log and to its own file, as run-worker.sh used to
+        with open(logFile, 'ab') as log:
+            while True:
+                chunk = process.stdout.read1(65536)
+                if not chunk:
+                    break
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
+                log.write(chunk)
+                log.flush()
+
+    def reap(self):
+        for slot, (process, started) in list(self.workers.items()):
+            returncode = process.poll()
+            if returncode is None:
+                continue
+            del self.workers[slot]
+            if returncode == 0:
+                print('Worker', slot, 'finished')
+                self.drained = True
+            elif not self.stopping:
+                # Back off if workers keep crashing quickly, so a broken job doesn't spin the CPU
+                if time.time() - started > WARMUP_SECONDS:
+                    self.restartDelay = CHECK_SECONDS
+                else:
+                    self.restartDelay = min(MAX_RESTART_DELAY, self.restartDelay * 2)
+                self.nextStart = time.time() + self.restartDelay
+                print('Worker', slot, 'exited with code', returncode, '- replacing it in', self.restartDelay, 'seconds')
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for process, started in self.workers.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+
+    def run(self):
+        while True:
+            self.reap()
+            if self.stopping or self.drained:
+                if len(self.workers) == 0:
+                    break
+            elif len(self.workers) < DOCKER_CORES and time.time() >= self.nextStart and self.admit():
+                slot = min(set(range(DOCKER_CORES)) - set(self.workers.keys()))
+                self.start(slot)
+                continue
+            time.sleep(CHECK_SECONDS)
+
+#################################
+# MODULE ENTRY POINT
+#################################
+
+if __name__ == '__main__':
+    print('Supervisor started, up to', DOCKER_CORES, 'workers')
+    supervisor = Supervisor()
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    supervisor.run()
+    print('Supervisor finished')